@@ -0,0 +1,64 @@
+'''
+A benchmark of the column cache (see Doors.models.columns)
+
+Runs a few analytics through the ORM and over the memory mapped column cache, checks they agree, and
+reports how long each took (the best of a number of repeats). The cache must be current (it's written by
+fetch_logs, or update_columns), and opening it (memory mapping it) is timed separately.
+'''
+from time import perf_counter
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+
+from Doors.models import DataFetch, Event, Opening, Visit
+from Doors.models import columns
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks analytics (histograms, per-day counts, battery series, segmentation) through the ORM against the column cache'
+
+    def add_arguments(self , parser):
+        parser.add_argument('-r', '--repeats', type=int, default=5, help="The number of times each is run (the best time is reported)")
+        parser.add_argument('-u', '--update', action='store_true', help="Write the column cache first if it is not current")
+
+    def best(self, function, repeats):
+        times = []
+        for _ in range(repeats):
+            start = perf_counter()
+            result = function()
+            times.append(perf_counter() - start)
+        return result, min(times)
+
+    def handle(self, *args, **kwargs):
+        if columns.cache_dir() is None:
+            raise CommandError("No column cache is configured (see settings.COLUMN_CACHE).")
+
+        start = perf_counter()
+        cached = columns.current()
+        if cached is None and kwargs['update'] and DataFetch.version() is not None:
+            columns.refresh(DataFetch.version(), verbosity=kwargs['verbosity'])
+            start = perf_counter()
+            cached = columns.current()
+        if cached is None:
+            raise CommandError("The column cache is not current (use -u to write it, or run update_columns).")
+        print(f"Opened the column cache (version {DataFetch.version()}) in {(perf_counter() - start) * 1000:.2f} ms: "
+              f"{', '.join(f'{len(cached[t][columns.TIME_COLUMNS[t]])} {t}' for t in columns.TABLES)}.")
+
+        thresholds = [timedelta(minutes=m) for m in (1, 2, 5, 10, 15, 20, 30, 60)]
+        categories = timedelta(seconds=30)
+
+        quiet = timedelta(minutes=30)
+
+        benchmarks = [("Visits per day", lambda: Visit.histogram("per_days", cache=False), lambda: Visit.histogram("per_days", cache=True)),
+                      ("Visits by hour of day", lambda: Visit.histogram("day", cache=False), lambda: Visit.histogram("day", cache=True)),
+                      ("Visit durations", lambda: Visit.histogram("durations", categories, cache=False), lambda: Visit.histogram("durations", categories, cache=True)),
+                      ("Quiet times", lambda: Visit.histogram("quiet_times", quiet, cache=False), lambda: Visit.histogram("quiet_times", quiet, cache=True)),
+                      ("Opening durations", lambda: Opening.histogram("durations", categories, cache=False), lambda: Opening.histogram("durations", categories, cache=True)),
+                      ("Battery series", lambda: Event.battery_series(cache=False), lambda: Event.battery_series(cache=True)),
+                      ("Visit segmentation", lambda: Visit.segmentation(thresholds, categories, cache=False), lambda: Visit.segmentation(thresholds, categories, cache=True))]
+
+        for name, orm, cache in benchmarks:
+            orm_result, orm_time = self.best(orm, kwargs['repeats'])
+            cache_result, cache_time = self.best(cache, kwargs['repeats'])
+            agree = "agree" if orm_result == cache_result else "DISAGREE"
+            print(f"\t{name}: ORM {orm_time * 1000:.2f} ms, column cache {cache_time * 1000:.2f} ms ({orm_time / cache_time:.1f} times faster), results {agree}.")
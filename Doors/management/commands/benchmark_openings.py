@@ -0,0 +1,50 @@
+'''
+A benchmark of Opening.update_from_events
+
+Rebuilds the Openings of a door from its recorded events one by one, in bulk and vectorized, reports
+how long each took and checks they paired the events alike. Everything is done in a transaction that
+is rolled back, so the database is left as it was found.
+'''
+from time import perf_counter
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from Doors.models import Door, Opening
+
+ENGINES = {"one by one": {"bulk": False},
+           "in bulk": {"bulk": True},
+           "vectorized": {"vectorized": True}}
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks rebuilding the Openings of a door with Opening.update_from_events, one by one, in bulk and vectorized'
+
+    def add_arguments(self , parser):
+        parser.add_argument('-d', '--door', type=int, default=None, help="The ID of the Door to rebuild the Openings of (default: the first door)")
+
+    def time_rebuild(self, door, engine):
+        with transaction.atomic():
+            start = perf_counter()
+            Opening.update_from_events(door, Rebuild=True, **engine)
+            elapsed = perf_counter() - start
+            pairs = list(Opening.objects.filter(door=door).order_by("date_time").values_list("open_event_id", "close_event_id", "duration"))
+            transaction.set_rollback(True)
+        return pairs, elapsed
+
+    def handle(self, *args, **kwargs):
+        door = Door.objects.get(pk=kwargs['door']) if kwargs['door'] else Door.objects.first()
+        if door is None:
+            print("No doors on record to benchmark against.")
+            return
+
+        print(f"Rebuilding the Openings of door {door.id} ...")
+
+        results = {}
+        for name, engine in ENGINES.items():
+            pairs, elapsed = self.time_rebuild(door, engine)
+            results[name] = pairs
+            print(f"\t{name + ':':12s} {len(pairs)} openings in {elapsed:.2f} s")
+
+        agree = all(pairs == results["one by one"] for pairs in results.values())
+        print(f"The engines {'agree' if agree else 'DISAGREE'}.")
@@ -0,0 +1,76 @@
+'''
+A benchmark of Event.save_logs
+
+Replays a synthetic Tuya log through the one-event-at-a-time path and the bulk path and reports
+how long each took. Everything is done in a transaction that is rolled back, so the database is
+left as it was found.
+'''
+import random
+
+from time import perf_counter
+from datetime import datetime
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from Doors.models import Door, Event
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks saving a synthetic Tuya log with Event.save_logs, event by event and in bulk'
+
+    def add_arguments(self , parser):
+        parser.add_argument('-e', '--events', type=int, default=100000, help="The number of events in the synthetic log")
+        parser.add_argument('-d', '--door', type=int, default=None, help="The ID of the Door to save the events against (default: the first door)")
+
+    def synthetic_log(self, count, start):
+        '''
+        Returns a log shaped like the one tinytuya.Cloud.getdevicelog returns with count events from
+        the start timestamp on, a plausible mix of door contacts, online/offline and battery reports.
+        '''
+        logs = []
+        timestamp = start
+        is_open = False
+        for i in range(count):
+            timestamp += random.randint(1000, 60000)
+            kind = i % 4
+            if kind == 0:
+                logs.append({'event_id': 1, 'event_from': '1', 'event_time': timestamp, 'code': '', 'value': ''})
+            elif kind == 1:
+                is_open = not is_open
+                logs.append({'event_id': 7, 'event_from': '1', 'event_time': timestamp, 'code': 'doorcontact_state', 'value': 'true' if is_open else 'false'})
+            elif kind == 2:
+                logs.append({'event_id': 7, 'event_from': '1', 'event_time': timestamp, 'code': 'battery_state', 'value': random.choice(['low', 'middle', 'high'])})
+            else:
+                logs.append({'event_id': 2, 'event_from': '1', 'event_time': timestamp, 'code': '', 'value': ''})
+
+        return {'result': {'logs': logs, 'has_next': False}, 'success': True}
+
+    def time_save(self, door, log, bulk):
+        with transaction.atomic():
+            start = perf_counter()
+            added = Event.save_logs(door, log, bulk=bulk)
+            elapsed = perf_counter() - start
+            transaction.set_rollback(True)
+        return added, elapsed
+
+    def handle(self, *args, **kwargs):
+        door = Door.objects.get(pk=kwargs['door']) if kwargs['door'] else Door.objects.first()
+        if door is None:
+            print("No doors on record to benchmark against.")
+            return
+
+        # Start after the last recorded event so the synthetic events are all new
+        last = Event.last()
+        start = last.timestamp + 1000 if last else Event.timestamp_from_datetime(datetime.now())
+        log = self.synthetic_log(kwargs['events'], int(start))
+
+        print(f"Saving {kwargs['events']} synthetic events against door {door.id} ...")
+
+        added, each_time = self.time_save(door, log, bulk=False)
+        print(f"\tevent by event: saved {added} events in {each_time:.2f} s ({added/each_time:.0f} events/s)")
+
+        added, bulk_time = self.time_save(door, log, bulk=True)
+        print(f"\tin bulk:        saved {added} events in {bulk_time:.2f} s ({added/bulk_time:.0f} events/s)")
+
+        print(f"Bulk saving was {each_time/bulk_time:.1f} times faster.")
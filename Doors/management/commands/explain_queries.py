@@ -0,0 +1,100 @@
+'''
+A query plan regression check of the hot queries
+
+Loads a large synthetic dataset (events, and the openings, uptimes and visits derived from them)
+and EXPLAINs each of the hot queries (see Doors.models.plans) failing if any plan includes a
+sequential scan or does not use the index designed to serve it. Everything is done in a transaction that is rolled back, so the database is left
+as it was found.
+'''
+import random
+
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from Doors.models import Door, Event, Opening, Uptime, Visit
+from Doors.models.conf import UPTIME_CODE, BULK_BATCH_SIZE, VISIT_SEPARATION
+from Doors.models.plans import check_plans
+
+
+class Command(BaseCommand):
+    help = 'Checks the query plans of the hot queries against a large synthetic dataset for sequential scans and unused indexes'
+
+    def add_arguments(self , parser):
+        parser.add_argument('-e', '--events', type=int, default=2000000, help="The number of synthetic events (spread over the doors)")
+        parser.add_argument('-d', '--doors', type=int, default=4, help="The number of synthetic doors")
+
+    def synthetic_events(self, doors, count, start):
+        '''
+        A generator of count Events from the start timestamp on, as visits (a few door contacts on random
+        doors in quick succession, with the occasional bounce) separated by quiet times, and now and then
+        a sensor going offline and back online.
+        '''
+        timestamp = start
+        is_open = {door.id: False for door in doors}
+        is_online = {door.id: True for door in doors}
+        for i in range(count):
+            # Every ten events or so, a quiet time between visits
+            if random.random() < 0.1:
+                timestamp += random.randint(VISIT_SEPARATION * 60000, 6 * 3600000)
+            else:
+                timestamp += random.randint(1000, 60000)
+
+            door = random.choice(doors)
+            if i % 50 == 0:
+                is_online[door.id] = not is_online[door.id]
+                yield Event(timestamp=timestamp, source="device itself", code=UPTIME_CODE, type="online" if is_online[door.id] else "offline", value="", door=door)
+            else:
+                if random.random() > 0.05:
+                    is_open[door.id] = not is_open[door.id]
+                yield Event(timestamp=timestamp, source="device itself", code="doorcontact_state", type="data report", value="Open" if is_open[door.id] else "Closed", door=door)
+
+    def load(self, doors, events, verbosity):
+        # Start after the last recorded event so the synthetic events are all new
+        last = Event.last()
+        start = last.timestamp + 1000 if last else Event.timestamp_from_datetime(datetime.now())
+
+        doors = [Door.objects.create(tuya_device_id=f"synthetic-{d}", contents="Synthetic") for d in range(doors)]
+
+        batch = []
+        for event in self.synthetic_events(doors, events, int(start)):
+            batch.append(event)
+            if len(batch) == BULK_BATCH_SIZE * 10:
+                Event.objects.bulk_create(batch, batch_size=BULK_BATCH_SIZE)
+                batch = []
+        Event.objects.bulk_create(batch, batch_size=BULK_BATCH_SIZE)
+
+        for door in doors:
+            Opening.update_from_events(door, verbosity=verbosity)
+            Uptime.update_from_events(door, verbosity=verbosity)
+
+        Visit.update_from_openings(verbosity=verbosity)
+
+        # Give the planner statistics on the new data
+        with connection.cursor() as cursor:
+            for model in (Event, Opening, Uptime, Visit):
+                cursor.execute(f"ANALYZE {connection.ops.quote_name(model._meta.db_table)}")
+
+        return doors[-1]
+
+    def handle(self, *args, **kwargs):
+        if connection.vendor != "postgresql":
+            raise CommandError("Query plans are only checked on PostgreSQL.")
+
+        verbosity = kwargs['verbosity']
+
+        with transaction.atomic():
+            print(f"Loading {kwargs['events']} synthetic events on {kwargs['doors']} doors ...")
+            door = self.load(kwargs['doors'], kwargs['events'], verbosity - 1)
+
+            # Query from near the end of the door's events, where incremental updates query from
+            recent = Event.objects.filter(door=door).order_by("-timestamp").values_list("timestamp", flat=True)[100]
+
+            failures = check_plans(door, recent, verbosity=max(verbosity, 1))
+            transaction.set_rollback(True)
+
+        if failures:
+            raise CommandError(f"{len(failures)} hot queries are not served by their index: {', '.join(failures)}")
+
+        print("Every hot query is served by its index.")
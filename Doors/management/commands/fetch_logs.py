@@ -39,10 +39,28 @@ My Devices are here:
 from django.core.management.base import BaseCommand
 
 from Doors.models import DataFetch
+from Doors.views.cache import warm_pages
+from Doors.models.conf import FETCH_WORKERS, TUYA_CALLS_PER_SECOND, TUYA_CALLS_PER_FETCH
 
 
 class Command(BaseCommand):
     help = 'Fetches the Tuya Logs and updates the database accordingly'
 
+    def add_arguments(self , parser):
+        parser.add_argument('-n', '--new', action='store_true', help="start a new fetch even if the last one was interrupted (don't resume it)")
+        parser.add_argument('-w', '--workers', type=int, default=FETCH_WORKERS, help=f"the number of doors to fetch concurrently (default: {FETCH_WORKERS})")
+        parser.add_argument('--rate', type=float, default=TUYA_CALLS_PER_SECOND, help=f"the maximum number of Tuya API calls per second, 0 for no limit (default: {TUYA_CALLS_PER_SECOND})")
+        parser.add_argument('--no-warm', action='store_true', help="don't warm the page cache after fetching")
+        parser.add_argument('--budget', type=int, default=TUYA_CALLS_PER_FETCH, help=f"the maximum number of Tuya API calls to make, 0 for no limit (default: {TUYA_CALLS_PER_FETCH})")
+
     def handle(self, *args, **kwargs):
-        DataFetch.fetch_logs(verbosity=kwargs['verbosity'])
+        DataFetch.fetch_logs(resume=not kwargs['new'],
+                             workers=kwargs['workers'],
+                             rate=kwargs['rate'],
+                             budget=kwargs['budget'],
+                             verbosity=kwargs['verbosity'])
+
+        # The fetch invalidated all cached pages, so render the expensive ones now, rather than
+        # have the first visitor wait for them.
+        if not kwargs['no_warm']:
+            warm_pages(verbosity=kwargs['verbosity'])
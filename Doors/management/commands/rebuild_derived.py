@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from Doors.models import DataFetch, Histogram, DailyRollup
+from Doors.models.shadow import rebuild
+from Doors.views.cache import warm_pages
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds Openings, Uptimes and Visits from all recorded Events into shadow tables and swaps them in once validated, with no downtime (PostgreSQL only)'
+
+    def add_arguments(self , parser):
+        parser.add_argument('-a', '--accept', action='store_true', help="swap the rebuilt tables in even if they differ from the live tables (row counts or checksums)")
+
+    def handle(self, *args, **kwargs):
+        if connection.vendor != "postgresql":
+            raise CommandError("Shadow rebuilds need PostgreSQL, use update_openings, update_uptimes and update_visits with -R instead.")
+
+        validation, swapped = rebuild(accept_changes=kwargs['accept'], verbosity=kwargs['verbosity'])
+
+        if not swapped:
+            raise CommandError("The rebuilt data differs from the live data and was not swapped in (use -a to accept the changes).")
+
+        # The rollups, histograms (summed from the rollups) and data statistics presented on the site are drawn from them
+        DailyRollup.update(verbosity=kwargs['verbosity'])
+        Histogram.refresh(verbosity=kwargs['verbosity'])
+
+        # As are the column cache and the cached pages, of a new version of the data (warmed, as after a fetch)
+        DataFetch.data_changed(verbosity=kwargs['verbosity'])
+        warm_pages(verbosity=kwargs['verbosity'])
@@ -0,0 +1,37 @@
+import humanize
+
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+
+from Doors.models import Visit
+from Doors.models.conf import VISIT_SEPARATION
+
+
+class Command(BaseCommand):
+    help = 'Reports the visits Openings would be grouped into at each of a list of thresholds (the gap between openings that separates visits), without changing Visits'
+
+    def add_arguments(self , parser):
+        parser.add_argument('-t', '--thresholds', default="1,2,5,10,15,20,30,60", help=f"a comma separated list of thresholds in minutes (default 1,2,5,10,15,20,30,60, Visits use {VISIT_SEPARATION})")
+        parser.add_argument('-c', '--categories', type=float, default=30, help="the width of the bins of the visit duration histograms in seconds (default 30)")
+
+    def handle(self, *args, **kwargs):
+        try:
+            thresholds = sorted(timedelta(minutes=float(t)) for t in kwargs['thresholds'].split(","))
+        except ValueError:
+            raise CommandError(f"Thresholds must be numbers of minutes, not: {kwargs['thresholds']}")
+
+        segmentation = Visit.segmentation(thresholds, timedelta(seconds=kwargs['categories']))
+
+        for threshold, visits in segmentation.items():
+            if visits["visits"]:
+                openings = sum(n * c for n, c in visits["doors_per_visit_total"].items()) / visits["visits"]
+                doors = sum(n * c for n, c in visits["doors_per_visit_unique"].items()) / visits["visits"]
+                print(f"{humanize.precisedelta(threshold)}: {visits['visits']} visits, median duration {humanize.precisedelta(visits['median_duration'], format='%0.1f')}, "
+                      f"{openings:.2f} openings ({doors:.2f} doors) per visit")
+            else:
+                print(f"{humanize.precisedelta(threshold)}: no visits")
+
+            if kwargs['verbosity'] >= 2:
+                for histogram in ("durations", "doors_per_visit_total", "doors_per_visit_unique"):
+                    print(f"\t{histogram}: {visits[histogram]}")
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from Doors.models import DataFetch
+from Doors.models import columns
+
+
+class Command(BaseCommand):
+    help = 'Writes the column cache of Events, Openings and Visits for the current version of the data (fetch_logs does so after every fetch)'
+
+    def add_arguments(self , parser):
+        parser.add_argument('-r', '--rebuild', action='store_true', help="write every table afresh from the database (needed after derived data is rebuilt outside of fetch_logs)")
+
+    def handle(self, *args, **kwargs):
+        if columns.cache_dir() is None:
+            raise CommandError("No column cache is configured (see settings.COLUMN_CACHE).")
+
+        version = DataFetch.version()
+        if version is None:
+            raise CommandError("No fetch of the logs has finished, so there is no version of the data to cache.")
+
+        columns.refresh(version, rebuild=kwargs['rebuild'], verbosity=max(kwargs['verbosity'], 1))
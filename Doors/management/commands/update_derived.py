@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from Doors.models import Door, DataFetch, Histogram, DailyRollup
+from Doors.views.cache import warm_pages
+from Doors.models.pipeline import Pipeline, STAGES
+
+
+class Command(BaseCommand):
+    help = 'Updates Openings, Uptimes, battery charges and event pairing states from recorded Events, in one pass per door'
+
+    def add_arguments(self , parser):
+        parser.add_argument('-r', '--rebuild', action='store_true', help="process all events (i.e. don't just process new events)")
+        parser.add_argument('-s', '--stages', help=f"a comma separated list of the stages to run, of: {', '.join(s.name for s in STAGES)} (default all)")
+
+    def handle(self, *args, **kwargs):
+        stages = STAGES
+        if kwargs['stages']:
+            names = kwargs['stages'].split(",")
+            unknown = set(names) - set(s.name for s in STAGES)
+            if unknown:
+                raise CommandError(f"Unknown stages: {', '.join(sorted(unknown))}")
+            stages = [s for s in STAGES if s.name in names]
+
+        for door in Door.objects.all():
+            Pipeline(door, stages=stages, rebuild=kwargs['rebuild'], verbosity=kwargs['verbosity']).run()
+
+        # The rollups, histograms (summed from the rollups) and data statistics presented on the site are drawn from them
+        DailyRollup.update(verbosity=kwargs['verbosity'])
+        Histogram.refresh(verbosity=kwargs['verbosity'])
+
+        # As are the column cache and the cached pages, of a new version of the data (warmed, as after a fetch)
+        DataFetch.data_changed(verbosity=kwargs['verbosity'])
+        warm_pages(verbosity=kwargs['verbosity'])
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from Doors.models import Histogram, DataFetch
+from Doors.views.cache import warm_pages
+
+
+class Command(BaseCommand):
+    help = 'Updates the precomputed histograms from the daily rollups'
+
+    def add_arguments(self , parser):
+        parser.add_argument('-r', '--rebuild', action='store_true', help="rebuild all histograms from scratch, from Visits and Openings (i.e. not from the daily rollups)")
+        parser.add_argument('-c', '--check', action='store_true', help="don't update, just check the stored histograms against the live data")
+
+    def handle(self, *args, **kwargs):
+        if kwargs['check']:
+            Histogram.verify(verbosity=max(kwargs['verbosity'], 1))
+        else:
+            Histogram.refresh(rebuild=kwargs['rebuild'], verbosity=kwargs['verbosity'])
+
+            # The pages presenting them are cached, by version of the data (Events, Openings and Visits are unchanged)
+            DataFetch.data_changed(rebuild=False, verbosity=kwargs['verbosity'])
+            warm_pages(verbosity=kwargs['verbosity'])
@@ -1,6 +1,7 @@
 from django.core.management.base import BaseCommand
 
-from Doors.models import Door, Opening
+from Doors.models import Door, Opening, DataFetch, Histogram, DailyRollup
+from Doors.views.cache import warm_pages
 
 
 class Command(BaseCommand):
@@ -8,8 +9,17 @@ class Command(BaseCommand):
 
     def add_arguments(self , parser):
         parser.add_argument('-r', '--rebuild', action='store_true', help="rebuild all Openings (i.e. don't just process new events)")
-        parser.add_argument('-R', '--Rebuild', action='store_true', help="Same as -r but delete all existing openings first.")
+        parser.add_argument('-R', '--Rebuild', action='store_true', help="Same as -r but delete all existing openings first (see rebuild_derived for a rebuild with no downtime).")
+        parser.add_argument('-n', '--numpy', action='store_true', help="pair events with the vectorized NumPy engine (fastest for rebuilds)")
 
     def handle(self, *args, **kwargs):
         for door in Door.objects.all():
-            Opening.update_from_events(door, rebuild=kwargs['rebuild'], Rebuild=kwargs['Rebuild'], verbosity=kwargs['verbosity'])
+            Opening.update_from_events(door, rebuild=kwargs['rebuild'], Rebuild=kwargs['Rebuild'], vectorized=kwargs['numpy'], verbosity=kwargs['verbosity'])
+
+        # The rollups, histograms (summed from the rollups) and data statistics presented on the site are drawn from them
+        DailyRollup.update(verbosity=kwargs['verbosity'])
+        Histogram.refresh(verbosity=kwargs['verbosity'])
+
+        # As are the column cache and the cached pages, of a new version of the data (warmed, as after a fetch)
+        DataFetch.data_changed(verbosity=kwargs['verbosity'])
+        warm_pages(verbosity=kwargs['verbosity'])
@@ -0,0 +1,29 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+
+from Doors.models import DailyRollup, Histogram, DataFetch
+from Doors.views.cache import warm_pages
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the daily rollups (per door, per day) from Openings, Visits and battery Events, for all days or a range of them'
+
+    def add_arguments(self , parser):
+        parser.add_argument('-s', '--start', help="the first day to roll up (YYYY-MM-DD, default the first day there is)")
+        parser.add_argument('-e', '--end', help="the last day to roll up (YYYY-MM-DD, default the last day there is)")
+
+    def handle(self, *args, **kwargs):
+        try:
+            start, end = (date.fromisoformat(kwargs[bound]) if kwargs[bound] else None for bound in ('start', 'end'))
+        except ValueError as E:
+            raise CommandError(f"Days must be given as YYYY-MM-DD: {E}")
+
+        DailyRollup.update(start, end, verbosity=max(kwargs['verbosity'], 1))
+
+        # The histograms presented are summed from them
+        Histogram.refresh(verbosity=kwargs['verbosity'])
+
+        # And the pages presenting them are cached, by version of the data (Events, Openings and Visits are unchanged)
+        DataFetch.data_changed(rebuild=False, verbosity=kwargs['verbosity'])
+        warm_pages(verbosity=kwargs['verbosity'])
@@ -8,8 +8,9 @@ class Command(BaseCommand):
 
     def add_arguments(self , parser):
         parser.add_argument('-r', '--rebuild', action='store_true', help="rebuild all uptimes (i.e. don't just process new events)")
-        parser.add_argument('-R', '--Rebuild', action='store_true', help="Same as -r but delete all existing uptimes first.")
+        parser.add_argument('-R', '--Rebuild', action='store_true', help="Same as -r but delete all existing uptimes first (see rebuild_derived for a rebuild with no downtime).")
+        parser.add_argument('-n', '--numpy', action='store_true', help="pair events with the vectorized NumPy engine (fastest for rebuilds)")
 
     def handle(self, *args, **kwargs):
         for door in Door.objects.all():
-            Uptime.update_from_events(door, rebuild=kwargs['rebuild'], Rebuild=kwargs['Rebuild'], verbosity=kwargs['verbosity'])
+            Uptime.update_from_events(door, rebuild=kwargs['rebuild'], Rebuild=kwargs['Rebuild'], vectorized=kwargs['numpy'], verbosity=kwargs['verbosity'])
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from Doors.models import Event
+from Doors.models.conf import PAIRING_STATES
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the pairing state of all Events from scratch and reports any drift from the recorded state'
+
+    def add_arguments(self , parser):
+        parser.add_argument('-f', '--fix', action='store_true', help="correct the recorded pairing state of events that drifted")
+
+    def handle(self, *args, **kwargs):
+        drift = Event.pairing_drift(fix=kwargs['fix'])
+
+        if drift:
+            for (code, recorded, correct), count in sorted(drift.items()):
+                print(f"{count} {code} events recorded as '{PAIRING_STATES[recorded]}' should be '{PAIRING_STATES[correct]}'.")
+            print(f"{sum(drift.values())} events drifted{', now fixed' if kwargs['fix'] else ''}.")
+        elif kwargs['verbosity'] >= 1:
+            print("The recorded pairing state of all events is correct.")
@@ -0,0 +1,29 @@
+# Generated by Django 4.1.13 on 2026-10-16 20:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Doors', '0005_datafetch_event_data_fetch'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='datafetch',
+            name='complete',
+            field=models.BooleanField(default=True, verbose_name='Complete'),
+        ),
+        # Fetches before this was added all completed, new ones are incomplete until they do.
+        migrations.AlterField(
+            model_name='datafetch',
+            name='complete',
+            field=models.BooleanField(default=False, verbose_name='Complete'),
+        ),
+        migrations.AddField(
+            model_name='datafetch',
+            name='row_keys',
+            field=models.JSONField(default=dict, verbose_name='Tuya row keys'),
+        ),
+    ]
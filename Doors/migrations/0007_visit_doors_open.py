@@ -0,0 +1,19 @@
+# Generated by Django 4.1.13 on 2026-10-16 20:59
+
+import django.core.serializers.json
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Doors', '0006_datafetch_row_keys'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='visit',
+            name='doors_open',
+            field=models.JSONField(encoder=django.core.serializers.json.DjangoJSONEncoder, null=True),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 4.1.13 on 2026-10-16 21:00
+
+import django.core.serializers.json
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Doors', '0007_visit_doors_open'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Histogram',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', models.CharField(max_length=64, verbose_name='Model')),
+                ('htype', models.CharField(max_length=64, verbose_name='Histogram type')),
+                ('categories', models.CharField(blank=True, max_length=64, verbose_name='Categories')),
+                ('data', models.JSONField(encoder=django.core.serializers.json.DjangoJSONEncoder, verbose_name='Data')),
+                ('source', models.JSONField(encoder=django.core.serializers.json.DjangoJSONEncoder, verbose_name='Source summary')),
+                ('date_time', models.DateTimeField(verbose_name='Time')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='histogram',
+            constraint=models.UniqueConstraint(fields=('model', 'htype', 'categories'), name='unique_histogram'),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 4.1.13 on 2026-10-16 21:01
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def finish_past_fetches(apps, schema_editor):
+    # Fetches before this was added all finished, we don't know when but near enough when they started
+    DataFetch = apps.get_model('Doors', 'DataFetch')
+    DataFetch.objects.update(finished=F('date_time'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Doors', '0008_histogram'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='datafetch',
+            name='finished',
+            field=models.DateTimeField(null=True, verbose_name='Finished'),
+        ),
+        migrations.RunPython(finish_past_fetches, migrations.RunPython.noop),
+    ]
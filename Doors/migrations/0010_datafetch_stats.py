@@ -0,0 +1,19 @@
+# Generated by Django 4.1.13 on 2026-10-16 21:04
+
+import django.core.serializers.json
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Doors', '0009_datafetch_finished'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='datafetch',
+            name='stats',
+            field=models.JSONField(encoder=django.core.serializers.json.DjangoJSONEncoder, null=True, verbose_name='Data statistics'),
+        ),
+    ]
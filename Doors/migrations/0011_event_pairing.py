@@ -0,0 +1,45 @@
+# Generated by Django 4.1.13 on 2026-10-16 21:06
+
+from django.db import migrations, models
+from django.db.models import Case, When, Value, Exists, OuterRef
+
+
+def pair_events(apps, schema_editor):
+    # Record the pairing state of all the events already paired into Openings and Uptimes (as
+    # Event.update_pairing does, but historical models don't have its methods)
+    Door = apps.get_model('Doors', 'Door')
+    Event = apps.get_model('Doors', 'Event')
+    pairs = {'doorcontact_state': (apps.get_model('Doors', 'Opening'), 'open_event', 'close_event'),
+             'updown_state': (apps.get_model('Doors', 'Uptime'), 'online_event', 'offline_event')}
+
+    for door in Door.objects.all():
+        for code, (model, opened, closed) in pairs.items():
+            last_close = model.objects.filter(door=door).order_by(f"-{closed}_id").values_list(f"{closed}_id", flat=True).first()
+            if last_close is None:
+                continue
+
+            Event.objects.filter(door=door, code=code).update(pairing=Case(
+                When(Exists(model.objects.filter(**{opened: OuterRef('pk')})), then=Value('open')),
+                When(Exists(model.objects.filter(**{closed: OuterRef('pk')})), then=Value('close')),
+                When(timestamp__gt=last_close, then=Value('pending')),
+                default=Value('orphan')))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Doors', '0010_datafetch_stats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='event',
+            name='pairing',
+            field=models.CharField(choices=[('pending', 'Pending'), ('open', 'Opens a pair'), ('close', 'Closes a pair'), ('orphan', 'Orphan')], default='pending', max_length=8, verbose_name='Pairing state'),
+        ),
+        migrations.AddIndex(
+            model_name='event',
+            index=models.Index(fields=['code', 'pairing'], name='event_pairing'),
+        ),
+        migrations.RunPython(pair_events, migrations.RunPython.noop),
+    ]
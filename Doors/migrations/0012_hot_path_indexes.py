@@ -0,0 +1,33 @@
+# Generated by Django 4.1.13 on 2026-10-16 21:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Doors', '0011_event_pairing'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='event',
+            index=models.Index(fields=['door', 'code', 'timestamp'], include=('value',), name='event_door_code_time'),
+        ),
+        migrations.AddIndex(
+            model_name='opening',
+            index=models.Index(fields=['door', 'date_time'], include=('close_event',), name='opening_door_time'),
+        ),
+        migrations.AddIndex(
+            model_name='opening',
+            index=models.Index(fields=['date_time'], name='opening_time'),
+        ),
+        migrations.AddIndex(
+            model_name='uptime',
+            index=models.Index(fields=['door', 'date_time'], include=('online_event',), name='uptime_door_time'),
+        ),
+        migrations.AddIndex(
+            model_name='visit',
+            index=models.Index(fields=['date_time'], name='visit_time'),
+        ),
+    ]
@@ -0,0 +1,68 @@
+# Generated by Django 4.1.13 on 2026-10-16 21:47
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+import math
+
+# A frozen copy of how Doors.models.sketch.LogSketch counts values and serialises a sketch, as it was when
+# this migration was written (so that later changes to LogSketch don't change what this migration writes)
+ACCURACY = 0.01
+LOG_GAMMA = math.log((1 + ACCURACY) / (1 - ACCURACY))
+
+
+def sketch_of(values):
+    count, total, low, high, zeros, buckets = 0, 0.0, None, None, 0, {}
+    for value in values:
+        count += 1
+        total += value
+        low = value if low is None else min(low, value)
+        high = value if high is None else max(high, value)
+        if value <= 0:
+            zeros += 1
+        else:
+            i = math.ceil(math.log(value) / LOG_GAMMA)
+            buckets[i] = buckets.get(i, 0) + 1
+
+    return {"accuracy": ACCURACY,
+            "count": count,
+            "total": total,
+            "min": low,
+            "max": high,
+            "zeros": zeros,
+            "buckets": {str(i): n for i, n in buckets.items()}}
+
+
+def sketch_uptimes(apps, schema_editor):
+    # Sketch the uptimes already recorded (as UptimeSketch.update does, but historical models don't have its methods)
+    Door = apps.get_model('Doors', 'Door')
+    Uptime = apps.get_model('Doors', 'Uptime')
+    UptimeSketch = apps.get_model('Doors', 'UptimeSketch')
+
+    for door in Door.objects.all():
+        durations = []
+        through = None
+        for online, duration in Uptime.objects.filter(door=door).order_by("online_event_id").values_list("online_event_id", "duration").iterator():
+            durations.append(duration.total_seconds())
+            through = online
+        UptimeSketch.objects.create(door=door, sketch=sketch_of(durations), through=through)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Doors', '0012_hot_path_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UptimeSketch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sketch', models.JSONField(verbose_name='Sketch')),
+                ('through', models.BigIntegerField(null=True, verbose_name='Through')),
+                ('door', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='uptime_sketch', to='Doors.door')),
+            ],
+        ),
+        migrations.RunPython(sketch_uptimes, migrations.RunPython.noop),
+    ]
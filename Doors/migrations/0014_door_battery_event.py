@@ -0,0 +1,34 @@
+# Generated by Django 4.1.13 on 2026-10-16 21:55
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def track_batteries(apps, schema_editor):
+    # Find the event at which each door's battery charge last changed (as the BatteryTracker does)
+    Door = apps.get_model('Doors', 'Door')
+    Event = apps.get_model('Doors', 'Event')
+
+    for door in Door.objects.all():
+        charge = None
+        for timestamp, value in Event.objects.filter(door=door, code="battery_state").order_by("timestamp").values_list("timestamp", "value").iterator():
+            if value != charge:
+                charge = value
+                door.battery_event_id = timestamp
+        door.save(update_fields=["battery_event"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Doors', '0013_uptimesketch'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='door',
+            name='battery_event',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='Doors.event'),
+        ),
+        migrations.RunPython(track_batteries, migrations.RunPython.noop),
+    ]
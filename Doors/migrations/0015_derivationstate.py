@@ -0,0 +1,29 @@
+# Generated by Django 4.1.13 on 2026-10-16 22:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Doors', '0014_door_battery_event'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DerivationState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('stage', models.CharField(max_length=16, verbose_name='Stage')),
+                ('through', models.BigIntegerField(null=True, verbose_name='Through')),
+                ('pending', models.BigIntegerField(null=True, verbose_name='Pending')),
+                ('door', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='derivation_states', to='Doors.door')),
+                ('visit', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='Doors.visit')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='derivationstate',
+            constraint=models.UniqueConstraint(fields=('door', 'stage'), name='unique_derivation_state'),
+        ),
+    ]
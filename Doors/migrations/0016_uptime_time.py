@@ -0,0 +1,17 @@
+# Generated by Django 4.1.13 on 2026-10-16 22:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Doors', '0015_derivationstate'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='uptime',
+            index=models.Index(fields=['date_time'], name='uptime_time'),
+        ),
+    ]
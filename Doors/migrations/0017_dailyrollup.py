@@ -0,0 +1,40 @@
+# Generated by Django 4.1.13 on 2026-10-16 22:31
+
+import datetime
+import django.core.serializers.json
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Doors', '0016_uptime_time'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(verbose_name='Date')),
+                ('openings', models.IntegerField(default=0, verbose_name='Openings')),
+                ('open_time', models.DurationField(default=datetime.timedelta, verbose_name='Time open')),
+                ('first_activity', models.DateTimeField(null=True, verbose_name='First activity')),
+                ('last_activity', models.DateTimeField(null=True, verbose_name='Last activity')),
+                ('visits', models.IntegerField(default=0, verbose_name='Visits')),
+                ('visits_opened', models.IntegerField(default=0, verbose_name='Visits opening the door')),
+                ('battery', models.CharField(max_length=64, null=True, verbose_name='Battery state')),
+                ('distributions', models.JSONField(default=dict, encoder=django.core.serializers.json.DjangoJSONEncoder, verbose_name='Distributions')),
+                ('door', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_rollups', to='Doors.door')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='dailyrollup',
+            index=models.Index(fields=['date'], name='rollup_date'),
+        ),
+        migrations.AddConstraint(
+            model_name='dailyrollup',
+            constraint=models.UniqueConstraint(fields=('door', 'date'), name='unique_daily_rollup'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.1.13 on 2026-10-16 22:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Doors', '0017_dailyrollup'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='opening',
+            index=models.Index(condition=models.Q(('visit__isnull', True)), fields=['date_time'], name='opening_unvisited'),
+        ),
+    ]
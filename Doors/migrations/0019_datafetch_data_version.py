@@ -0,0 +1,26 @@
+# Generated by Django 4.1.13 on 2026-10-16 23:07
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def version_past_fetches(apps, schema_editor):
+    # The version of the data was the ID of the last fetch that finished, so the pages and columns cached stay current
+    DataFetch = apps.get_model('Doors', 'DataFetch')
+    DataFetch.objects.filter(finished__isnull=False).update(data_version=F('id'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Doors', '0018_opening_unvisited'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='datafetch',
+            name='data_version',
+            field=models.PositiveBigIntegerField(null=True, verbose_name='Data version'),
+        ),
+        migrations.RunPython(version_past_fetches, migrations.RunPython.noop),
+    ]
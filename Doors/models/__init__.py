@@ -2,5 +2,8 @@ from .door import Door
 from .event import Event
 from .opening import Opening
 from .visit import Visit
-from .uptime import Uptime
+from .uptime import Uptime, UptimeSketch
+from .derivation import DerivationState
 from .fetch import DataFetch
+from .histogram import Histogram
+from .rollup import DailyRollup
@@ -0,0 +1,105 @@
+'''
+A vectorized engine for the battery charge time series of door sensors, for graphing.
+
+The sensors report one of three charges (see BATTERY_STATES) with almost every event, so a door's series
+is long and mostly repeats. It is loaded as NumPy arrays of times and charges (1, 2, 3 for low, middle and
+high), collapsed to its step changes (the first report of each charge, and the last report) and downsampled
+to a bounded number of points with LTTB (Largest Triangle Three Buckets). A smoothed fit and the projected
+time of replacement are computed from all the reports, and the fit is sampled at a bounded number of points.
+'''
+import numpy as np
+
+from .conf import BATTERY_HORIZON
+
+
+def steps(x, y):
+    '''
+    Returns the points of a series at which y changes (the first point of each run of equal ys) and its
+    last point, as two NumPy arrays.
+
+    :param x: a NumPy array of times in order
+    :param y: a NumPy array of the values at those times
+    '''
+    if len(x) == 0:
+        return x, y
+
+    keep = np.concatenate(([True], y[1:] != y[:-1]))
+    keep[-1] = True
+    return x[keep], y[keep]
+
+
+def lttb(x, y, points):
+    '''
+    Downsamples a series to at most points points with the Largest Triangle Three Buckets algorithm, which
+    keeps the first and last points and from each of points - 2 equal buckets of the points between, the
+    point forming the largest triangle with the point kept from the bucket before and the mean of the bucket
+    after. Returns the points kept as two NumPy arrays.
+
+    :param x: a NumPy array of times in order
+    :param y: a NumPy array of the values at those times
+    :param points: the most points to keep (at least 3)
+    '''
+    n = len(x)
+    if n <= points:
+        return x, y
+
+    # The bounds of the buckets, which cover all points but the first and last
+    bounds = np.linspace(1, n - 1, points - 1).astype(np.int64)
+
+    kept = [0]
+    for start, end, after in zip(bounds[:-1], bounds[1:], np.append(bounds[2:], n)):
+        ax, ay = x[kept[-1]], y[kept[-1]]
+        cx, cy = x[end:after].mean(), y[end:after].mean()
+        areas = np.abs((ax - cx) * (y[start:end] - ay) - (ax - x[start:end]) * (cy - ay))
+        kept.append(start + int(np.argmax(areas)))
+    kept.append(n - 1)
+
+    return x[kept], y[kept]
+
+
+def fit(x, y, degree=5):
+    '''
+    Returns a smoothed fit of a series, a NumPy Polynomial of degree (or less if there are too few points
+    for it) fitted by least squares. A series reported at one time only is fitted by its mean.
+
+    :param x: a NumPy array of times
+    :param y: a NumPy array of the values at those times
+    :param degree: the degree of the polynomial
+    '''
+    distinct = len(np.unique(x))
+
+    # No fit spans a single time (it is mapped to a domain of no width)
+    if distinct < 2:
+        return np.polynomial.Polynomial([np.mean(y)])
+
+    return np.polynomial.Polynomial.fit(x, y, min(degree, distinct - 1))
+
+
+def replacement(x, y, low=1, horizon=BATTERY_HORIZON):
+    '''
+    Returns the time at which the charge is projected to fall to low (or did, if it has), from a linear
+    fit of the reports since the last rise in charge (a new battery). None if the charge has not fallen since,
+    or is falling so slowly that it is projected to reach low more than horizon after the last report.
+
+    :param x: a NumPy array of times (in days) in order
+    :param y: a NumPy array of the charges reported at those times
+    :param low: the charge at which a battery needs replacing
+    :param horizon: the furthest past the last report (in days) that a replacement is projected
+    '''
+    rises = np.flatnonzero(y[1:] > y[:-1]) + 1
+    since = rises[-1] if len(rises) else 0
+    x, y = x[since:], y[since:]
+
+    if y[-1] <= low:
+        return x[np.argmax(y <= low)]
+
+    # With no fall in charge since, there's no fall to project
+    if not (y[1:] < y[:-1]).any():
+        return None
+
+    slope, intercept = np.polyfit(x - x[0], y, 1)
+    if not slope < 0:
+        return None
+
+    projected = x[0] + (low - intercept) / slope
+    return projected if projected <= x[-1] + horizon else None
@@ -0,0 +1,307 @@
+'''
+A columnar cache of Events, Openings and Visits, for analytics that need only a few columns of them.
+
+Each table is cached as one file of fixed width values per column (see TABLES), its rows in time order,
+so a column is a NumPy array on disk. The cache is written after every fetch of the logs and is versioned
+by the version of the data (see DataFetch.version), in a directory per version. The current version is
+named in a file (replaced atomically) and a reader only uses the cache if it is current, else reads the
+database. Readers memory map the columns read only, so that the uWSGI workers share one copy of them in
+the OS page cache, and analytics run as NumPy array operations over them.
+
+A refresh is incremental: a fetch only adds or changes rows from the day before its first event on (see
+DailyRollup.touched), so the rows before that are copied from the last version and only the rows after
+are read from the database and appended. A table whose cached row count then differs from the database
+(changed by other means) is written afresh. Versions are never changed once written, so a worker can go
+on reading one it has mapped, even once it has been superseded and removed.
+'''
+import os, json, shutil, numpy as np
+
+from datetime import datetime, time, timedelta
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Min
+
+from .conf import CODES, BATTERY_STATES, UPTIME_CODE
+from .event import Event
+from .opening import Opening
+from .visit import Visit
+
+# The columns cached of each table, and their types
+TABLES = {"events": {"timestamp": np.int64,  # Tuya timestamp (ms)
+                     "door": np.int64,  # Door ID
+                     "code": np.int8,  # index in CODES (-1 for any other)
+                     "state": np.int8},  # 1/0 for Open/Closed and online/offline, 1, 2, 3 for a low, middle, high battery (-1 for any other)
+          "openings": {"start": "datetime64[us]",
+                       "duration": "timedelta64[us]",
+                       "door": np.int64},
+          "visits": {"start": "datetime64[us]",
+                     "duration": "timedelta64[us]",
+                     "prior_quiet": "timedelta64[us]"}}
+
+# The states of events by code (see the events state column)
+STATES = {"doorcontact_state": {"Open": 1, "Closed": 0},
+          "battery_state": {state: 1 + i for i, state in enumerate(BATTERY_STATES)},
+          UPTIME_CODE: {"online": 1, "offline": 0}}
+
+# The column of each table its rows are in order of (the tail of a table is refreshed from a time on)
+TIME_COLUMNS = {"events": "timestamp", "openings": "start", "visits": "start"}
+
+# The memory mapped version last opened (by this process)
+_opened = None
+
+
+def cache_dir():
+    return getattr(settings, "COLUMN_CACHE", None)
+
+
+def rows(table, since=None):
+    '''
+    Returns the columns of the rows of table (from the time since on, if given) as a dict of NumPy
+    arrays keyed on column, read from the database in one query.
+
+    :param table: a key of TABLES
+    :param since: a datetime
+    '''
+    columns = TABLES[table]
+
+    if table == "events":
+        events = Event.objects.all() if since is None else Event.objects.filter(timestamp__gte=time_value(table, since))
+        data = list(events.order_by("timestamp").values_list("timestamp", "door_id", "code", "type", "value"))
+        codes = {code: i for i, code in enumerate(CODES)}
+        arrays = {"timestamp": np.fromiter((e[0] for e in data), dtype=columns["timestamp"], count=len(data)),
+                  "door": np.fromiter((e[1] for e in data), dtype=columns["door"], count=len(data)),
+                  "code": np.fromiter((codes.get(e[2], -1) for e in data), dtype=columns["code"], count=len(data)),
+                  # Uptime events carry their state in the type (see Doors.models.uptime)
+                  "state": np.fromiter((STATES.get(e[2], {}).get(e[3] if e[2] == UPTIME_CODE else e[4], -1) for e in data), dtype=columns["state"], count=len(data))}
+    else:
+        model, fields = (Opening, ("date_time", "duration", "door_id")) if table == "openings" else (Visit, ("date_time", "duration", "prior_quiet"))
+        objects = model.objects.all() if since is None else model.objects.filter(date_time__gte=since)
+        data = list(objects.order_by("date_time", "id").values_list(*fields))
+        arrays = {column: np.array([row[i] for row in data], dtype=dtype) for i, (column, dtype) in enumerate(columns.items())}
+
+    return arrays
+
+
+def time_value(table, date_time):
+    # A time as it is held in the time column of table
+    if table == "events":
+        return np.int64(Event.timestamp_from_datetime(date_time))
+    return np.datetime64(date_time, "us")
+
+
+def column_path(directory, table, column):
+    return os.path.join(directory, f"{table}.{column}")
+
+
+def current_version(directory):
+    '''
+    Returns the version of the cache that is current in directory (None if there is none).
+    '''
+    try:
+        with open(os.path.join(directory, "current")) as f:
+            return int(f.read())
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def manifest_path(directory, version):
+    return os.path.join(directory, str(version), "manifest.json")
+
+
+def manifest(directory, version):
+    with open(manifest_path(directory, version)) as f:
+        return json.load(f)
+
+
+def schema():
+    # The database and the columns of each table and their types, as recorded in a manifest (a cache of another
+    # database or other columns is not read)
+    return {"database": connection.settings_dict["NAME"],
+            "columns": {table: {column: np.dtype(dtype).str for column, dtype in columns.items()} for table, columns in TABLES.items()}}
+
+
+def refresh(version, rebuild=False, verbosity=0):
+    '''
+    Writes version of the cache, incrementally from the current version if there is one (see Doors.models.columns),
+    and makes it current. Returns a dict keyed on table of the rows copied from the last version (the rest
+    being read from the database).
+
+    :param version: the version written (a DataFetch.version)
+    :param rebuild: write every table afresh from the database
+    :param verbosity: Django manage.py argument for Verbosity level; 0=minimal output, 1=normal output, 2=verbose output, 3=very verbose output
+    '''
+    global _opened
+
+    directory = cache_dir()
+    if directory is None:
+        return {}
+
+    last = current_version(directory)
+
+    # A version written again is written afresh (it can't be copied from itself)
+    old = None if last is None or last == version or rebuild else os.path.join(directory, str(last))
+    if old is not None and (not os.path.exists(manifest_path(directory, last)) or manifest(directory, last)["schema"] != schema()):
+        old = None
+    if old is not None:
+        # The rows the fetches that finished since the last version could have changed are those from the day
+        # before their first event on (and with no events since, none). A fetch has a new version every time
+        # it finishes, so the events a resumed fetch saved are among them, if saved under an older version.
+        first = Event.objects.filter(data_fetch__data_version__gt=last).aggregate(first=Min("timestamp"))["first"]
+        since = None if first is None else datetime.combine(Event.datetime_from_timestamp(first).date() - timedelta(days=1), time())
+
+    target = os.path.join(directory, str(version))
+    shutil.rmtree(target, ignore_errors=True)
+    os.makedirs(target)
+
+    counts = {"events": Event.objects.count(), "openings": Opening.objects.count(), "visits": Visit.objects.count()}
+    kept, written = {}, {}
+    for table, columns in TABLES.items():
+        if old is not None:
+            # Copy the rows before since from the last version, and read those after from the database
+            old_rows = manifest(directory, last)["rows"][table]
+            if since is None:
+                kept[table] = old_rows
+                arrays = {column: np.empty(0, dtype=dtype) for column, dtype in columns.items()}
+            else:
+                times = read(old, table, TIME_COLUMNS[table], columns[TIME_COLUMNS[table]], old_rows)
+                kept[table] = int(np.searchsorted(times, time_value(table, since), side="left"))
+                arrays = rows(table, since)
+
+            for column, dtype in columns.items():
+                shutil.copyfile(column_path(old, table, column), column_path(target, table, column))
+                os.truncate(column_path(target, table, column), kept[table] * np.dtype(dtype).itemsize)
+
+            if kept[table] + len(arrays[TIME_COLUMNS[table]]) != counts[table]:
+                # Rows were added or removed before since (not by a fetch), so write the table afresh
+                kept[table] = 0
+                arrays = rows(table)
+        else:
+            kept[table] = 0
+            arrays = rows(table)
+
+        for column, dtype in columns.items():
+            with open(column_path(target, table, column), "ab" if kept[table] else "wb") as f:
+                arrays[column].astype(dtype).tofile(f)
+        written[table] = kept[table] + len(arrays[TIME_COLUMNS[table]])
+
+        if verbosity >= 2:
+            print(f"\tCached {written[table]} {table}, {kept[table]} of them from version {last}.")
+
+    with open(os.path.join(target, "manifest.json"), "w") as f:
+        json.dump({"version": version, "rows": written, "schema": schema()}, f)
+
+    # Make it current (atomically) and remove the versions it supersedes
+    with open(os.path.join(directory, "current.new"), "w") as f:
+        f.write(str(version))
+    os.replace(os.path.join(directory, "current.new"), os.path.join(directory, "current"))
+
+    for name in os.listdir(directory):
+        if name.isdigit() and int(name) != version:
+            shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+
+    # A version rewritten (rebuilt) is reopened
+    _opened = None
+
+    if verbosity >= 1:
+        print(f"Cached version {version} of {', '.join(f'{n} {t}' for t, n in written.items())}.")
+
+    return kept
+
+
+def read(directory, table, column, dtype, count):
+    '''
+    Returns a column of count rows memory mapped read only (an empty array if there are none).
+    '''
+    if count == 0:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(column_path(directory, table, column), dtype=dtype, mode="r", shape=(count,))
+
+
+def current():
+    '''
+    Returns the current version of the cache, memory mapped, as a dict keyed on table of dicts of NumPy
+    arrays keyed on column. None if the cache is not configured or is not of the current version of the
+    data (DataFetch.version), when the data must be read from the database.
+    '''
+    global _opened
+
+    directory = cache_dir()
+    if directory is None:
+        return None
+
+    # No cache, no need to ask the database for the version of the data
+    version = current_version(directory)
+    if version is None:
+        return None
+
+    from .fetch import DataFetch
+    if DataFetch.version() != version:
+        return None
+
+    try:
+        # A version is only rewritten if rebuilt (see update_columns), and is then reopened
+        written = os.stat(manifest_path(directory, version)).st_mtime_ns
+        if _opened is not None and _opened[0] == (directory, version, written):
+            return _opened[1]
+
+        recorded = manifest(directory, version)
+        if recorded["schema"] != schema():
+            return None
+
+        target = os.path.join(directory, str(version))
+        tables = {table: {column: read(target, table, column, dtype, recorded["rows"][table]) for column, dtype in columns.items()} for table, columns in TABLES.items()}
+    except (FileNotFoundError, KeyError, ValueError):
+        # Superseded and removed while being opened
+        return None
+
+    _opened = ((directory, version, written), tables)
+    return tables
+
+
+def per_day(starts):
+    '''
+    Returns a histogram of the number of visits per day (as Visit.histogram("per_days")) from their start times.
+    '''
+    days, counts = np.unique(starts.astype("datetime64[D]"), return_counts=True)
+    return {int(n): int(c) for n, c in zip(*np.unique(counts, return_counts=True))}
+
+
+def hour_of_day(starts):
+    '''
+    Returns a histogram of the hour of the day visits started in (as Visit.histogram("day")) from their start times.
+    '''
+    hours = np.bincount((starts - starts.astype("datetime64[D]")).astype("timedelta64[h]").astype(np.int64), minlength=25)
+    return {f"{h}-{h+1 if h < 24 else 1}": int(hours[h]) for h in range(25)}
+
+
+def durations(values, categories):
+    '''
+    Returns a histogram of durations in categories of a given width (as Visit.histogram("durations", categories)
+    and Opening.histogram do) from an array of durations.
+
+    :param values: a NumPy array of durations (timedelta64)
+    :param categories: the width of the categories (a timedelta)
+    '''
+    from .rollup import duration_label
+
+    # Rounded half to even, as the database rounds them (see DurationBucket)
+    buckets = np.rint(values / np.timedelta64(categories)).astype(np.int64)
+    return {duration_label(categories, int(b)): int(c) for b, c in zip(*np.unique(buckets, return_counts=True))}
+
+
+def quiet_times(values, categories):
+    '''
+    Returns a histogram of the quiet times before visits in categories of a given width (as Visit.histogram("quiet_times",
+    categories) does) from an array of them. Those over a day are ignored, and empty categories below the longest included.
+
+    :param values: a NumPy array of quiet times (timedelta64)
+    :param categories: the width of the categories (a timedelta)
+    '''
+    from .rollup import quiet_label
+
+    buckets = np.rint(values[values <= np.timedelta64(timedelta(days=1))] / np.timedelta64(categories)).astype(np.int64)
+
+    # Negative quiet times (naive local times run backwards when daylight saving ends) are below the first category
+    counts = np.bincount(buckets[buckets >= 0])
+    return {quiet_label(categories, b): int(c) for b, c in enumerate(counts)}
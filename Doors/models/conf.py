@@ -34,6 +34,15 @@ DOOR_STATES = { "true": "Open",  # Moves the state from closed to open
 # The sensor only reports three battery states (alas).
 BATTERY_STATES = ["low", "middle", "high"]
 
+# The most points in a battery charge graph (the series are downsampled to it, however long
+# the history, see Doors.models.battery).
+BATTERY_POINTS = 200
+
+# The furthest ahead (in days past the last report) a battery's replacement is projected. A battery that
+# reported one charge for long and has only just fallen to the next projects a slope near zero, and a
+# replacement centuries away (or beyond the dates Python can represent), which is no projection at all.
+BATTERY_HORIZON = 3 * 365
+
 # And Event Type to code map
 # Tuya only provide codes for "data report" events. But we give other event
 # types a code as well, as we store it in a database column anyhow, to group
@@ -46,3 +55,37 @@ EVENT_CODES = {"online": UPTIME_CODE,
 # Defines the gap between openings that separates visits.
 # A gap this long or greater is classified a new visit.
 VISIT_SEPARATION = 10  # Minutes
+
+# The number of rows written per INSERT when saving events, openings, uptimes
+# and visits in bulk. Keeps statements a sensible size on large backfills.
+BULK_BATCH_SIZE = 1000
+
+# Tuya's servers return at most 100 log entries per query, and we page through
+# the logs one query (one API call) at a time.
+TUYA_PAGE_SIZE = 100
+
+# Doors are fetched concurrently by this many worker threads. Calls to Tuya are
+# made one at a time, at most TUYA_CALLS_PER_SECOND of them, and at most
+# TUYA_CALLS_PER_FETCH in one fetch, keeping us well inside the Tuya quota
+# (about 1700 calls a day, see the fetch_logs management command).
+FETCH_WORKERS = 4
+TUYA_CALLS_PER_SECOND = 5
+TUYA_CALLS_PER_FETCH = 1500
+
+# The pairing state of an event, maintained as Openings and Uptimes are derived from
+# events. An event opens or closes a pair (an Opening or Uptime), is an orphan (is in
+# no pair and never will be) or is pending (in no pair yet, as it follows the last pair
+# on its door and may pair with events still to come, or was never paired at all).
+PAIRING_PENDING = "pending"
+PAIRED_OPEN = "open"
+PAIRED_CLOSE = "close"
+PAIRING_ORPHAN = "orphan"
+
+PAIRING_STATES = {PAIRING_PENDING: "Pending",
+                  PAIRED_OPEN: "Opens a pair",
+                  PAIRED_CLOSE: "Closes a pair",
+                  PAIRING_ORPHAN: "Orphan"}
+
+# The relative accuracy of the quantiles of the uptime sketches (log bucketed counts of uptime
+# durations, see Doors.models.sketch). 0.01 puts any quantile within 1% of the true value.
+SKETCH_ACCURACY = 0.01
@@ -0,0 +1,57 @@
+from django.db import models
+
+
+class DerivationState(models.Model):
+    '''
+    How far a stage deriving data from events (see Doors.models.pipeline) or openings (Visits) has got,
+    so that an update resumes where the last one stopped, touching only new events, with no need to look
+    back through what was derived to find where that was.
+
+    Keyed on door and stage. Visits span doors, so their state has no door.
+    '''
+    door = models.ForeignKey('Door', related_name='derivation_states', null=True, on_delete=models.CASCADE)
+    stage = models.CharField('Stage', max_length=16)
+
+    # The timestamp of the last event processed (for Visits, of the opening event of the last opening)
+    through = models.BigIntegerField('Through', null=True)
+
+    # The timestamp of the event opening a pair (an Open or online event) not yet closed
+    pending = models.BigIntegerField('Pending', null=True)
+
+    # The last visit, which is provisional as the next openings may extend it
+    visit = models.ForeignKey('Visit', related_name='+', null=True, on_delete=models.SET_NULL)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['door', 'stage'], name='unique_derivation_state')]
+
+    @classmethod
+    def of(cls, door, stage):
+        '''
+        Returns the recorded state of stage on door (None if there is none).
+
+        :param door: An instance of Door (or None for stages that span doors)
+        :param stage: the name of the stage
+        '''
+        return cls.objects.filter(door=door, stage=stage).first()
+
+    @classmethod
+    def record(cls, door, stage, **state):
+        '''
+        Records the state of stage on door.
+
+        :param door: An instance of Door (or None for stages that span doors)
+        :param stage: the name of the stage
+        :param state: the fields of the state to record
+        '''
+        updated = cls.objects.filter(door=door, stage=stage).update(**state)
+        if not updated:
+            cls.objects.create(door=door, stage=stage, **state)
+
+    @classmethod
+    def forget(cls, door, stage):
+        '''
+        Forgets the state of stage on door, so that the next update finds where to resume from what
+        was derived (as it does on the first update). For use when the derived data is changed other
+        than by the stage.
+        '''
+        cls.objects.filter(door=door, stage=stage).delete()
@@ -9,10 +9,18 @@ class Door(models.Model):
     tuya_device_id = models.CharField('Tuya Device ID', max_length=64)
     contents = models.CharField('Description of contents', max_length=256)
 
+    # The battery_state event at which the battery charge of the door's sensor last changed (maintained by
+    # the BatteryTracker in Doors.models.pipeline), its value being the current charge.
+    battery_event = models.ForeignKey('Event', related_name='+', null=True, on_delete=models.SET_NULL)
+
     # Related foreign keys
     # openings = OneToManyField(Opening, related_name='door') # Implicit by ForeignKey in Opening
     # events = OneToManyField(Event, related_name='door') # Implicit by ForeignKey in Event
 
+    @property
+    def battery(self):
+        return self.battery_event.value if self.battery_event else None
+
     @classproperty
     def ids(cls):
         return sorted([door.id for door in Door.objects.all()])
@@ -1,16 +1,43 @@
-import humanize
+import humanize, numpy as np
 
 from django_rich_views.model import field_render, link_target_url, RichMixIn
 
 from django.utils.functional import classproperty, cached_property
 from django.urls import reverse
 from django.apps import apps
-from django.db.models import Count
-from django.db import models
+from django.db.models import Count, Exists, OuterRef, F, Q, Window, Case, When, Value
+from django.db.models.functions import Lag, Lead
+from django.db import models, transaction, connection
 
-from datetime import datetime
+from collections import namedtuple
+from datetime import datetime, timedelta
 
-from .conf import EVENT_IDS, EVENT_CODES, DOOR_STATES, BATTERY_STATES
+from .conf import CODES, EVENT_IDS, EVENT_CODES, DOOR_STATES, BATTERY_STATES, BATTERY_POINTS, BULK_BATCH_SIZE, UPTIME_CODE
+from .conf import PAIRING_STATES, PAIRING_PENDING, PAIRED_OPEN, PAIRED_CLOSE, PAIRING_ORPHAN
+from .pairing import runs
+from .battery import steps, lttb, fit, replacement
+
+from Site.logutils import log
+
+
+class Orphan(namedtuple("Orphan", ["timestamp", "door_id", "value", "before", "after"])):
+    '''
+    A compact record of an orphaned door contact event (one in no Opening) with the values of the
+    two door contact events before it and after it on the same door (None where there are none).
+    '''
+
+    @property
+    def date_time(self):
+        return Event.datetime_from_timestamp(self.timestamp)
+
+    @property
+    def valid(self):
+        '''
+        An orphan is valid if its neighbours have the same value (Open, Open or Closed, Closed) as that
+        is precisely when an event is found unmatched and orphaned. The first and last events (which
+        lack a neighbour) are not.
+        '''
+        return bool(self.before[1] and self.after[0] and self.before[1] == self.after[0])
 
 
 class Event(models.Model, RichMixIn):
@@ -40,11 +67,28 @@ class Event(models.Model, RichMixIn):
     door = models.ForeignKey('Door', related_name='events', on_delete=models.PROTECT)
     data_fetch = models.ForeignKey('DataFetch', related_name='events', null=True, on_delete=models.PROTECT)
 
+    # Whether the event opens or closes an Opening or Uptime, is an orphan, or is pending. Maintained as
+    # Openings and Uptimes are derived from events (see update_pairing) so unpaired events are found with
+    # an indexed filter, not an anti-join.
+    pairing = models.CharField('Pairing state', max_length=8, choices=PAIRING_STATES.items(), default=PAIRING_PENDING)
+
+    class Meta:
+        # The hot access paths are events of a door with a code in time order (covering the value, so
+        # pairing events is an index only scan) and unpaired events of a code (see Doors.models.plans).
+        indexes = [models.Index(fields=['door', 'code', 'timestamp'], include=['value'], name='event_door_code_time'),
+                   models.Index(fields=['code', 'pairing'], name='event_pairing')]
+
     # openings = OneToManyField(Opening, related_name='open_event') # Implicit by ForeignKey in Opening
     # closings = OneToManyField(Opening, related_name='close_event') # Implicit by ForeignKey in Opening
     # went_up = OneToManyField(Event, related_name='online_event') # Implicit by ForeignKey in Event
     # went_down = OneToManyField(Event, related_name='offline_event') # Implicit by ForeignKey in Event
 
+    # The relations rendered when events are listed (fetched with the list, see Doors.views.generic.with_related)
+    list_prefetch_related = ("openings", "closings", "went_up", "went_down")
+
+    # The keys events are listed and browsed in order of (see Doors.views.keyset), unique as the primary key
+    ordering_keys = ("timestamp",)
+
     @property
     def date_time(self):
         return Event.datetime_from_timestamp(self.timestamp)
@@ -53,15 +97,13 @@ class Event(models.Model, RichMixIn):
     def ignored(self):
         '''
         It can happen that events don't form enat Open/Closed pairs. Superfluous events are ignored.
-        That is, they ar enot ever mentioned in an opening or closing.
+        That is, they ar enot ever mentioned in an opening or closing (or uptime).
         '''
-        # TODO: test
-        return (len(self.openings.all()) + len(self.closings.all())) == 0
+        return self.pairing in (PAIRING_ORPHAN, PAIRING_PENDING)
 
     @classproperty
     def Ignored(cls):
-        # TODO: test
-        return cls.objects.filter(openings=None, closings=None)
+        return cls.objects.filter(pairing__in=(PAIRING_ORPHAN, PAIRING_PENDING))
 
     @classmethod
     def first(cls, code=None, door=None):
@@ -72,35 +114,32 @@ class Event(models.Model, RichMixIn):
         :param code: An Event code
         '''
         result = cls.objects.all()
-        if result:
-            if not door is None:
-                result = result.filter(door=door)
-            if not code is None:
-                result = result.filter(code=code)
-            result = result.order_by("timestamp")[0]
+        if not door is None:
+            result = result.filter(door=door)
+        if not code is None:
+            result = result.filter(code=code)
 
-        return result
+        # One indexed query (there is no need to check for events first, first() returns None if there are none)
+        return result.order_by("timestamp").first()
 
     @classmethod
     def last(cls, code=None, door=None):
         '''
         Return the last event recorded for this door (or all doors)
 
-        On the very first run there are no events for the door so we catch the exception on trying to
-        return the fist and return None.
+        On the very first run there are no events for the door and we return None.
 
         :param door: And instance of Door
         :param code: An Event code
         '''
         result = cls.objects.all()
-        if result:
-            if not door is None:
-                result = result.filter(door=door)
-            if not code is None:
-                result = result.filter(code=code)
-            result = result.order_by("-timestamp")[0]
+        if not door is None:
+            result = result.filter(door=door)
+        if not code is None:
+            result = result.filter(code=code)
 
-        return result
+        # One indexed query (there is no need to check for events first, first() returns None if there are none)
+        return result.order_by("-timestamp").first()
 
     @classmethod
     def datetime_from_timestamp(cls, tuya_timestamp):
@@ -129,13 +168,43 @@ class Event(models.Model, RichMixIn):
         return DOOR_STATES[contact_state] if contact_state in DOOR_STATES else contact_state
 
     @classmethod
-    def save_logs(cls, door, log, fetch=None, verbosity=0):
+    def parse_log_event(cls, event):
+        '''
+        Translates one row of a Tuya log into the values we store on an Event.
+
+        Returns a dict of Event field values (without door or data_fetch) and a flag
+        saying whether it's an event we keep (we only keep the codes we support).
+
+        :param event: a single entry from the logs list returned by tinytuya.Cloud.getdevicelog
+        '''
+        event_type = cls.type_from_int(event.get("event_id", None))
+        event_code = event.get('code', None)
+        event_timestamp = int(event['event_time'])
+        event_from = cls.source_from_int(int(event.get("event_from", None)))
+        event_value = cls.door_state_from_contact_state(event.get("value", ""))
+
+        # Where Tuya do not provide codes, we store an informative one for our use.
+        if not event_code:
+            if event_type in EVENT_CODES:
+                event_code = EVENT_CODES[event_type]
+
+        keep = event_code in ("doorcontact_state", "battery_state") or event_type in ("online", "offline")
+
+        return {'timestamp': event_timestamp,
+                'source': event_from,
+                'code': event_code,
+                'type': event_type,
+                'value': event_value}, keep
+
+    @classmethod
+    def save_logs(cls, door, log, fetch=None, bulk=False, verbosity=0):
         '''
         Given Tuya logs for a given door, will save the to the Events table
 
         :param door: a Door object
         :param log: a log as returned by tinytuya.Cloud.getdevicelog
         :param fetch: a DataFetch object that logs this fetch (created if not provided)
+        :param bulk: if True, check for existing events with one query and insert new ones in batches (see save_logs_bulk)
         :param verbosity: Django manage.py argument for Verbosity level; 0=minimal output, 1=normal output, 2=verbose output, 3=very verbose output
         '''
         if fetch is None:
@@ -144,8 +213,6 @@ class Event(models.Model, RichMixIn):
             fetch = DataFetch(date_time=datetime.now())
             fetch.save()
 
-        added = 0
-        code_counts = {}
         events = log['result']['logs']
 
         if verbosity >= 2:
@@ -156,44 +223,57 @@ class Event(models.Model, RichMixIn):
             else:
                 print(f"Downloaded NO events.")
 
+        if bulk:
+            added, code_counts = cls.save_logs_bulk(door, events, fetch, verbosity=verbosity)
+        else:
+            added, code_counts = cls.save_logs_each(door, events, fetch, verbosity=verbosity)
+
+        if verbosity >= 1:
+            print(f"Door {door.id}: Fetched {len(events)} events, saved {added} events, {len(events)-added} events were already in the database.")
+            for code in code_counts:
+                print(f"\t{code_counts[code]} events with code '{code}' were downloaded.")
+
+        return added
+
+    @classmethod
+    def save_logs_each(cls, door, events, fetch, verbosity=0):
+        '''
+        Saves downloaded events one at a time, checking first if each one is already in the database.
+
+        Two queries per event, which is fine for a daily fetch but slow on a large backfill.
+
+        Returns the number of events added and a dict of counts of downloaded events keyed on code.
+
+        :param door: a Door object
+        :param events: the list of logs in a log returned by tinytuya.Cloud.getdevicelog
+        :param fetch: a DataFetch object that logs this fetch
+        :param verbosity: Django manage.py argument for Verbosity level; 0=minimal output, 1=normal output, 2=verbose output, 3=very verbose output
+        '''
+        added = 0
+        code_counts = {}
+
         for i, event in enumerate(events):
-            event_type = cls.type_from_int(event.get("event_id", None))
-            event_code = event.get('code', None)
-            event_value = event.get("value", None)
-            event_timestamp = int(event['event_time'])
-            event_date_time = cls.door_state_from_contact_state(event_timestamp)
-            event_from = cls.source_from_int(int(event.get("event_from", None)))
-            event_value = cls.door_state_from_contact_state(event.get("value", ""))
-
-            # Where Tuya do not provide codes, we store an informative one for our use.
-            if not event_code:
-                if event_type in EVENT_CODES:
-                    event_code = EVENT_CODES[event_type]
+            fields, keep = cls.parse_log_event(event)
+            event_code = fields['code']
 
             if not event_code in code_counts:
                 code_counts[event_code] = 0
             code_counts[event_code] += 1
 
             if verbosity >= 2:
-                print(f"\t{i} of {len(events)}, {event_date_time}: {event_code}={event_value}")
+                print(f"\t{i} of {len(events)}, {fields['timestamp']}: {event_code}={fields['value']}")
 
-            if event_code in ("doorcontact_state", "battery_state") or event_type in ("online", "offline"):
+            if keep:
                 try:
-                    if not Event.objects.filter(timestamp=event_timestamp, door=door).exists():
-                        event = Event(timestamp=event_timestamp,
-                                      source=event_from,
-                                      code=event_code,
-                                      type=event_type,
-                                      value=event_value,
-                                      door=door,
-                                      data_fetch=fetch)
+                    if not Event.objects.filter(timestamp=fields['timestamp'], door=door).exists():
+                        event = Event(door=door, data_fetch=fetch, **fields)
 
                         event.save()
 
                         if verbosity >= 3:
                             print(f"\t\tSaved")
 
-                        assert event.date_time == cls.datetime_from_timestamp(event_date_time), "Oops, timestamp issue"
+                        assert event.date_time == cls.datetime_from_timestamp(fields['timestamp']), "Oops, timestamp issue"
 
                         added += 1
                     else:
@@ -203,76 +283,299 @@ class Event(models.Model, RichMixIn):
                     if verbosity >= 3:
                         print(f"\t\tEvent creation failed with: {E}.")
 
-        if verbosity >= 1:
-            print(f"Door {door.id}: Fetched {len(events)} events, saved {added} events, {len(events)-added} events were already in the database.")
-            for code in code_counts:
-                print(f"\t{code_counts[code]} events with code '{code}' were downloaded.")
+        return added, code_counts
+
+    @classmethod
+    def save_logs_bulk(cls, door, events, fetch, batch_size=BULK_BATCH_SIZE, verbosity=0):
+        '''
+        Saves downloaded events in bulk.
+
+        The timestamps already recorded for this door in the time window the events span are loaded
+        with one query, and the new events are inserted in batches in one transaction. The timestamp
+        is the primary key and so conflicts (events that snuck in meanwhile) are simply ignored.
+
+        Returns the number of events added and a dict of counts of downloaded events keyed on code.
+
+        :param door: a Door object
+        :param events: the list of logs in a log returned by tinytuya.Cloud.getdevicelog
+        :param fetch: a DataFetch object that logs this fetch
+        :param batch_size: the number of events to insert per query
+        :param verbosity: Django manage.py argument for Verbosity level; 0=minimal output, 1=normal output, 2=verbose output, 3=very verbose output
+        '''
+        code_counts = {}
+        candidates = {}  # Keyed on timestamp, which also drops duplicates in the log itself
+
+        for i, event in enumerate(events):
+            fields, keep = cls.parse_log_event(event)
+            event_code = fields['code']
+
+            if not event_code in code_counts:
+                code_counts[event_code] = 0
+            code_counts[event_code] += 1
+
+            if verbosity >= 2:
+                print(f"\t{i} of {len(events)}, {fields['timestamp']}: {event_code}={fields['value']}")
+
+            if keep:
+                candidates[fields['timestamp']] = fields
+
+        if candidates:
+            existing = set(cls.objects.filter(door=door,
+                                              timestamp__gte=min(candidates),
+                                              timestamp__lte=max(candidates)).values_list('timestamp', flat=True))
+        else:
+            existing = set()
+
+        new_events = [cls(door=door, data_fetch=fetch, **fields) for timestamp, fields in candidates.items() if not timestamp in existing]
+
+        with transaction.atomic():
+            cls.objects.bulk_create(new_events, batch_size=batch_size, ignore_conflicts=True)
+
+        # Conflicts are ignored silently, so count the events that were actually saved (those on another
+        # door with the same timestamp, or that snuck in meanwhile, were not)
+        if new_events:
+            saved = set(cls.objects.filter(door=door,
+                                           data_fetch=fetch,
+                                           timestamp__gte=min(candidates),
+                                           timestamp__lte=max(candidates)).values_list('timestamp', flat=True))
+            collisions = [event for event in new_events if not event.timestamp in saved]
+        else:
+            collisions = []
+
+        for event in collisions:
+            log.warning(f"Event on door {door.id} at {event.timestamp} ({event.code}={event.value}) was not saved, its timestamp is already recorded.")
+
+        added = len(new_events) - len(collisions)
+
+        if verbosity >= 3:
+            print(f"\t\tSaved {added} events, {len(existing)} were already in database, {len(collisions)} collided with another event.")
+
+        return added, code_counts
 
     @classproperty
     def orphans(cls):
-        return cls.objects.filter(openings__isnull=True, closings__isnull=True, code='doorcontact_state')
+        return cls.objects.filter(code='doorcontact_state', pairing__in=(PAIRING_ORPHAN, PAIRING_PENDING))
+
+    @classmethod
+    def pair_models(cls):
+        '''
+        Returns a dict keyed on event code, of the (model, open field, close field) 3-tuple that pairs
+        events with that code, for the codes that are paired.
+        '''
+        APP = __package__.split('.')[0]
+        Opening = apps.get_model(APP, "Opening")
+        Uptime = apps.get_model(APP, "Uptime")
+        return {'doorcontact_state': (Opening, 'open_event', 'close_event'),
+                UPTIME_CODE: (Uptime, 'online_event', 'offline_event')}
+
+    @classmethod
+    def pairing_state(cls, door, code):
+        '''
+        Returns an expression for the pairing state of events of door with code, as found in the pairs
+        (Openings or Uptimes) recorded. Unpaired events after the last pair on the door are pending, as
+        the next update pairs from there, and those before it are orphans.
+
+        :param door: An instance of Door
+        :param code: An Event code
+        '''
+        pairs = cls.pair_models().get(code, None)
+        if pairs is None:
+            return Value(PAIRING_PENDING)
+
+        model, opened, closed = pairs
+        last_close = model.objects.filter(door=door).order_by(f"-{closed}_id").values_list(f"{closed}_id", flat=True).first()
+
+        states = [When(Exists(model.objects.filter(**{opened: OuterRef('pk')})), then=Value(PAIRED_OPEN)),
+                  When(Exists(model.objects.filter(**{closed: OuterRef('pk')})), then=Value(PAIRED_CLOSE))]
+
+        # With no pairs on record, every event is pending
+        if last_close is None:
+            return Case(*states, default=Value(PAIRING_PENDING))
+
+        states.append(When(timestamp__gt=last_close, then=Value(PAIRING_PENDING)))
+        return Case(*states, default=Value(PAIRING_ORPHAN))
+
+    @classmethod
+    def update_pairing(cls, door, code, events=None):
+        '''
+        Updates the pairing state of events of door with code, in one query. Called by the stages that
+        derive pairs from events (Opening.update_from_events and Uptime.update_from_events) for the events
+        they processed.
+
+        Returns the number of events updated.
+
+        :param door: An instance of Door
+        :param code: An Event code
+        :param events: A QuerySet of the events to update (default, all events of door with code)
+        '''
+        if events is None:
+            events = cls.objects.filter(door=door, code=code)
+        return events.update(pairing=cls.pairing_state(door, code))
+
+    @classmethod
+    def pairing_drift(cls, fix=False):
+        '''
+        Recomputes the pairing state of every event from scratch and returns a dict keyed on (code,
+        recorded state, correct state) 3-tuples of counts of events whose recorded state is wrong.
+
+        :param fix: correct the recorded states of events that drifted
+        '''
+        APP = __package__.split('.')[0]
+        Door = apps.get_model(APP, "Door")
+
+        drift = {}
+        for door in Door.objects.all():
+            for code in cls.objects.filter(door=door).values_list('code', flat=True).distinct():
+                correct = cls.pairing_state(door, code)
+                drifted = (cls.objects.filter(door=door, code=code)
+                                      .annotate(correct=correct)
+                                      .exclude(pairing=F('correct'))
+                                      .values_list('pairing', 'correct')
+                                      .annotate(count=Count('timestamp'))
+                                      .order_by())
+
+                for recorded, should_be, count in drifted:
+                    key = (code, recorded, should_be)
+                    drift[key] = drift.get(key, 0) + count
+
+                if fix and drifted:
+                    cls.update_pairing(door, code)
+
+        return drift
+
+    @classmethod
+    def orphan_analysis(cls, door=None):
+        '''
+        Returns a list of Orphan records, one for each orphaned door contact event, in order of door
+        and time, in one query.
+
+        The neighbours are found with LAG and LEAD window functions over the door contact events
+        partitioned by door. A query's WHERE clause filters rows before its windows are computed, so
+        the orphans (found by their pairing state) are selected from it in an enclosing query.
+
+        :param door: a Door to analyse, or None for all doors
+        '''
+        events = cls.objects.filter(code='doorcontact_state')
+        if not door is None:
+            events = events.filter(door=door)
+
+        window = {'partition_by': [F('door_id')], 'order_by': F('timestamp').asc()}
+        neighbours = events.annotate(before2=Window(Lag('value', 2), **window),
+                                     before1=Window(Lag('value', 1), **window),
+                                     after1=Window(Lead('value', 1), **window),
+                                     after2=Window(Lead('value', 2), **window))
+        neighbours = neighbours.values_list('timestamp', 'door_id', 'value', 'before2', 'before1', 'after1', 'after2', 'pairing')
+
+        sql, params = neighbours.query.sql_with_params()
+        q = connection.ops.quote_name
+        columns = ", ".join(q(c) for c in ('timestamp', 'door_id', 'value', 'before2', 'before1', 'after1', 'after2'))
+        orphans_sql = f"SELECT {columns} FROM ({sql}) neighbours WHERE {q('pairing')} IN (%s, %s) ORDER BY {q('door_id')}, {q('timestamp')}"
+
+        with connection.cursor() as cursor:
+            cursor.execute(orphans_sql, params + (PAIRING_ORPHAN, PAIRING_PENDING))
+            return [Orphan(timestamp, door_id, value, (before2, before1), (after1, after2))
+                    for timestamp, door_id, value, before2, before1, after1, after2 in cursor.fetchall()]
 
     @classmethod
     def invalid_orphans(cls):
-        invalid_orphans = []  # Suggest something went wrong when generating openings
-        for o in cls.orphans:
-            n = o.neighbours
-            # The first and last event don't have neighbours at all and are valid orphans
-            # if orphans they be. And every other orphan has neighbours and these must be
-            # of the same value (open or close) to be a valid orphas, because if they
-            # differ that is precisely when they were found unmatched and orphaned.
-            valid = n[0] and n[1] and n[0].value == n[1].value
-            if not valid:
-                invalid_orphans.append(o)
-        return invalid_orphans
+        '''
+        Returns a list of the Orphan records that are not valid (see Orphan.valid), which suggest
+        something went wrong when generating openings.
+        '''
+        return [o for o in cls.orphan_analysis() if not o.valid]
 
     @classproperty
     def histogram(cls):
         # A basic count of all the events by code
-        code_counts = cls.objects.values('code').annotate(count=Count('code'))
+        code_counts = cls.objects.values('code').annotate(count=Count('code'), unpaired=Count('code', filter=Q(pairing__in=(PAIRING_ORPHAN, PAIRING_PENDING))))
         event_counts = {c['code']: c['count'] for c in code_counts}
         # And an extra entry for doorcontact_state events that have no associated opening (are orphaned)
-        event_counts['doorcontact_state_orphans'] = cls.orphans.count()
+        event_counts['doorcontact_state_orphans'] = sum(c['unpaired'] for c in code_counts if c['code'] == 'doorcontact_state')
         return event_counts
 
+    @classmethod
+    def battery_series(cls, door=None, points=BATTERY_POINTS, degree=5, cache=True):
+        '''
+        Returns the battery charge time series of each door, for graphing, as a dict keyed on door ID of
+        dicts of:
+
+            start:      the time of the first report (the series times are in days since it)
+            x, y:       the step changes of charge (1, 2, 3 for low, middle, high), downsampled to at most points points
+            smooth_x,
+            smooth_y:   a smoothed fit of the charge (a polynomial of degree), sampled at points times
+            replace:    the time the charge is projected to fall to low (or did), or None if it isn't falling
+
+        In one query for all doors (none if the reports are read from the column cache, see Doors.models.columns),
+        with NumPy array operations on the reports (see Doors.models.battery), so the series are bounded in size,
+        however long the history.
+
+        :param door: An instance of Door (or None for all doors)
+        :param points: the most points in each series
+        :param degree: the degree of the polynomial fitted
+        :param cache: read the reports from the column cache if it is current
+        '''
+        from .columns import current
+        cached = current() if cache else None
+        if cached is not None:
+            events = cached["events"]
+            reports = (events["code"] == CODES.index("battery_state")) & (events["state"] > 0)
+            if door is not None:
+                reports &= events["door"] == door.id
+            # By door, in time order (the cache is in time order)
+            order = np.argsort(events["door"][reports], kind="stable")
+            doors = events["door"][reports][order]
+            timestamps = events["timestamp"][reports][order]
+            charges = events["state"][reports][order].astype(np.int64)
+        else:
+            events = cls.objects.filter(code="battery_state", value__in=BATTERY_STATES)
+            if door is not None:
+                events = events.filter(door=door)
+            rows = list(events.order_by("door_id", "timestamp").values_list("door_id", "timestamp", "value"))
+
+            doors = np.fromiter((d for d, t, v in rows), dtype=np.int64, count=len(rows))
+            timestamps = np.fromiter((t for d, t, v in rows), dtype=np.int64, count=len(rows))
+            charges = np.fromiter((1 + BATTERY_STATES.index(v) for d, t, v in rows), dtype=np.int64, count=len(rows))
+
+        series = {}
+        starts = runs(doors)
+        for first, last in zip(starts.tolist(), np.append(starts[1:], len(doors)).tolist()):
+            zero = timestamps[first]
+            x = cls.days_from_timestamp_diff(timestamps[first:last] - zero)
+            y = charges[first:last]
+
+            smooth = fit(x, y, degree)
+            smooth_x = np.linspace(x[0], x[-1], points)
+            replace = replacement(x, y)
+
+            step_x, step_y = lttb(*steps(x, y), points)
+            series[int(doors[first])] = {"start": cls.datetime_from_timestamp(zero),
+                                         "x": step_x.tolist(),
+                                         "y": step_y.tolist(),
+                                         "smooth_x": smooth_x.tolist(),
+                                         "smooth_y": smooth(smooth_x).tolist(),
+                                         "replace": None if replace is None else cls.datetime_from_timestamp(zero) + timedelta(days=float(replace))}
+
+        return series
+
     @classmethod
     def battery_graph(cls, door=None):
         '''
         Returns a time series of battery states, for a given door or all doors
 
-        For one door it is a dict keyed on time, with a numeric battery state (3, 2, 1)
-        and for all doors it's a list of such dicts.
+        For one door it is a dict keyed on time (in days since the first report), with a numeric battery
+        state (3, 2, 1) at each change of state (see battery_series) and for all doors it's a list of such dicts.
 
         :param door: An instance of Door
         '''
-        APP = __package__.split('.')[0]
-        Door = apps.get_model(APP, "Door")
-        if door is None:
-            doors = Door.objects.all()
-        else:
-            doors = [door]
-
-        graphs = []
-        for door in doors:
-            graph = dict()
-            events = cls.objects.filter(door=door, code="battery_state").order_by("timestamp")
-            zero = events.first().timestamp
-            for event in events:
-                time_value = cls.days_from_timestamp_diff(event.timestamp - zero)
-                graph[time_value] = 1 + BATTERY_STATES.index(event.value)
-            graphs.append(graph)
-
+        graphs = [dict(zip(s["x"], s["y"])) for s in cls.battery_series(door).values()]
         return graphs[0] if len(graphs) == 1 else graphs
 
     @property
     def neighbours(self):
-        before = Event.objects.filter(door=self.door, code='doorcontact_state', timestamp__lt=self.timestamp).order_by("-timestamp")
-        after = Event.objects.filter(door=self.door, code='doorcontact_state', timestamp__gt=self.timestamp).order_by("timestamp")
-
-        Before = before[0] if before else None
-        After = after[0] if after else None
+        before = Event.objects.filter(door_id=self.door_id, code='doorcontact_state', timestamp__lt=self.timestamp).order_by("-timestamp")
+        after = Event.objects.filter(door_id=self.door_id, code='doorcontact_state', timestamp__gt=self.timestamp).order_by("timestamp")
 
-        return (Before, After)
+        return (before.first(), after.first())
 
     #########################################################################################
     # Django Rich Views supports nuanced rendering of the object
@@ -283,11 +586,11 @@ class Event(models.Model, RichMixIn):
         '''
         # Most codes have a value, uypdeown_state does not and records the value in type. Tuya!? Bizarre encoding.
         if self.code == 'doorcontact_state':
-            value = f"Door {self.door.id} is {'opened' if self.value == 'Open' else 'closed'}"
+            value = f"Door {self.door_id} is {'opened' if self.value == 'Open' else 'closed'}"
         elif self.code == 'battery_state':
-            value = f"Battery charge on door {self.door.id} is {self.value}"
+            value = f"Battery charge on door {self.door_id} is {self.value}"
         elif self.code == 'updown_state':
-            value = f"Sensor on door {self.door.id} goes {self.type}"
+            value = f"Sensor on door {self.door_id} goes {self.type}"
         else:
             value = "ERROR: Unsupported event"
 
@@ -309,25 +612,24 @@ class Event(models.Model, RichMixIn):
         '''
         if self.code == "doorcontact_state":
             text = 'opened' if self.value == 'Open' else 'closed'
-            if self.openings.count() > 0:
-                opening = field_render(text, link_target_url(self.openings.all()[0], link))
-            elif self.closings.count() > 0:
-                opening = field_render(text, link_target_url(self.closings.all()[0], link))
+            # Read through all() so that prefetched openings are used (see list_prefetch_related)
+            openings = self.openings.all() or self.closings.all()
+            if openings:
+                opening = field_render(text, link_target_url(openings[0], link))
             else:
                 opening = "unknown"
 
-            return f"{self.date_time} - Door {self.door.id} has been {opening}"
+            return f"{self.date_time} - Door {self.door_id} has been {opening}"
         elif self.code == "updown_state":
-            if self.went_up.count() > 0:
-                uptime = field_render(self.type, link_target_url(self.went_up.all()[0], link))
-            elif self.went_down.count() > 0:
-                uptime = field_render(self.type, link_target_url(self.went_down.all()[0], link))
+            uptimes = self.went_up.all() or self.went_down.all()
+            if uptimes:
+                uptime = field_render(self.type, link_target_url(uptimes[0], link))
             else:
                 uptime = "unknown"
 
-            return f"{self.date_time} - Door {self.door.id} sensor going {uptime}"
+            return f"{self.date_time} - Door {self.door_id} sensor going {uptime}"
         elif self.code == "battery_state":
-            return f"{self.date_time} - Door {self.door.id} battery charge is {self.value}"
+            return f"{self.date_time} - Door {self.door_id} battery charge is {self.value}"
 
     def __detail_str__(self, link=None):
         '''
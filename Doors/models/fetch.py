@@ -1,14 +1,67 @@
-import tinytuya, sys
+import tinytuya, sys, threading
 
 from django.conf import settings
-from django.db import models
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import models, transaction, connection
+from django.db.models import Count, Max, Min, Q
 
+from .conf import TUYA_PAGE_SIZE, TUYA_CALLS_PER_SECOND, TUYA_CALLS_PER_FETCH, FETCH_WORKERS
 from .door import Door
+from .event import Event
 from .opening import Opening
 from .visit import Visit
-from .uptime import Uptime
+from .pipeline import Pipeline
 
 from datetime import datetime
+from time import monotonic, sleep
+from concurrent.futures import ThreadPoolExecutor
+
+from Site.logutils import log
+
+# The widest window of time we ask Tuya for logs over
+MIN_TUYA_TIMESTAMP = 1
+MAX_TUYA_TIMESTAMP = sys.maxsize
+
+
+class RateLimitedCloud:
+    '''
+    Wraps a tinytuya.Cloud so that it can be shared by threads fetching logs for different doors.
+
+    Calls to getdevicelog are made one at a time (tinytuya.Cloud is not documented as thread safe),
+    at most rate calls per second, and no more than budget calls in all. Once the budget is spent
+    getdevicelog returns a log with no result, which stops paging and leaves a checkpoint for the next
+    fetch to resume from. Between them, rate and budget keep us within the Tuya API quota (described
+    in the fetch_logs management command).
+    '''
+
+    def __init__(self, cloud, rate=TUYA_CALLS_PER_SECOND, budget=TUYA_CALLS_PER_FETCH):
+        '''
+        :param cloud: a tinytuya.Cloud
+        :param rate: the maximum number of calls per second (None or 0 for no limit)
+        :param budget: the maximum number of calls to make (None or 0 for no limit)
+        '''
+        self.cloud = cloud
+        self.interval = 1 / rate if rate else 0
+        self.budget = budget
+        self.calls = 0
+        self.last_call = None
+        self.lock = threading.Lock()
+
+    def getdevicelog(self, *args, **kwargs):
+        with self.lock:
+            if self.budget and self.calls >= self.budget:
+                return {"success": False, "msg": f"Tuya API call budget of {self.budget} calls spent."}
+
+            if self.last_call is not None:
+                wait = self.last_call + self.interval - monotonic()
+                if wait > 0:
+                    sleep(wait)
+
+            try:
+                return self.cloud.getdevicelog(*args, **kwargs)
+            finally:
+                self.last_call = monotonic()
+                self.calls += 1
 
 
 class DataFetch(models.Model):
@@ -17,46 +70,333 @@ class DataFetch(models.Model):
     '''
     date_time = models.DateTimeField('Time')
 
+    # Checkpoints so that an interrupted fetch can resume where it stopped. Keyed on door ID (as
+    # a string, it's JSON) each is a dict with the "start" time the logs were requested from, the
+    # "row_key" of the next page to fetch and whether the door is "done" (all pages fetched).
+    row_keys = models.JSONField('Tuya row keys', default=dict)
+    complete = models.BooleanField('Complete', default=False)
+
+    # When the fetch finished (updating everything derived from the events), complete or not
+    finished = models.DateTimeField('Finished', null=True)
+
+    # A snapshot of the data statistics (see live_stats) taken when the fetch finished
+    stats = models.JSONField('Data statistics', encoder=DjangoJSONEncoder, null=True)
+
+    # The version of the data when the fetch last finished (see version), new every time it finishes
+    data_version = models.PositiveBigIntegerField('Data version', null=True)
+
     @classmethod
-    def fetch_logs(self, verbosity=1):
-        from .event import Event
+    def cloud(cls):
+        '''
+        Returns a tinytuya.Cloud connection configured from settings.
+        '''
+        return tinytuya.Cloud(apiRegion=settings.TUYA_REGION,
+                              apiKey=settings.TUYA_KEY,
+                              apiSecret=settings.TUYA_SECRET,
+                              apiDeviceID=settings.TUYA_DEVICE_ID)
 
-        cloud = tinytuya.Cloud(apiRegion=settings.TUYA_REGION,
-                               apiKey=settings.TUYA_KEY,
-                               apiSecret=settings.TUYA_SECRET,
-                               apiDeviceID=settings.TUYA_DEVICE_ID)
+    @classmethod
+    def log_pages(cls, cloud, door, start, end=MAX_TUYA_TIMESTAMP, row_key=None, verbosity=1):
+        '''
+        A generator that pages through the Tuya logs for a door, one API call per page, following
+        next_row_key until Tuya says there's no more. Yields (log, next_row_key) 2-tuples, where log
+        is as returned by tinytuya.Cloud.getdevicelog and holds one page of events, and next_row_key
+        is the row key of the page after it (None after the last page).
 
-        min_tuya_timestamp = 1
-        max_tuya_timestamp = sys.maxsize
+        Only one page is ever in memory, however long the backlog.
 
-        fetch = DataFetch(date_time=datetime.now())
-        fetch.save()
+        :param cloud: a tinytuya.Cloud (or anything with a compatible getdevicelog method)
+        :param door: a Door object
+        :param start: the Tuya timestamp to fetch logs from
+        :param end: the Tuya timestamp to fetch logs until
+        :param row_key: the row key to start fetching from (to resume an interrupted fetch)
+        :param verbosity: Django manage.py argument for Verbosity level; 0=minimal output, 1=normal output, 2=verbose output, 3=very verbose output
+        '''
+        while True:
+            log = cloud.getdevicelog(door.tuya_device_id, start=start, end=end, size=TUYA_PAGE_SIZE, max_fetches=1, start_row_key=row_key)
 
-        for door in Door.objects.all():
-            last = Event.last(door=door)
-            start = last.timestamp - 1  if last else  min_tuya_timestamp
-            log = cloud.getdevicelog(door.tuya_device_id, start=start, end=max_tuya_timestamp)
-
-            # Just some sniffers while debugging
-            if 'result' in log:
-                row_key = log['result'].get('current_row_key', None)
-                has_next = log['result'].get('has_next', False)
-                next_row_key = log['result'].get('next_row_key', None)
-                fetches = log.get('fetches', 1)
-                events = log['result'].get('logs', [])
-                
-                if verbosity > 0:
-                    print(f"Door {door.id}: Fetched {len(events)} events in {fetches} fetches.")
-
-                Event.save_logs(door, log, fetch, verbosity=verbosity)
-                Opening.update_from_events(door, verbosity=verbosity)
-                Uptime.update_from_events(door, verbosity=verbosity)
-            else:
+            if not 'result' in log:
                 print("No result in downloaded log.")
                 print(f"log: {log}")
+                return
+
+            has_next = log['result'].get('has_next', False)
+            next_row_key = log['result'].get('next_row_key', None) if has_next else None
+
+            if verbosity >= 2:
+                print(f"Door {door.id}: Fetched a page of {len(log['result'].get('logs', []))} events{', more to come' if next_row_key else ''}.")
+
+            yield log, next_row_key
+
+            # Tuya has been known to offer has_next without a new row key, so we stop if it doesn't move on
+            if not next_row_key or next_row_key == row_key:
+                return
+
+            row_key = next_row_key
+
+    @classmethod
+    def version(cls):
+        '''
+        Returns the version of all the data derived from events (None if there's been no fetch), which
+        only ever goes up: every time a fetch finishes (a resumed one included), and whenever the data is
+        changed other than by a fetch (see new_version). A fetch in progress does not change it.
+        '''
+        return cls.objects.aggregate(version=Max("data_version"))["version"]
+
+    @classmethod
+    def new_version(cls, fetch=None):
+        '''
+        Gives a fetch a new version of the data, one greater than any before it, and returns it (None if no
+        fetch has finished).
+
+        :param fetch: the DataFetch that changed the data (default: the last that finished, for changes made
+                      other than by a fetch)
+        '''
+        with transaction.atomic():
+            # Locking the fetch with the latest version, so that two new versions are never the same
+            latest = cls.objects.select_for_update().filter(data_version__isnull=False).order_by("-data_version").values_list("data_version", flat=True).first()
+
+            if fetch is None:
+                fetch = cls.objects.filter(finished__isnull=False).order_by("-id").first()
+                if fetch is None:
+                    return None
+
+            fetch.data_version = (latest or 0) + 1
+            fetch.save(update_fields=["data_version"])
+
+        return fetch.data_version
+
+    @classmethod
+    def live_stats(cls):
+        '''
+        Returns a dict of basic statistics about the collected data, computed from the data itself:
+        the timestamps of the first and last events, the number of door contact events, and the
+        number of Openings and Visits. All the event statistics come from one aggregate query.
+        '''
+        stats = Event.objects.aggregate(first_event=Min('timestamp'),
+                                        last_event=Max('timestamp'),
+                                        event_count=Count('timestamp', filter=Q(code='doorcontact_state')))
+        stats['open_count'] = Opening.objects.count()
+        stats['visit_count'] = Visit.objects.count()
+        return stats
+
+    @classmethod
+    def refresh_stats(cls):
+        '''
+        Takes a new snapshot of the data statistics on the last fetch that finished. For use after
+        anything other than a fetch has changed the data (rebuilding Openings or Visits for example).
+        '''
+        fetch = cls.objects.filter(finished__isnull=False).order_by("-id").first()
+        if fetch:
+            fetch.stats = cls.live_stats()
+            fetch.save(update_fields=["stats"])
+
+    @classmethod
+    def data_changed(cls, rebuild=True, verbosity=1):
+        '''
+        Records a change to the data made other than by a fetch (rebuilding Openings or Visits, the rollups
+        or histograms for example): takes a new snapshot of the data statistics, gives the data a new version
+        (so that no page cached before is served) and writes the column cache of it. Returns the new version
+        (None if no fetch has finished).
+
+        :param rebuild: write the column cache afresh (if Events, Openings or Visits changed), else copy it from the last version
+        :param verbosity: Django manage.py argument for Verbosity level; 0=minimal output, 1=normal output, 2=verbose output, 3=very verbose output
+        '''
+        cls.refresh_stats()
+
+        version = cls.new_version()
+        if version is not None:
+            from . import columns
+            columns.refresh(version, rebuild=rebuild, verbosity=verbosity)
+
+        return version
+
+    @classmethod
+    def data_stats(cls):
+        '''
+        Returns a dict of basic statistics about the collected data, for presentation on every page.
+
+        In one query, from the snapshot taken when the last fetch finished. Only if there is no
+        snapshot (no fetch has finished since they were introduced) are they computed live.
+        '''
+        last_fetch = cls.objects.filter(finished__isnull=False).order_by("-id").values("date_time", "stats").first()
+
+        if last_fetch and last_fetch["stats"]:
+            stats = last_fetch["stats"]
+        else:
+            stats = cls.live_stats()
+            if not last_fetch:
+                last_fetch = cls.objects.order_by("-id").values("date_time").first()
+
+        first_event = Event.datetime_from_timestamp(stats['first_event']) if stats['first_event'] else None
+        last_event = Event.datetime_from_timestamp(stats['last_event']) if stats['last_event'] else None
+
+        return {'first_event': first_event,
+                'last_event': last_event,
+                'last_fetch': last_fetch["date_time"] if last_fetch else "unknown",
+                'time_span': last_event - first_event if first_event else None,
+                'event_count': stats['event_count'],
+                'open_count': stats['open_count'],
+                'visit_count': stats['visit_count']}
+
+    @classmethod
+    def resumable(cls):
+        '''
+        Returns the last fetch if it was interrupted (is not complete), else None.
+        '''
+        last = cls.objects.order_by("-id").first()
+        return last if last and not last.complete else None
+
+    def checkpoint(self, door, start, row_key, done=False):
+        '''
+        Records how far we got fetching logs for a door, in the transaction that saved the page.
+
+        Doors may be fetched concurrently, so only this door's checkpoint is written: the row keys are
+        re-read (locking the row until the page is committed) and this door's merged in, and our copy
+        is updated only once the page is committed (a page rolled back leaves no checkpoint, in the
+        database or here, for another door's checkpoint to save).
+
+        :param door: a Door object
+        :param start: the Tuya timestamp we fetched logs from
+        :param row_key: the row key of the next page to fetch
+        :param done: True if all the logs for this door have been fetched
+        '''
+        key = str(door.id)
+        checkpoint = {"start": start, "row_key": row_key, "done": done}
+
+        with transaction.atomic():
+            row_keys = DataFetch.objects.select_for_update().values_list("row_keys", flat=True).get(pk=self.pk)
+            row_keys[key] = checkpoint
+            DataFetch.objects.filter(pk=self.pk).update(row_keys=row_keys)
+
+        def committed():
+            self.row_keys[key] = checkpoint
+
+        transaction.on_commit(committed)
+
+    def fetch_door(self, cloud, door, verbosity=1):
+        '''
+        Fetch the new logs for one door, saving them as Events and updating everything derived from them
+        (the door's Openings, Uptimes, battery charge and event pairing states) in one pass (see Pipeline).
+
+        Returns True if all the door's logs were fetched, False if paging stopped early (in which case
+        the checkpoint will see the next fetch resume where this one stopped).
+
+        :param cloud: a tinytuya.Cloud (or a RateLimitedCloud wrapping one)
+        :param door: a Door object
+        :param verbosity: Django manage.py argument for Verbosity level; 0=minimal output, 1=normal output, 2=verbose output, 3=very verbose output
+        '''
+        checkpoint = self.row_keys.get(str(door.id), None)
+
+        # Resume paging where an interrupted fetch stopped, else fetch everything since the last event we have.
+        if checkpoint and not checkpoint["done"]:
+            start = checkpoint["start"]
+            row_key = checkpoint["row_key"]
+            if verbosity > 0:
+                print(f"Door {door.id}: Resuming from row key {row_key}.")
+        else:
+            last = Event.last(door=door)
+            start = last.timestamp - 1 if last else MIN_TUYA_TIMESTAMP
+            row_key = None
+
+        pages = 0
+        fetched = 0
+        done = False
+        for log, next_row_key in DataFetch.log_pages(cloud, door, start, row_key=row_key, verbosity=verbosity):
+            done = next_row_key is None
+
+            # Save the page and record the checkpoint together, so that a resumed fetch
+            # starts from the first page not saved.
+            with transaction.atomic():
+                Event.save_logs(door, log, self, bulk=True, verbosity=verbosity)
+                self.checkpoint(door, start, next_row_key, done=done)
+
+            pages += 1
+            fetched += len(log['result'].get('logs', []))
+
+        if verbosity > 0:
+            print(f"Door {door.id}: Fetched {fetched} events in {pages} fetches.")
+
+        Pipeline(door, verbosity=verbosity).run()
+
+        return done
+
+    def fetch_door_in_thread(self, cloud, door, verbosity=1):
+        '''
+        fetch_door for a worker thread. Django opens a database connection per thread, and we close it
+        when done, as the pool's threads are not managed by Django (as request threads are).
+        '''
+        try:
+            return self.fetch_door(cloud, door, verbosity=verbosity)
+        finally:
+            connection.close()
+
+    @classmethod
+    def fetch_logs(self, cloud=None, resume=True, workers=FETCH_WORKERS, rate=TUYA_CALLS_PER_SECOND, budget=TUYA_CALLS_PER_FETCH, verbosity=1):
+        '''
+        Fetch all new logs from Tuya, saving them as Events and updating Openings, Uptimes and Visits from them.
+
+        With more than one worker, doors are fetched concurrently, in a pool of that many threads. Calls
+        to Tuya are made one at a time and rate limited (see RateLimitedCloud), so one door's download
+        overlaps other doors' database work.
+
+        :param cloud: a tinytuya.Cloud (created from settings if not provided)
+        :param resume: resume the last fetch if it was interrupted, else start a new one
+        :param workers: the number of doors to fetch concurrently
+        :param rate: the maximum number of Tuya API calls per second (None or 0 for no limit)
+        :param budget: the maximum number of Tuya API calls to make (None or 0 for no limit), any doors not fetched within budget are resumed next fetch
+        :param verbosity: Django manage.py argument for Verbosity level; 0=minimal output, 1=normal output, 2=verbose output, 3=very verbose output
+        '''
+        if cloud is None:
+            cloud = DataFetch.cloud()
+
+        cloud = RateLimitedCloud(cloud, rate=rate, budget=budget)
+
+        fetch = DataFetch.resumable() if resume else None
+
+        if fetch:
+            if verbosity > 0:
+                print(f"Resuming interrupted fetch from {fetch.date_time}.")
+        else:
+            fetch = DataFetch(date_time=datetime.now())
+            fetch.save()
+
+        doors = list(Door.objects.all())
+
+        if workers > 1 and len(doors) > 1:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                done = list(pool.map(lambda door: fetch.fetch_door_in_thread(cloud, door, verbosity=verbosity), doors))
+        else:
+            done = [fetch.fetch_door(cloud, door, verbosity=verbosity) for door in doors]
 
         # A visit spans all doors (while an Opening concerns only one door)
         Visit.update_from_openings(verbosity=verbosity)
 
+        # The daily rollups of the days this fetch touched
+        from .rollup import DailyRollup
+        touched = DailyRollup.touched(fetch)
+        if touched:
+            DailyRollup.update(*touched, verbosity=verbosity)
+
+        # And the histograms presented are precomputed from Visits and Openings
+        from .histogram import Histogram
+        Histogram.refresh(verbosity=verbosity)
+
+        # An incomplete fetch (one that failed on any door) is resumed next time
+        fetch.complete = all(done)
+        fetch.finished = datetime.now()
+        fetch.stats = DataFetch.live_stats()
+        fetch.save(update_fields=["complete", "finished", "stats"])
+        version = DataFetch.new_version(fetch)
+
+        # The column cache of this version of the data (which is only read once it is written, so a failure
+        # to write it leaves readers reading the database)
+        from . import columns
+        try:
+            columns.refresh(version, verbosity=verbosity)
+        except OSError as E:
+            log.warning(f"Failed to write the column cache: {E}")
+
         if verbosity > 0:
+            print(f"Made {cloud.calls} Tuya API calls.")
             print(f"Done!")
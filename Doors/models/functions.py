@@ -0,0 +1,35 @@
+'''
+Database functions for binning durations in the database (rather than in Python).
+
+Durations are stored as a PostgreSQL interval (and in SQLite as a count of microseconds).
+'''
+from django.db.models import Func, Value, FloatField, IntegerField
+
+
+class Epoch(Func):
+    '''
+    A duration in seconds (as a float).
+    '''
+    output_field = FloatField()
+
+    def as_postgresql(self, compiler, connection, **extra_context):
+        return self.as_sql(compiler, connection, template="CAST(EXTRACT(EPOCH FROM %(expressions)s) AS double precision)", **extra_context)
+
+    def as_sqlite(self, compiler, connection, **extra_context):
+        return self.as_sql(compiler, connection, template="(%(expressions)s / 1000000.0)", **extra_context)
+
+
+class DurationBucket(Func):
+    '''
+    The bucket a duration falls in, for buckets of a given width, being the duration divided by
+    the width and rounded to the nearest integer (as round(duration / width) does in Python).
+
+    :param expression: a duration
+    :param width: the width of the buckets (a timedelta)
+    '''
+    template = "CAST(ROUND(%(expressions)s) AS integer)"
+    arg_joiner = " / "
+    output_field = IntegerField()
+
+    def __init__(self, expression, width, **extra):
+        super().__init__(Epoch(expression), Value(width.total_seconds(), output_field=FloatField()), **extra)
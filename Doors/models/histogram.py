@@ -0,0 +1,208 @@
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Count, Max, Sum
+from django.db import models, transaction
+
+from datetime import datetime, timedelta
+
+from .opening import Opening
+from .visit import Visit
+
+# The widths of the duration categories of the histograms presented on the Trends page (which daily
+# rollups are binned in as well, see Doors.models.rollup)
+DURATION_CATEGORIES = timedelta(seconds=30)
+QUIET_CATEGORIES = timedelta(minutes=30)
+
+# The histograms presented on the Trends page, as (model, htype, categories) 3-tuples
+# being the arguments Model.histogram(htype, categories) is called with.
+TRENDS_HISTOGRAMS = [(Visit, "per_days", None),
+                     (Visit, "day", None),
+                     (Visit, "week", None),
+                     (Visit, "month", None),
+                     (Visit, "year", "months"),
+                     (Visit, "year", "weeks"),
+                     (Visit, "durations", DURATION_CATEGORIES),
+                     (Visit, "quiet_times", QUIET_CATEGORIES),
+                     (Visit, "doors_per_visit_total", None),
+                     (Visit, "doors_per_visit_unique", None),
+                     (Visit, "opens_per_door", None),
+                     (Visit, "overlap_durations", None),
+                     (Opening, "durations", DURATION_CATEGORIES)]
+
+
+class Histogram(models.Model):
+    '''
+    Precomputed histogram data, so that pages can present histograms without aggregating whole tables
+    on every request. The data only changes when logs are fetched, and the histograms are refreshed
+    at the end of every fetch (from the daily rollups, see refresh).
+
+    Keyed on the model and histogram type and categories that Model.histogram(htype, categories) is
+    called with. The data is stored as a list of [category, count] pairs, because a JSON object
+    (stored as PostgreSQL jsonb) does not preserve the order of the categories.
+    '''
+    model = models.CharField('Model', max_length=64)
+    htype = models.CharField('Histogram type', max_length=64)
+    categories = models.CharField('Categories', max_length=64, blank=True)
+    data = models.JSONField('Data', encoder=DjangoJSONEncoder)
+
+    # A summary of the source data the histogram was computed from, which changes when it does
+    source = models.JSONField('Source summary', encoder=DjangoJSONEncoder)
+    date_time = models.DateTimeField('Time')
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['model', 'htype', 'categories'], name='unique_histogram')]
+
+    @property
+    def histogram(self):
+        return {category: count for category, count in self.data}
+
+    @classmethod
+    def key(cls, model, htype, categories=None):
+        return (model.__name__, htype, "" if categories is None else str(categories))
+
+    @classmethod
+    def sources(cls):
+        '''
+        Returns a summary of the source data for histograms of each model. Visit histograms draw on
+        Openings too (the doors opened in a visit), so their summary includes both.
+        '''
+        def summary(model):
+            return list(model.objects.aggregate(count=Count('id'), last=Max('date_time'), total=Sum('duration')).values())
+
+        visits = summary(Visit)
+        openings = summary(Opening)
+        return {Visit.__name__: visits + openings, Opening.__name__: openings}
+
+    @classmethod
+    def live(cls, model, htype, categories=None):
+        '''
+        Returns the histogram computed from scratch, as a list of [category, count] pairs.
+
+        From the database, not the column cache, which is of the last version of the data, not one being
+        derived (histograms are refreshed before a fetch finishes and the cache of its version is written).
+        '''
+        if not model.objects.exists():
+            return []
+
+        data = model.histogram(htype, categories, cache=False) or {}
+        return [[category, int(count)] for category, count in data.items()]
+
+    @classmethod
+    def all(cls, histograms=TRENDS_HISTOGRAMS):
+        '''
+        Returns a dict of histograms (each a dict of counts keyed on category) keyed on (model, htype,
+        categories) as they appear in histograms. In one query, bar any missing from the store (that
+        have never been refreshed) which are computed live.
+
+        :param histograms: a list of (model, htype, categories) 3-tuples
+        '''
+        stored = {(h.model, h.htype, h.categories): h.histogram for h in cls.objects.all()}
+
+        result = {}
+        for model, htype, categories in histograms:
+            key = cls.key(model, htype, categories)
+            if key in stored:
+                result[(model, htype, categories)] = stored[key]
+            else:
+                result[(model, htype, categories)] = {category: count for category, count in cls.live(model, htype, categories)}
+
+        return result
+
+    @classmethod
+    def refresh(cls, rebuild=False, histograms=TRENDS_HISTOGRAMS, verbosity=0):
+        '''
+        Brings the stored histograms up to date, saving those that changed.
+
+        They are summed from the daily rollups (see Doors.models.rollup), which a fetch recomputes for the days
+        it touched, so a refresh reads one row per door per day rather than aggregating all the Visits and
+        Openings. Only if the rollups don't cover all days yet, for histograms they don't answer, or if rebuild
+        is requested, are histograms computed from scratch (see live).
+
+        :param rebuild: compute every histogram from scratch (from Visits and Openings)
+        :param histograms: a list of (model, htype, categories) 3-tuples
+        :param verbosity: Django manage.py argument for Verbosity level; 0=minimal output, 1=normal output, 2=verbose output, 3=very verbose output
+        '''
+        from .rollup import DailyRollup
+
+        if rebuild or not DailyRollup.cover_all_days():
+            rolled_up, sources = {}, cls.sources()
+        else:
+            summary = DailyRollup.summary()
+            rolled_up, sources = DailyRollup.histograms(), {Visit.__name__: summary, Opening.__name__: summary}
+
+        stored = {(h.model, h.htype, h.categories): h for h in cls.objects.all()}
+        now = datetime.now()
+
+        updated = 0
+        with transaction.atomic():
+            for model, htype, categories in histograms:
+                key = cls.key(model, htype, categories)
+                histogram = stored.get(key, None)
+
+                if (model, htype, categories) in rolled_up:
+                    data = [[category, int(count)] for category, count in rolled_up[(model, htype, categories)].items()]
+                else:
+                    data = cls.live(model, htype, categories)
+
+                # Round trip the data through JSON to compare like with like
+                if histogram and not rebuild and DjangoJSONEncoder().encode(histogram.data) == DjangoJSONEncoder().encode(data):
+                    if verbosity >= 2:
+                        print(f"\tHistogram {key} is up to date.")
+                    continue
+
+                if histogram is None:
+                    histogram = cls(model=key[0], htype=key[1], categories=key[2])
+
+                histogram.data = data
+                histogram.source = sources[model.__name__]
+                histogram.date_time = now
+                histogram.save()
+                updated += 1
+
+                if verbosity >= 2:
+                    print(f"\tHistogram {key} updated.")
+
+            # Drop any histograms no longer presented
+            keys = [cls.key(*h) for h in histograms]
+            for key, histogram in stored.items():
+                if not key in keys:
+                    histogram.delete()
+
+        if verbosity >= 1:
+            print(f"Updated {updated} of {len(histograms)} histograms{'' if rolled_up else ' (from scratch)'}.")
+
+    @classmethod
+    def verify(cls, histograms=TRENDS_HISTOGRAMS, verbosity=0):
+        '''
+        Compares the stored histograms with the live computation. Returns a list of the keys
+        of histograms that are missing or differ.
+
+        :param histograms: a list of (model, htype, categories) 3-tuples
+        :param verbosity: Django manage.py argument for Verbosity level; 0=minimal output, 1=normal output, 2=verbose output, 3=very verbose output
+        '''
+        stored = {(h.model, h.htype, h.categories): h for h in cls.objects.all()}
+
+        inconsistent = []
+        for model, htype, categories in histograms:
+            key = cls.key(model, htype, categories)
+            live = cls.live(model, htype, categories)
+            # Round trip the live data through JSON to compare like with like (JSON has no tuples for example)
+            live = DjangoJSONEncoder().encode(live)
+
+            if not key in stored:
+                inconsistent.append(key)
+                if verbosity >= 1:
+                    print(f"Histogram {key} is missing.")
+            elif DjangoJSONEncoder().encode(stored[key].data) != live:
+                inconsistent.append(key)
+                if verbosity >= 1:
+                    print(f"Histogram {key} differs from the live data.")
+                if verbosity >= 2:
+                    print(f"\tstored: {stored[key].data}")
+                    print(f"\tlive:   {live}")
+            elif verbosity >= 2:
+                print(f"Histogram {key} is consistent.")
+
+        if verbosity >= 1:
+            print(f"{len(histograms) - len(inconsistent)} of {len(histograms)} histograms are consistent with the live data.")
+
+        return inconsistent
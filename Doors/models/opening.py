@@ -2,12 +2,19 @@ import humanize
 
 from datetime import timedelta
 
-from django.db import models
+from django_rich_views.model import field_render, link_target_url, RichMixIn
+
+from django.db import models, transaction
+from django.db.models import Count, Q
+
+from .conf import BULK_BATCH_SIZE, PAIRING_PENDING
+from .functions import DurationBucket
+from .pairing import load, pair_door_contacts
 
 from Site.logutils import log
 
 
-class Opening(models.Model):
+class Opening(models.Model, RichMixIn):
     '''
     A reinterpretation of Events to pair Open and Close events into Openings.
 
@@ -21,6 +28,19 @@ class Opening(models.Model):
     open_event = models.ForeignKey('Event', related_name='openings', on_delete=models.PROTECT)
     close_event = models.ForeignKey('Event', related_name='closings', on_delete=models.PROTECT)
 
+    class Meta:
+        # Openings are found by door in time order (covering the close event that updates resume from)
+        # and by time across all doors (visits are updated from them, from the first not yet in a visit).
+        indexes = [models.Index(fields=['door', 'date_time'], include=['close_event'], name='opening_door_time'),
+                   models.Index(fields=['date_time'], name='opening_time'),
+                   models.Index(fields=['date_time'], condition=Q(visit__isnull=True), name='opening_unvisited')]
+
+    # The relations rendered when openings are listed (fetched with the list, see Doors.views.generic.with_related)
+    list_select_related = ("open_event", "close_event", "visit")
+
+    # The keys openings are listed and browsed in order of (see Doors.views.keyset)
+    ordering_keys = ("date_time", "id")
+
     @property
     def timestamp(self):
         from .event import Event
@@ -32,8 +52,13 @@ class Opening(models.Model):
 
     @property
     def previous(self):
-        earlier = self.__class__.objects.filter(date_time__lt=self.date_time).order_by("-date_time")
-        return earlier[0] if len(earlier) > 0 else None
+        '''
+        The opening of the same door before this one in key order (None if it is the first), a seek in the
+        door and time index.
+        '''
+        earlier = self.__class__.objects.filter(Q(date_time__lt=self.date_time) | Q(date_time=self.date_time, id__lt=self.id),
+                                                door_id=self.door_id, date_time__lte=self.date_time)
+        return earlier.order_by("-date_time", "-id").first()
 
     @classmethod
     def last(cls, door=None):
@@ -48,17 +73,26 @@ class Opening(models.Model):
         return openings[0] if openings else None
 
     @classmethod
-    def histogram(cls, htype="durations", categories=None):
+    def histogram(cls, htype="durations", categories=None, cache=True):
         '''
         Returns data for populating a histogram of opening counts.
         In the form of a dict with category as key and count of openings and the value.
 
+        Computed over the column cache if it is current (see Doors.models.columns), with no query bar the one
+        for its version.
+
         :param htype:
+        :param cache: read openings from the column cache if it is current
         '''
         if htype == "durations":
             if categories is None:
                 categories = timedelta(minutes=1)
 
+            from . import columns
+            cached = columns.current() if cache and isinstance(categories, timedelta) else None
+            if cached is not None:
+                return columns.durations(cached["openings"]["duration"], categories)
+
             if isinstance(categories, timedelta):
                 def label(td, i):
                     secs = round((i * td).total_seconds())
@@ -68,45 +102,85 @@ class Opening(models.Model):
                 def label2(td, i):
                     return f"{label(td, i)}-{label(td, i+1)}"
 
+                # Binned in the database, which returns only the buckets with openings in them
                 field = "duration"
-                durations = list(cls.objects.all().order_by(field).values_list(field))
-                longest = durations[-1][0]
-                cats = round(longest / categories)
-                visit_counts = {f"{label2(categories, c)}":0 for c in range(cats + 1)}
-                for d in durations:
-                    # d is a single value tuple (thanks Django!)
-                    c = round(d[0] / categories)
-                    visit_counts[f"{label2(categories, c)}"] += 1
-
-                # remove empty categories
-                return {l:c for l,c in visit_counts.items() if c !=0 }
+                buckets = cls.objects.annotate(bucket=DurationBucket(field, categories)).values("bucket").annotate(count=Count("id")).order_by("bucket")
+                return {label2(categories, b["bucket"]): b["count"] for b in buckets}
             else:
                 return None
 
     @classmethod
-    def update_from_events(cls, door, rebuild=False, Rebuild=False, verbosity=0):
+    def update_from_events(cls, door, rebuild=False, Rebuild=False, bulk=True, vectorized=False, verbosity=0):
         '''
         Update openings from new events (or all events if rebuild requested)
 
         :param door: An instance of Door
         :param rebuild: Rebuild all openings (process all events)
         :param Rebuild: same as rebuild but delete all openings visits first (a hard reset)
+        :param bulk: pair events from a stream of values and create new openings in bulk (see update_from_events_bulk)
+        :param vectorized: pair events with NumPy array operations, fastest for rebuilds (see update_from_events_vectorized)
         :param verbosity: Django manage.py argument for Verbosity level; 0=minimal output, 1=normal output, 2=verbose output, 3=very verbose output
         '''
         from .event import Event
+        from .pipeline import OpeningPairer
+        from .derivation import DerivationState
 
-        # Find the last opening recorded
-        last_opening = cls.last(door)
-
-        # Get all events after it's closing event
-        if last_opening and not (rebuild or Rebuild):
-            new_events = Event.objects.filter(door=door, code="doorcontact_state", timestamp__gt=last_opening.close_event.timestamp).order_by("timestamp")
+        if bulk and not vectorized:
+            # The bulk engine is the OpeningPairer of the derivation pipeline, which resumes from its recorded state
+            pairer = OpeningPairer(door, rebuild=rebuild or Rebuild, verbosity=verbosity)
+            since = pairer.since("doorcontact_state")
+        else:
+            # The others start closed, after the closing event of the last opening recorded (its id is its
+            # timestamp) and leave no state to resume from
+            DerivationState.forget(door, OpeningPairer.name)
+            since = None if rebuild or Rebuild else cls.objects.filter(door=door).order_by("-date_time").values_list("close_event_id", flat=True).first()
+
+        # Get all events after it
+        if since and not (rebuild or Rebuild):
+            new_events = Event.objects.filter(door=door, code="doorcontact_state", timestamp__gt=since).order_by("timestamp")
         # or all events (if we have no openings for this door yet)
         else:
             if Rebuild:
                 cls.objects.filter(door=door).delete()
             new_events = Event.objects.filter(door=door, code="doorcontact_state").order_by("timestamp")
 
+        if vectorized:
+            processed, new_openings, existing_openings, orphan_events = cls.update_from_events_vectorized(door, new_events, verbosity=verbosity)
+        elif bulk:
+            processed, new_openings, existing_openings, orphan_events = cls.update_from_events_bulk(door, new_events, pairer=pairer, verbosity=verbosity)
+        else:
+            processed, new_openings, existing_openings, orphan_events = cls.update_from_events_each(door, new_events, verbosity=verbosity)
+
+        # Record which of the events are paired, orphaned or pending (of those that might have changed,
+        # being those that were pending, unless we've reprocessed all events)
+        if rebuild or Rebuild:
+            Event.update_pairing(door, "doorcontact_state", new_events)
+        else:
+            Event.update_pairing(door, "doorcontact_state", Event.objects.filter(door=door, code="doorcontact_state", pairing=PAIRING_PENDING))
+
+        if verbosity >= 1:
+            print(f"Door {door.id}: Processed {processed} events, saved {len(new_openings)} new openings for door {door.id}.")
+            if len(new_openings) > 0:
+                print(f"\tfrom {new_openings[0].date_time} to {new_openings[-1].date_time}")
+            if existing_openings > 0:
+                print(f"\tand found {existing_openings} openings already saved.")
+            if len(orphan_events) > 0:
+                print(f"\tand found {len(orphan_events)} orphaned events (unmatched opens or closes).")
+
+        return new_openings
+
+    @classmethod
+    def update_from_events_each(cls, door, new_events, verbosity=0):
+        '''
+        Pairs Open and Closed events into openings, looking up and creating each opening in turn.
+
+        Returns the number of events processed, a list of the new openings, a count of the openings
+        that already existed and a list of the orphaned events.
+
+        :param door: An instance of Door
+        :param new_events: A QuerySet of the doorcontact_state Events to process, in timestamp order
+        :param verbosity: Django manage.py argument for Verbosity level; 0=minimal output, 1=normal output, 2=verbose output, 3=very verbose output
+        '''
         if verbosity >= 2:
             print(f"Processing {len(new_events)} Open/Close events for door {door.id}.")
 
@@ -173,12 +247,116 @@ class Opening(models.Model):
                     orphan_events.append(event)
                     pass
 
-        if verbosity >= 1:
-            print(f"Door {door.id}: Processed {len(new_events)} events, saved {len(new_openings)} new openings for door {door.id}.")
-            if len(new_openings) > 0:
-                print(f"\tfrom {new_openings[0].date_time} to {new_openings[-1].date_time}")
-            if len(existing_openings) > 0:
-                print(f"\tand found {len(existing_openings)} openings already saved.")
-            if len(orphan_events) > 0:
-                print(f"\tand found {len(orphan_events)} orphaned events (unmatched opens or closes).")
+        return len(new_events), new_openings, len(existing_openings), orphan_events
+
+    @classmethod
+    def update_from_events_bulk(cls, door, new_events, pairer=None, batch_size=BULK_BATCH_SIZE, verbosity=0):
+        '''
+        Pairs Open and Closed events into openings, as update_from_events_each does, but set based.
 
+        Events are streamed as (timestamp, value) tuples rather than model instances and paired in
+        memory by the OpeningPairer stage of the derivation pipeline (see Doors.models.pipeline), which
+        fetches the (open_event, close_event) pairs already recorded in one query, and the new openings
+        are created in batches in one transaction.
+
+        Returns the number of events processed, a list of the new openings, a count of the openings
+        that already existed and a list of the orphaned events (their timestamps).
+
+        :param door: An instance of Door
+        :param new_events: A QuerySet of the doorcontact_state Events to process, in timestamp order
+        :param pairer: the OpeningPairer to pair them with, if resuming from its state (default, a new one assuming closed state from outset)
+        :param batch_size: the number of openings to insert per query
+        :param verbosity: Django manage.py argument for Verbosity level; 0=minimal output, 1=normal output, 2=verbose output, 3=very verbose output
+        '''
+        from .pipeline import OpeningPairer
+
+        if pairer is None:
+            pairer = OpeningPairer(door, rebuild=True, batch_size=batch_size, verbosity=verbosity)
+
+        for timestamp, value in new_events.values_list("timestamp", "value").iterator(chunk_size=batch_size):
+            pairer.event(timestamp, "doorcontact_state", None, value)
+        pairer.finish()
+
+        if verbosity >= 2:
+            print(f"Processed {pairer.processed} Open/Close events for door {door.id}.")
+
+        return pairer.processed, pairer.new_openings, pairer.existing_openings, pairer.orphan_events
+
+    @classmethod
+    def update_from_events_vectorized(cls, door, new_events, batch_size=BULK_BATCH_SIZE, verbosity=0):
+        '''
+        Pairs Open and Closed events into openings, as update_from_events_each does, but with NumPy
+        array operations on all the events at once (see Doors.models.pairing). The events are loaded
+        as two columns (timestamp and value), the openings already recorded from them fetched in one
+        query, and the new openings created in batches in one transaction.
+
+        Returns the number of events processed, a list of the new openings, a count of the openings
+        that already existed and a list of the orphaned events (their timestamps).
+
+        :param door: An instance of Door
+        :param new_events: A QuerySet of the doorcontact_state Events to process, in timestamp order
+        :param batch_size: the number of openings to insert per query
+        :param verbosity: Django manage.py argument for Verbosity level; 0=minimal output, 1=normal output, 2=verbose output, 3=very verbose output
+        '''
+        from .event import Event
+
+        timestamps, is_open = load(new_events, "value", "Open", "Closed")
+        opens, closes, orphans = pair_door_contacts(timestamps, is_open)
+
+        if len(timestamps) > 0:
+            existing = {(o, c): (t, d, door_id) for o, c, t, d, door_id in
+                        cls.objects.filter(open_event_id__gte=timestamps[0])
+                                   .values_list("open_event_id", "close_event_id", "date_time", "duration", "door_id")}
+        else:
+            existing = {}
+
+        existing_openings = 0
+        new_openings = []
+        for opened, closed in zip(opens.tolist(), closes.tolist()):
+            open_time = Event.datetime_from_timestamp(opened)
+            duration = Event.datetime_from_timestamp(closed) - open_time
+
+            if (opened, closed) in existing:
+                date_time, open_duration, door_id = existing[(opened, closed)]
+                if date_time != open_time:
+                    log.warning("Apparant, unexpected, change in Opening date_time")
+                if open_duration != duration:
+                    log.warning("Apparant, unexpected, change in Opening duration")
+                if door_id != door.id:
+                    log.warning("Apparant, unexpected, change in Opening door")
+
+                existing_openings += 1
+            else:
+                new_openings.append(cls(date_time=open_time,
+                                        duration=duration,
+                                        door=door,
+                                        open_event_id=opened,
+                                        close_event_id=closed))
+
+        with transaction.atomic():
+            cls.objects.bulk_create(new_openings, batch_size=batch_size)
+
+        if verbosity >= 2:
+            print(f"Processed {len(timestamps)} Open/Close events for door {door.id}.")
+
+        return len(timestamps), new_openings, existing_openings, orphans.tolist()
+
+    #########################################################################################
+    # Django Rich Views supports nuanced rendering of the object
+
+    def __str__(self):
+        '''
+        A basic default render. Should be on one line (contain no newlines, plain text.
+        '''
+        return f"{self.date_time} - Door {self.door_id} open for {humanize.precisedelta(self.duration, format='%0.1f')}"
+
+    def __rich_str__(self, link=None):
+        '''
+        A rich rendering which, should still be on one line (no newlines) but can contain hyperlinks
+
+        :param link: A django_rich_views.options.field_link_target
+        '''
+        opened = field_render("opened", link_target_url(self.open_event, link))
+        closed = field_render("closed", link_target_url(self.close_event, link))
+        visit = f" in {field_render('a visit', link_target_url(self.visit, link))}" if self.visit_id else ""
+        return f"{self.date_time} - Door {self.door_id} {opened} and {closed} {humanize.precisedelta(self.duration, format='%0.1f')} later{visit}"
@@ -0,0 +1,81 @@
+'''
+A sort-and-sweep engine for overlapping door openings.
+
+Openings are time spans on a door and a visit is a group of them. Sweeping the spans in order
+of their start time, keeping those still open in a heap ordered by end time, finds every overlap
+while only ever comparing a span with those still open when it starts. Accumulators are sparse,
+so the cost scales with the overlaps actually present, not with the number of doors.
+'''
+import heapq
+
+from collections import defaultdict
+from datetime import timedelta
+
+from Site.logutils import log
+
+
+def pairwise_overlaps(spans):
+    '''
+    Returns a dict keyed on (door_i, door_j) 2-tuples of the time door_i was open while door_j
+    already was (door_j opened before door_i, or at the same time but listed earlier). Only
+    pairs that overlapped are present.
+
+    :param spans: (start, end, door) 3-tuples in order of start
+    '''
+    overlaps = defaultdict(timedelta)
+    still_open = []  # A heap of (end, door) 2-tuples
+
+    for start, end, door in spans:
+        # Drop the spans that closed before this one opened
+        while still_open and still_open[0][0] <= start:
+            heapq.heappop(still_open)
+
+        for open_end, open_door in still_open:
+            overlaps[(door, open_door)] += min(open_end, end) - start
+
+        heapq.heappush(still_open, (end, door))
+
+    return dict(overlaps)
+
+
+def open_door_durations(spans, start=None, end=None):
+    '''
+    Returns a list of the time spent with 0, 1, 2 ... doors open at once, indexed on the number
+    of doors open, between start and end (defaulting to the first opening and last closing).
+
+    :param spans: (start, end, door) 3-tuples (in any order)
+    :param start: the start of the period of interest (a datetime)
+    :param end: the end of the period of interest (a datetime)
+    '''
+    if not spans:
+        return []
+
+    # Naive local times can run backwards (when daylight saving ends) and an opening then ends before it
+    # starts. We can't know how long it was open, so count it as open no time at all (else it would count
+    # fewer doors open than there are for a while, less than none at times).
+    inverted = [(s, e, d) for s, e, d in spans if e < s]
+    if inverted:
+        log.warning(f"Openings that end before they start counted as open no time: {inverted}")
+        spans = [(s, max(s, e), d) for s, e, d in spans]
+
+    changes = sorted([(s, 1) for s, e, d in spans] + [(e, -1) for s, e, d in spans])
+
+    time = changes[0][0] if start is None else start
+    end = changes[-1][0] if end is None else end
+
+    durations = defaultdict(timedelta)
+    doors_open = 0
+    for change_time, change in changes:
+        if change_time > time:
+            durations[doors_open] += change_time - time
+            time = change_time
+        doors_open += change
+
+    if end > time:
+        durations[doors_open] += end - time
+
+    # Nothing was open for any time at all
+    if not durations:
+        return []
+
+    return [durations[n] for n in range(max(durations) + 1)]
@@ -0,0 +1,83 @@
+'''
+A vectorized engine for pairing events, for rebuilding Openings and Uptimes from all the events of a door.
+
+Events are loaded as NumPy arrays of timestamps and states (True for Open or online, False for Closed
+or offline) and pairs are found with array operations rather than by stepping a state machine through
+them one by one. The pairing rules are those of the state machines in Opening.update_from_events and
+Uptime.update_from_events:
+
+    Open/Closed:     the last Open of a run of Opens and the first Closed of a run of Closeds pair,
+                     the other Opens (but for a trailing run) and Closeds are orphans.
+    online/offline:  the first online of a run of onlines and the first offline of a run of offlines
+                     pair, the others are ignored.
+
+Both machines start closed (down), and the states always alternate between runs, so every run of
+Closeds (offlines) but a leading one pairs with the run of Opens (onlines) before it.
+'''
+import numpy as np
+
+
+def runs(states):
+    '''
+    Returns an array of the indices at which each run of equal states starts.
+
+    :param states: a boolean NumPy array
+    '''
+    if len(states) == 0:
+        return np.empty(0, dtype=np.int64)
+    return np.concatenate(([0], np.flatnonzero(states[1:] != states[:-1]) + 1))
+
+
+def pair_door_contacts(timestamps, is_open):
+    '''
+    Pairs Open and Closed events. Returns the timestamps of the opening events, of the matching
+    closing events, and of the orphaned events (in time order) as three NumPy arrays.
+
+    :param timestamps: a NumPy array of event timestamps in time order
+    :param is_open: a boolean NumPy array, True for Open events and False for Closed
+    '''
+    if len(timestamps) == 0:
+        return timestamps, timestamps, timestamps
+
+    # A Closed that follows an Open pairs with it (as the first of a run of Closeds follows the last of a run of Opens)
+    paired = np.flatnonzero(~is_open[1:] & is_open[:-1]) + 1
+
+    # Opens followed by an Open, and Closeds not following an Open, are orphans
+    orphan_opens = is_open[:-1] & is_open[1:]
+    orphan_closes = ~is_open
+    orphan_closes[paired] = False
+    orphans = np.flatnonzero(np.concatenate((orphan_opens, [False])) | orphan_closes)
+
+    return timestamps[paired - 1], timestamps[paired], timestamps[orphans]
+
+
+def pair_updowns(timestamps, is_up):
+    '''
+    Pairs online and offline events. Returns the timestamps of the online events and of the
+    matching offline events as two NumPy arrays.
+
+    :param timestamps: a NumPy array of event timestamps in time order
+    :param is_up: a boolean NumPy array, True for online events and False for offline
+    '''
+    starts = runs(is_up)
+
+    # Every run of offlines but a leading one follows a run of onlines, and their first events pair
+    downs = starts[~is_up[starts]]
+    downs = downs[downs > 0]
+    ups = starts[np.searchsorted(starts, downs) - 1]
+
+    return timestamps[ups], timestamps[downs]
+
+
+def load(events, field, true_value, false_value):
+    '''
+    Loads the timestamps and states of events into NumPy arrays, skipping events with a state that
+    is neither true_value nor false_value (as the state machines ignore them).
+
+    :param events: a QuerySet of Events in time order
+    :param field: the field holding the state ("value" for Open/Closed, "type" for online/offline)
+    '''
+    rows = list(events.filter(**{f"{field}__in": (true_value, false_value)}).values_list("timestamp", field))
+    timestamps = np.fromiter((t for t, s in rows), dtype=np.int64, count=len(rows))
+    states = np.fromiter((s == true_value for t, s in rows), dtype=bool, count=len(rows))
+    return timestamps, states
@@ -0,0 +1,479 @@
+'''
+A pipeline that derives everything we derive from the events of a door in one pass.
+
+Openings, Uptimes, the door's battery charge and the pairing state of events are all derived from the
+events of a door, each from the events after its own checkpoint. Rather than each reading the events
+it needs in a query of its own, the pipeline reads the door's new events once, in one query, in time
+order, and dispatches each to the stages that take events with its code. All of it in one transaction.
+
+Stages record their state (see DerivationState) when done, the last event they processed and any pair
+they left open, and resume from it, so an update reads only new events and needs no lookback queries to
+find where to start.
+
+A stage is a subclass of Stage, and the stages run are pluggable (see STAGES). Each reports the time
+spent in it, so the cost of each derivation is known.
+'''
+import humanize
+
+from time import perf_counter
+
+from django.db import transaction
+from django.db.models import Q
+
+from .conf import BULK_BATCH_SIZE, UPTIME_CODE, PAIRING_PENDING
+from .derivation import DerivationState
+from .event import Event
+from .opening import Opening
+from .uptime import Uptime, UptimeSketch
+
+from Site.logutils import log
+
+
+class Stage:
+    '''
+    A stage of the pipeline, taking the events with one of its codes in time order.
+    '''
+    # A name to report the stage by
+    name = None
+
+    # The codes of the events the stage takes
+    codes = ()
+
+    # Whether the stage records its state (see DerivationState)
+    keeps_state = False
+
+    def __init__(self, door, rebuild=False, batch_size=BULK_BATCH_SIZE, verbosity=0):
+        '''
+        :param door: An instance of Door
+        :param rebuild: process all events (not just those after the stage's checkpoint)
+        :param batch_size: the number of rows to write per query
+        :param verbosity: Django manage.py argument for Verbosity level; 0=minimal output, 1=normal output, 2=verbose output, 3=very verbose output
+        '''
+        self.door = door
+        self.rebuild = rebuild
+        self.batch_size = batch_size
+        self.verbosity = verbosity
+        self.processed = 0
+        self.seconds = 0
+
+        # The recorded state of the stage, unless rebuilding (which starts afresh)
+        self.state = DerivationState.of(door, self.name) if self.keeps_state and not rebuild else None
+        self.through = self.state.through if self.state else None
+
+    def since(self, code):
+        '''
+        Returns the timestamp of the event after which the stage wants events with code (None for all).
+        '''
+        return None
+
+    def event(self, timestamp, code, type, value):
+        '''
+        Takes an event (as its timestamp, code, type and value).
+        '''
+        pass
+
+    def finish(self):
+        '''
+        Called after the last event, to write whatever the stage derived.
+        '''
+        pass
+
+    def record(self, **state):
+        '''
+        Records the state of the stage, the last event processed and whatever else the stage needs to
+        resume from it.
+        '''
+        if self.processed:
+            DerivationState.record(self.door, self.name, through=self.through, **state)
+
+    def summary(self):
+        '''
+        Returns a short description of what the stage derived, for reporting.
+        '''
+        return f"{self.processed} events"
+
+
+class OpeningPairer(Stage):
+    '''
+    Pairs Open and Closed events into Openings, as Opening.update_from_events_each does, holding the
+    Openings found in memory and creating them in bulk when done.
+    '''
+    name = "openings"
+    codes = ("doorcontact_state",)
+    keeps_state = True
+
+    def __init__(self, door, rebuild=False, batch_size=BULK_BATCH_SIZE, verbosity=0):
+        super().__init__(door, rebuild=rebuild, batch_size=batch_size, verbosity=verbosity)
+
+        # Resume with the door open if an Open was pending, else assume closed state from outset (see
+        # Opening.update_from_events_each)
+        self.opened = self.state.pending if self.state else None
+        self.is_open = self.opened is not None
+        self.existing = None
+        self.existing_openings = 0
+        self.new_openings = []
+        self.orphan_events = []
+        self.saved = False
+
+    def since(self, code):
+        if self.rebuild:
+            return None
+        if self.state:
+            return self.state.through
+        # With no state recorded, resume after the closing event of the last opening recorded (its id is its timestamp)
+        return Opening.objects.filter(door=self.door).order_by("-date_time").values_list("close_event_id", flat=True).first()
+
+    @property
+    def pending(self):
+        # The timestamp of the Open event awaiting a Closed (None if the door is closed)
+        return self.opened if self.is_open else None
+
+    def event(self, timestamp, code, type, value):
+        self.processed += 1
+        self.through = timestamp
+
+        # Openings already recorded from these events keyed on their (open_event, close_event) pair, in
+        # one query when the first event arrives. We only need those opened by this or a later event (or
+        # the pending Open), but include openings of any door to warn of unexpected changes of door as we go.
+        if self.existing is None:
+            first = min(timestamp, self.opened) if self.is_open else timestamp
+            self.existing = {(o, c): (t, d, door_id) for o, c, t, d, door_id in
+                             Opening.objects.filter(open_event_id__gte=first)
+                                            .values_list("open_event_id", "close_event_id", "date_time", "duration", "door_id")}
+
+        if self.verbosity >= 2:
+            print(f"\t{value:6} at {Event.datetime_from_timestamp(timestamp)}")
+
+        if value == "Open":
+            if self.is_open:
+                # Last Open of a bounce wins
+                self.orphan_events.append(self.opened)
+            self.opened = timestamp
+            self.is_open = True
+        elif value == "Closed":
+            if self.is_open:
+                self.is_open = False
+                open_time = Event.datetime_from_timestamp(self.opened)
+                duration = Event.datetime_from_timestamp(timestamp) - open_time
+
+                if (self.opened, timestamp) in self.existing:
+                    date_time, open_duration, door_id = self.existing[(self.opened, timestamp)]
+                    if date_time != open_time:
+                        log.warning("Apparant, unexpected, change in Opening date_time")
+                    if open_duration != duration:
+                        log.warning("Apparant, unexpected, change in Opening duration")
+                    if door_id != self.door.id:
+                        log.warning("Apparant, unexpected, change in Opening door")
+
+                    self.existing_openings += 1
+
+                    if self.verbosity >= 3:
+                        print(f"\t\tOpening already exists and has integrity.")
+                else:
+                    self.new_openings.append(Opening(date_time=open_time,
+                                                     duration=duration,
+                                                     door=self.door,
+                                                     open_event_id=self.opened,
+                                                     close_event_id=timestamp))
+
+                    if self.verbosity >= 3:
+                        print(f"\t\tOpening found. Door {self.door.id} opened at {open_time} for {humanize.precisedelta(duration,format='%0.1f')} ")
+            else:
+                # First Closed of a bounce wins, the rest are orphans
+                self.orphan_events.append(timestamp)
+
+    def save(self):
+        '''
+        Creates the new openings found, in batches.
+        '''
+        if not self.saved:
+            with transaction.atomic():
+                Opening.objects.bulk_create(self.new_openings, batch_size=self.batch_size)
+            self.saved = True
+
+    def finish(self):
+        self.save()
+        self.record(pending=self.pending)
+
+    def summary(self):
+        return f"{self.processed} events, {len(self.new_openings)} new openings, {self.existing_openings} existing, {len(self.orphan_events)} orphans"
+
+
+class UptimePairer(Stage):
+    '''
+    Pairs online and offline events into Uptimes, as Uptime.update_from_events_each does, creating them
+    in batches as they are found (Uptimes are our most numerous derived records, and only one batch of
+    them is ever in memory).
+    '''
+    name = "uptimes"
+    codes = (UPTIME_CODE,)
+    keeps_state = True
+
+    def __init__(self, door, rebuild=False, batch_size=BULK_BATCH_SIZE, verbosity=0):
+        super().__init__(door, rebuild=rebuild, batch_size=batch_size, verbosity=verbosity)
+
+        # Resume with the switch up if an online was pending, else assume switch is down at outset (see
+        # Uptime.update_from_events_each)
+        self.up_timestamp = self.state.pending if self.state else None
+        self.is_up = self.up_timestamp is not None
+        self.batch = []  # Paired (online timestamp, offline timestamp) 2-tuples
+        self.new_uptimes = 0
+        self.existing_uptimes = 0
+        self.first_new = None
+        self.last_new = None
+
+    def since(self, code):
+        if self.rebuild:
+            return None
+        if self.state:
+            return self.state.through
+        # With no state recorded, resume from the online event of the last uptime recorded (its id is its timestamp)
+        return Uptime.objects.filter(door=self.door).order_by("-date_time").values_list("online_event_id", flat=True).first()
+
+    @property
+    def pending(self):
+        # The timestamp of the online event awaiting an offline (None if the switch is down)
+        return self.up_timestamp if self.is_up else None
+
+    def event(self, timestamp, code, type, value):
+        self.processed += 1
+        self.through = timestamp
+
+        if self.verbosity >= 2:
+            print(f"\t{type:7} at {Event.datetime_from_timestamp(timestamp)}")
+
+        if type == "online":
+            # First online of a bounce wins
+            if not self.is_up:
+                self.up_timestamp = timestamp
+                self.is_up = True
+        elif type == "offline":
+            # First offline of a bounce wins
+            if self.is_up:
+                self.is_up = False
+                self.batch.append((self.up_timestamp, timestamp))
+
+                if len(self.batch) >= self.batch_size:
+                    self.save()
+
+    def save(self):
+        '''
+        Creates the uptimes in the batch that are not already recorded, in one query to find those that
+        are and one to insert the rest.
+        '''
+        if not self.batch:
+            return
+
+        # Uptimes already recorded from these online events (of any door, so we can warn of a change in door)
+        existing = {o: (c, t, d, door_id) for o, c, t, d, door_id in
+                    Uptime.objects.filter(online_event_id__in=[o for o, c in self.batch])
+                                  .values_list("online_event_id", "offline_event_id", "date_time", "duration", "door_id")}
+
+        uptimes = []
+        for online, offline in self.batch:
+            up_time = Event.datetime_from_timestamp(online)
+            up_duration = Event.datetime_from_timestamp(offline) - up_time
+
+            if online in existing and existing[online][0] == offline:
+                offline, date_time, duration, door_id = existing[online]
+                if date_time != up_time:
+                    log.warning("Apparant, unexpected, change in Uptime date_time")
+                if duration != up_duration:
+                    log.warning("Apparant, unexpected, change in Uptime duration")
+                if door_id != self.door.id:
+                    log.warning("Apparant, unexpected, change in Uptime door")
+
+                self.existing_uptimes += 1
+            else:
+                uptimes.append(Uptime(date_time=up_time,
+                                      duration=up_duration,
+                                      door=self.door,
+                                      online_event_id=online,
+                                      offline_event_id=offline))
+
+                if self.verbosity >= 3:
+                    print(f"\t\tUptime found. Door {self.door.id} switch went up at {up_time} for {humanize.precisedelta(up_duration,minimum_unit='microseconds',format='%0.1f')} ")
+
+        Uptime.objects.bulk_create(uptimes)
+
+        if uptimes:
+            self.new_uptimes += len(uptimes)
+            self.first_new = self.first_new or uptimes[0].date_time
+            self.last_new = uptimes[-1].date_time
+
+        self.batch = []
+
+    def finish(self):
+        self.save()
+        self.record(pending=self.pending)
+
+        # And add the new uptimes to the door's sketch (a rebuild can fill gaps, so rebuilds the sketch)
+        UptimeSketch.update(self.door, rebuild=self.rebuild)
+
+    def summary(self):
+        return f"{self.processed} events, {self.new_uptimes} new uptimes, {self.existing_uptimes} existing"
+
+
+class BatteryTracker(Stage):
+    '''
+    Tracks the battery charge of a door, recording the battery_state event at which it last changed
+    (see Door.battery_event).
+    '''
+    name = "battery"
+    codes = ("battery_state",)
+    keeps_state = True
+
+    def __init__(self, door, rebuild=False, batch_size=BULK_BATCH_SIZE, verbosity=0):
+        super().__init__(door, rebuild=rebuild, batch_size=batch_size, verbosity=verbosity)
+        self.charge = None
+        self.changed = None
+        self.changes = 0
+
+    def since(self, code):
+        if self.rebuild:
+            return None
+        if self.state:
+            return self.state.through
+        # With no state recorded, resume after the last change of charge (reports of the same charge are of no interest)
+        return self.door.battery_event_id
+
+    def event(self, timestamp, code, type, value):
+        self.processed += 1
+        self.through = timestamp
+
+        # The charge we have (only looked up when there is news of it)
+        if self.processed == 1 and not self.rebuild and self.door.battery_event_id is not None:
+            self.charge = Event.objects.filter(pk=self.door.battery_event_id).values_list("value", flat=True).first()
+
+        if value != self.charge:
+            self.charge = value
+            self.changed = timestamp
+            self.changes += 1
+
+            if self.verbosity >= 2:
+                print(f"\tBattery charge {value} at {Event.datetime_from_timestamp(timestamp)}")
+
+    def finish(self):
+        if self.changed is not None:
+            self.door.battery_event_id = self.changed
+            self.door.save(update_fields=["battery_event"])
+        self.record()
+
+    def summary(self):
+        return f"{self.processed} events, {self.changes} changes of charge"
+
+
+class OrphanFlagger(Stage):
+    '''
+    Updates the pairing state of events (see Event.update_pairing) that the pairers may have changed,
+    being those that were pending (new events are saved pending, and events paired or orphaned stay that
+    way). It reads no events, but must follow the pairers.
+    '''
+    name = "pairing"
+    codes = ()
+
+    # The codes of the events whose pairing state is maintained
+    paired_codes = ("doorcontact_state", UPTIME_CODE)
+
+    def __init__(self, door, rebuild=False, batch_size=BULK_BATCH_SIZE, verbosity=0):
+        super().__init__(door, rebuild=rebuild, batch_size=batch_size, verbosity=verbosity)
+        self.updated = 0
+
+    def finish(self):
+        for code in self.paired_codes:
+            events = Event.objects.filter(door=self.door, code=code)
+            if not self.rebuild:
+                events = events.filter(pairing=PAIRING_PENDING)
+            self.updated += Event.update_pairing(self.door, code, events)
+
+    def summary(self):
+        return f"{self.updated} pairing states updated"
+
+
+# The stages run by default, in order (the OrphanFlagger reads what the pairers write so must follow them)
+STAGES = [OpeningPairer, UptimePairer, BatteryTracker, OrphanFlagger]
+
+
+class Pipeline:
+    '''
+    Runs stages over the new events of a door, reading them once, in one query and one transaction.
+    '''
+
+    def __init__(self, door, stages=STAGES, rebuild=False, batch_size=BULK_BATCH_SIZE, verbosity=0):
+        '''
+        :param door: An instance of Door
+        :param stages: a list of the Stage classes to run, in order
+        :param rebuild: process all events (not just those after each stage's checkpoint)
+        :param batch_size: the number of events to read, and rows to write, per query
+        :param verbosity: Django manage.py argument for Verbosity level; 0=minimal output, 1=normal output, 2=verbose output, 3=very verbose output
+        '''
+        self.door = door
+        self.stages = [stage(door, rebuild=rebuild, batch_size=batch_size, verbosity=verbosity) for stage in stages]
+        self.batch_size = batch_size
+        self.verbosity = verbosity
+        self.processed = 0
+        self.seconds = 0
+
+    def events(self, since):
+        '''
+        Returns a QuerySet of the events of the door with the codes in since, after the timestamp since
+        holds for each code (or all of them if None), in time order.
+
+        :param since: a dict of timestamps (or None) keyed on code
+        '''
+        wanted = Q()
+        for code, timestamp in since.items():
+            wanted |= Q(code=code) if timestamp is None else Q(code=code, timestamp__gt=timestamp)
+        return Event.objects.filter(wanted, door=self.door).order_by("timestamp")
+
+    def run(self):
+        '''
+        Reads the new events of the door and dispatches each to the stages that take its code, then
+        finishes the stages in order. Returns a dict of the seconds spent in each stage keyed on its name
+        (and on "read" the seconds spent reading events).
+        '''
+        start = perf_counter()
+
+        with transaction.atomic():
+            # Each stage takes events with its codes after its own checkpoint, and the pipeline reads those
+            # after the earliest checkpoint of any stage for each code.
+            since = {}
+            for stage in self.stages:
+                began = perf_counter()
+                stage.checkpoints = {code: stage.since(code) for code in stage.codes}
+                stage.seconds += perf_counter() - began
+                for code, timestamp in stage.checkpoints.items():
+                    if code in since:
+                        since[code] = None if since[code] is None or timestamp is None else min(since[code], timestamp)
+                    else:
+                        since[code] = timestamp
+
+            if since:
+                events = self.events(since).values_list("timestamp", "code", "type", "value")
+
+                for timestamp, code, type, value in events.iterator(chunk_size=self.batch_size):
+                    self.processed += 1
+                    for stage in self.stages:
+                        if code in stage.checkpoints:
+                            checkpoint = stage.checkpoints[code]
+                            if checkpoint is None or timestamp > checkpoint:
+                                began = perf_counter()
+                                stage.event(timestamp, code, type, value)
+                                stage.seconds += perf_counter() - began
+
+            for stage in self.stages:
+                began = perf_counter()
+                stage.finish()
+                stage.seconds += perf_counter() - began
+
+        self.seconds = perf_counter() - start
+
+        timing = {stage.name: stage.seconds for stage in self.stages}
+        timing["read"] = self.seconds - sum(timing.values())
+
+        if self.verbosity >= 1:
+            print(f"Door {self.door.id}: Read {self.processed} events in {timing['read']:.3f} seconds.")
+            for stage in self.stages:
+                print(f"	{stage.name}: {stage.summary()} in {stage.seconds:.3f} seconds.")
+
+        return timing
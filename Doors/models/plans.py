@@ -0,0 +1,118 @@
+'''
+Query plan regression checks for the hot queries.
+
+The queries run most (on every fetch or page) all have an index designed to serve them (see
+HOT_INDEXES). Each is EXPLAINed and the plan is searched for sequential scans, and for the index,
+which is how a lost or unusable index shows itself (another index can serve a query, if worse, so
+the absence of sequential scans alone says little). PostgreSQL only, as the plans (and the indexes,
+some covering) are PostgreSQL's.
+
+Used by the explain_queries management command (against a large synthetic dataset) and the tests.
+'''
+import json
+
+from datetime import timedelta
+
+from django.db import connection
+from django.db.models import Q
+
+from .conf import UPTIME_CODE, PAIRING_ORPHAN, PAIRING_PENDING
+from .event import Event
+from .opening import Opening
+from .uptime import Uptime
+from .visit import Visit
+
+
+def hot_queries(door, timestamp):
+    '''
+    Returns a dict of the hot queries keyed on a name, as QuerySets that mirror the queries
+    the named methods issue.
+
+    :param door: A Door to query
+    :param timestamp: A Tuya timestamp to query from, near the end of the events, as incremental updates query the recent ones
+    '''
+    date_time = Event.datetime_from_timestamp(timestamp)
+    return {
+        "Event.last": Event.objects.filter(door=door, code="doorcontact_state").order_by("-timestamp")[:1],
+        "Event.neighbours (before)": Event.objects.filter(door=door, code="doorcontact_state", timestamp__lt=timestamp).order_by("-timestamp")[:1],
+        "Event.neighbours (after)": Event.objects.filter(door=door, code="doorcontact_state", timestamp__gt=timestamp).order_by("timestamp")[:1],
+        "Event.orphans": Event.objects.filter(code="doorcontact_state", pairing__in=(PAIRING_ORPHAN, PAIRING_PENDING)),
+        "Opening.update_from_events (resume)": Opening.objects.filter(door=door).order_by("-date_time").values_list("close_event_id", flat=True)[:1],
+        "Opening.update_from_events (events)": Event.objects.filter(door=door, code="doorcontact_state", timestamp__gt=timestamp).order_by("timestamp").values_list("timestamp", "value"),
+        "Uptime.update_from_events (resume)": Uptime.objects.filter(door=door).order_by("-date_time").values_list("online_event_id", flat=True)[:1],
+        "Uptime.update_from_events (events)": Event.objects.filter(door=door, code=UPTIME_CODE, timestamp__gt=timestamp).order_by("timestamp").values_list("timestamp", "type"),
+        "Opening.previous": Opening.objects.filter(Q(date_time__lt=date_time) | Q(date_time=date_time, id__lt=0), door=door, date_time__lte=date_time).order_by("-date_time", "-id")[:1],
+        "Visit.update_from_openings (resume)": Opening.objects.filter(visit__isnull=True).order_by("date_time").values_list("date_time", flat=True)[:1],
+        "Visit.update_from_openings (openings)": Opening.objects.filter(date_time__gte=date_time).order_by("date_time"),
+        "Visit.update_from_openings (visits)": Visit.objects.filter(date_time__gte=date_time - timedelta(days=1)).order_by("date_time"),
+    }
+
+
+# The index designed to serve each of the hot queries (see hot_queries)
+HOT_INDEXES = {"Event.last": "event_door_code_time",
+               "Event.neighbours (before)": "event_door_code_time",
+               "Event.neighbours (after)": "event_door_code_time",
+               "Event.orphans": "event_pairing",
+               "Opening.update_from_events (resume)": "opening_door_time",
+               "Opening.update_from_events (events)": "event_door_code_time",
+               "Uptime.update_from_events (resume)": "uptime_door_time",
+               "Uptime.update_from_events (events)": "event_door_code_time",
+               "Opening.previous": "opening_door_time",
+               "Visit.update_from_openings (resume)": "opening_unvisited",
+               "Visit.update_from_openings (openings)": "opening_time",
+               "Visit.update_from_openings (visits)": "visit_time"}
+
+
+def plan_nodes(plan):
+    '''
+    A generator of all the nodes in a PostgreSQL JSON format query plan (a tree of nodes).
+    '''
+    yield plan
+    for child in plan.get("Plans", []):
+        yield from plan_nodes(child)
+
+
+def explain(queryset):
+    '''
+    Returns the PostgreSQL plan of a QuerySet (the root node of its JSON format EXPLAIN).
+    '''
+    plan = queryset.explain(format="json")
+    return json.loads(plan)[0]["Plan"]
+
+
+def seq_scans(queryset):
+    '''
+    Returns a list of the relations (tables) the plan of a QuerySet scans sequentially.
+    '''
+    return [node.get("Relation Name") for node in plan_nodes(explain(queryset)) if node["Node Type"] == "Seq Scan"]
+
+
+def check_plans(door, timestamp, verbosity=0):
+    '''
+    EXPLAINs each of the hot queries and returns a dict keyed on the name of those whose plan
+    includes a sequential scan, or does not use the index designed to serve it (see HOT_INDEXES),
+    of a list of the problems found.
+
+    :param door: A Door to query
+    :param timestamp: A Tuya timestamp to query around
+    :param verbosity: Django manage.py argument for Verbosity level; 0=minimal output, 1=normal output, 2=verbose output, 3=very verbose output
+    '''
+    if connection.vendor != "postgresql":
+        raise NotImplementedError("Query plans are only checked on PostgreSQL.")
+
+    failures = {}
+    for name, queryset in hot_queries(door, timestamp).items():
+        nodes = list(plan_nodes(explain(queryset)))
+
+        problems = [f"sequential scan of {node.get('Relation Name')}" for node in nodes if node["Node Type"] == "Seq Scan"]
+        if not any(node.get("Index Name") == HOT_INDEXES[name] for node in nodes):
+            problems.append(f"{HOT_INDEXES[name]} not used")
+        if problems:
+            failures[name] = problems
+
+        if verbosity >= 1:
+            print(f"{name}: {', '.join(problems) if problems else 'OK'}")
+        if verbosity >= 2:
+            print(f"\t{[node['Node Type'] + (' on ' + node['Index Name'] if 'Index Name' in node else '') for node in nodes]}")
+
+    return failures
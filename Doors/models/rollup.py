@@ -0,0 +1,318 @@
+'''
+Daily rollups of activity on each door, so that the Trends histograms and summaries can be presented
+over any range of dates in time proportional to the days in it, not to the Visits and Openings in it.
+
+A rollup holds, for one door on one day, the openings of the door (their count, total time open and the
+first and last activity), the visits and the battery state last reported. And the distributions the Trends
+histograms draw on, as counts by category (the hour a visit started, the duration of visits and of openings
+in DURATION_CATEGORIES, the quiet time before visits in QUIET_CATEGORIES, the openings and distinct doors in
+visits, and the time spent in visits with 0, 1, 2 ... doors open). A visit is rolled up on the day it started and the door first opened in it, so that the visits of
+all doors sum to the visits of the library.
+
+Rollups are derived from Openings and Visits (and battery_state Events) and recomputed a range of days at a
+time, by fetch_logs for the days a fetch touched. The all-time histograms of the Trends page are summed from
+them (see Histogram.refresh).
+'''
+import calendar
+
+from isodate import parse_duration
+
+from collections import Counter
+from datetime import datetime, time, timedelta
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models.functions import TruncDate, ExtractHour, Coalesce
+from django.db.models import Count, Sum, Min, Max, F, OuterRef, Subquery, ExpressionWrapper, DateTimeField
+from django.db import models, transaction
+
+from .conf import BATTERY_STATES, BULK_BATCH_SIZE
+from .functions import DurationBucket
+from .door import Door
+from .event import Event
+from .opening import Opening
+from .visit import Visit
+from .histogram import DURATION_CATEGORIES, QUIET_CATEGORIES
+
+# The histograms of the Trends page that rollups answer, as (model, htype, categories) 3-tuples as they
+# appear in TRENDS_HISTOGRAMS (see Doors.models.histogram)
+ROLLUP_HISTOGRAMS = [(Visit, "per_days", None),
+                     (Visit, "day", None),
+                     (Visit, "week", None),
+                     (Visit, "month", None),
+                     (Visit, "year", "months"),
+                     (Visit, "year", "weeks"),
+                     (Visit, "durations", DURATION_CATEGORIES),
+                     (Visit, "quiet_times", QUIET_CATEGORIES),
+                     (Visit, "doors_per_visit_total", None),
+                     (Visit, "doors_per_visit_unique", None),
+                     (Visit, "opens_per_door", None),
+                     (Visit, "overlap_durations", None),
+                     (Opening, "durations", DURATION_CATEGORIES)]
+
+
+def duration_label(width, i):
+    # The label of a duration category, in minutes and seconds (as Visit.histogram and Opening.histogram label them)
+    def label(i):
+        mins, secs = divmod(round((i * width).total_seconds()), 60)
+        return f"{mins}:{secs:02d}"
+
+    return f"{label(i)}-{label(i + 1)}"
+
+
+def quiet_label(width, i):
+    # The label of a quiet time category, in hours and minutes (as Visit.histogram labels them)
+    def label(i):
+        mins = round((i * width).total_seconds()) // 60
+        hours, mins = divmod(mins, 60)
+        return f"{hours}:{mins:02d}"
+
+    return f"{label(i)}-{label(i + 1)}"
+
+
+def within(field, start=None, end=None):
+    '''
+    Returns filter arguments selecting times in field on the days from start to end inclusive (either
+    can be None, for no bound).
+    '''
+    bounds = {}
+    if start is not None:
+        bounds[f"{field}__gte"] = datetime.combine(start, time())
+    if end is not None:
+        bounds[f"{field}__lt"] = datetime.combine(end + timedelta(days=1), time())
+    return bounds
+
+
+def describe(start=None, end=None):
+    if start is None and end is None:
+        return "all days"
+    return f"{start or 'the first day'} to {end or 'the last day'}"
+
+
+class DailyRollup(models.Model):
+    '''
+    The activity on a door on a day (see Doors.models.rollup).
+
+    Keyed on door and date. The distributions are a dict of counts keyed on category (as a string, JSON
+    having only string keys) in a dict keyed on name: visit_hours, visit_durations, quiet_times,
+    openings_per_visit, doors_per_visit and opening_durations. And doors_open, which holds not counts
+    but the microseconds spent in visits with each number of doors open.
+    '''
+    door = models.ForeignKey('Door', related_name='daily_rollups', on_delete=models.CASCADE)
+    date = models.DateField('Date')
+
+    openings = models.IntegerField('Openings', default=0)
+    open_time = models.DurationField('Time open', default=timedelta)
+    first_activity = models.DateTimeField('First activity', null=True)  # The start of the first opening
+    last_activity = models.DateTimeField('Last activity', null=True)  # The end of the last opening
+
+    visits = models.IntegerField('Visits', default=0)  # Visits started with the door
+    visits_opened = models.IntegerField('Visits opening the door', default=0)  # Visits the door was opened in
+
+    battery = models.CharField('Battery state', max_length=64, null=True)  # The battery state last reported
+
+    distributions = models.JSONField('Distributions', default=dict, encoder=DjangoJSONEncoder)
+
+    class Meta:
+        # Rollups are read by date range across all doors
+        constraints = [models.UniqueConstraint(fields=['door', 'date'], name='unique_daily_rollup')]
+        indexes = [models.Index(fields=['date'], name='rollup_date')]
+
+    @classmethod
+    def compute(cls, start=None, end=None):
+        '''
+        Returns the rollups of the days from start to end inclusive (None for no bound) as a dict of unsaved
+        DailyRollups keyed on (door ID, date), for the doors and days that saw activity. In a fixed number
+        of queries, the openings and visits aggregated in the database.
+
+        :param start: the first day (a date)
+        :param end: the last day (a date)
+        '''
+        rollups = {}
+
+        def rollup(door_id, day):
+            key = (door_id, day)
+            if key not in rollups:
+                rollups[key] = cls(door_id=door_id, date=day, distributions={})
+            return rollups[key]
+
+        def tally(rollup, name, category, count=1):
+            counts = rollup.distributions.setdefault(name, {})
+            counts[str(category)] = counts.get(str(category), 0) + count
+
+        openings = Opening.objects.filter(**within("date_time", start, end)).annotate(day=TruncDate("date_time"))
+        end_time = ExpressionWrapper(F("date_time") + F("duration"), output_field=DateTimeField())
+        for o in openings.values("door_id", "day").annotate(count=Count("id"), total=Sum("duration"), first=Min("date_time"), last=Max(end_time)):
+            r = rollup(o["door_id"], o["day"])
+            r.openings = o["count"]
+            r.open_time = o["total"]
+            r.first_activity = o["first"]
+            r.last_activity = o["last"]
+
+        for o in openings.annotate(category=DurationBucket("duration", DURATION_CATEGORIES)).values("door_id", "day", "category").annotate(count=Count("id")):
+            tally(rollup(o["door_id"], o["day"]), "opening_durations", o["category"], o["count"])
+
+        # The door first opened in each visit, and the openings and distinct doors in it
+        in_visit = Opening.objects.filter(visit=OuterRef('pk'))
+        first_door = Subquery(in_visit.order_by("date_time", "id").values("door_id")[:1])
+        openings_in = Coalesce(Subquery(in_visit.values('visit').annotate(count=Count('id')).values('count')), 0)
+        doors_in = Coalesce(Subquery(in_visit.values('visit').annotate(count=Count('door', distinct=True)).values('count')), 0)
+
+        visits = (Visit.objects.filter(**within("date_time", start, end))
+                  .annotate(day=TruncDate("date_time"), hour=ExtractHour("date_time"), first_door=first_door, openings_in=openings_in, doors_in=doors_in,
+                            duration_category=DurationBucket("duration", DURATION_CATEGORIES), quiet_category=DurationBucket("prior_quiet", QUIET_CATEGORIES))
+                  .values_list("first_door", "day", "hour", "duration_category", "prior_quiet", "quiet_category", "openings_in", "doors_in", "doors_open"))
+
+        for door_id, day, hour, duration_category, prior_quiet, quiet_category, openings_in, doors_in, doors_open in visits:
+            # A visit with no openings has no door to be rolled up on
+            if door_id is None:
+                continue
+
+            r = rollup(door_id, day)
+            r.visits += 1
+            tally(r, "visit_hours", hour)
+            tally(r, "visit_durations", duration_category)
+            # Quiet times over a day are outliers (missing data) and ignored, as Visit.histogram has it
+            if prior_quiet <= timedelta(days=1):
+                tally(r, "quiet_times", quiet_category)
+            tally(r, "openings_per_visit", openings_in)
+            tally(r, "doors_per_visit", doors_in)
+            for n, d in enumerate(doors_open or []):
+                tally(r, "doors_open", n, parse_duration(d) // timedelta(microseconds=1))
+
+        opened = Opening.objects.filter(**within("visit__date_time", start, end)).annotate(day=TruncDate("visit__date_time"))
+        for o in opened.values("door_id", "day").annotate(count=Count("visit", distinct=True)):
+            rollup(o["door_id"], o["day"]).visits_opened = o["count"]
+
+        # The battery state last reported on each day
+        batteries = Event.objects.filter(code="battery_state", value__in=BATTERY_STATES)
+        if start is not None:
+            batteries = batteries.filter(timestamp__gte=Event.timestamp_from_datetime(datetime.combine(start, time())))
+        if end is not None:
+            batteries = batteries.filter(timestamp__lt=Event.timestamp_from_datetime(datetime.combine(end + timedelta(days=1), time())))
+        for door_id, timestamp, value in batteries.order_by("timestamp").values_list("door_id", "timestamp", "value").iterator():
+            rollup(door_id, Event.datetime_from_timestamp(timestamp).date()).battery = value
+
+        return rollups
+
+    @classmethod
+    def update(cls, start=None, end=None, verbosity=0):
+        '''
+        Recomputes the rollups of the days from start to end inclusive (all days if neither is given).
+        Returns the number of rollups saved.
+
+        :param start: the first day (a date), None for the first day there is
+        :param end: the last day (a date), None for the last day there is
+        :param verbosity: Django manage.py argument for Verbosity level; 0=minimal output, 1=normal output, 2=verbose output, 3=very verbose output
+        '''
+        rollups = cls.compute(start, end)
+
+        with transaction.atomic():
+            stale = cls.objects.all()
+            if start is not None:
+                stale = stale.filter(date__gte=start)
+            if end is not None:
+                stale = stale.filter(date__lte=end)
+            stale.delete()
+            cls.objects.bulk_create(rollups.values(), batch_size=BULK_BATCH_SIZE)
+
+        if verbosity >= 1:
+            print(f"Rolled up {len(rollups)} door days for {describe(start, end)}.")
+
+        return len(rollups)
+
+    @classmethod
+    def touched(cls, fetch):
+        '''
+        Returns the first and last days (a 2-tuple of dates) whose rollups a fetch of logs may have changed,
+        or None if it saved no events. Being the days of the events it saved, widened by a day either
+        side, as Visit.update_from_openings looks back a day for visits that new openings join, and a new
+        visit changes the quiet time before the next one (which is only rolled up if within a day).
+
+        :param fetch: a DataFetch
+        '''
+        span = fetch.events.aggregate(first=Min("timestamp"), last=Max("timestamp"))
+        if span["first"] is None:
+            return None
+
+        return (Event.datetime_from_timestamp(span["first"]).date() - timedelta(days=1),
+                Event.datetime_from_timestamp(span["last"]).date() + timedelta(days=1))
+
+    @classmethod
+    def cover_all_days(cls):
+        '''
+        Returns True if the rollups reach back to the first Opening (as they do once rolled up for all days,
+        see update_rollups) and so answer the all-time histograms. In two queries, on indexes.
+        '''
+        first_opening = Opening.objects.order_by("date_time").values_list("date_time", flat=True).first()
+        if first_opening is None:
+            return True
+
+        first_rollup = cls.objects.order_by("date").values_list("date", flat=True).first()
+        return first_rollup is not None and first_rollup <= first_opening.date()
+
+    @classmethod
+    def in_range(cls, start=None, end=None):
+        rollups = cls.objects.all()
+        if start is not None:
+            rollups = rollups.filter(date__gte=start)
+        if end is not None:
+            rollups = rollups.filter(date__lte=end)
+        return rollups
+
+    @classmethod
+    def summary(cls, start=None, end=None):
+        '''
+        Returns a dict summarising the days from start to end inclusive: openings, open_time, visits,
+        first_activity, last_activity and days (with activity). In one query.
+
+        :param start: the first day (a date), None for the first day there is
+        :param end: the last day (a date), None for the last day there is
+        '''
+        return cls.in_range(start, end).aggregate(openings=Coalesce(Sum("openings"), 0), open_time=Sum("open_time"), visits=Coalesce(Sum("visits"), 0),
+                                                  first_activity=Min("first_activity"), last_activity=Max("last_activity"),
+                                                  days=Count("date", distinct=True))
+
+    @classmethod
+    def histograms(cls, start=None, end=None):
+        '''
+        Returns the Trends histograms (see ROLLUP_HISTOGRAMS) over the days from start to end inclusive,
+        in the form Histogram.all() returns them (a dict of histograms, each a dict of counts keyed on
+        category, keyed on (model, htype, categories)). From the rollups of those days, in one query (and
+        one for the doors).
+
+        :param start: the first day (a date), None for the first day there is
+        :param end: the last day (a date), None for the last day there is
+        '''
+        per_day = Counter()
+        weekdays, monthdays, months, weeks = Counter(), Counter(), Counter(), Counter()
+        opened = Counter()
+        distributions = {name: Counter() for name in ("visit_hours", "visit_durations", "quiet_times", "openings_per_visit", "doors_per_visit", "doors_open", "opening_durations")}
+
+        for door_id, day, visits, visits_opened, counts in cls.in_range(start, end).values_list("door_id", "date", "visits", "visits_opened", "distributions"):
+            if visits:
+                per_day[day] += visits
+                weekdays[day.isoweekday()] += visits
+                monthdays[day.day] += visits
+                months[day.month] += visits
+                weeks[day.isocalendar()[1]] += visits
+            opened[door_id] += visits_opened
+            for name, categories in counts.items():
+                for category, count in categories.items():
+                    distributions[name][int(category)] += count
+
+        quiet = distributions["quiet_times"]
+        doors_open = distributions["doors_open"]
+
+        return {(Visit, "per_days", None): dict(sorted(Counter(count for count in per_day.values() if count).items())),
+                (Visit, "day", None): {f"{h}-{h+1 if h < 24 else 1}": distributions["visit_hours"][h] for h in range(25)},
+                (Visit, "week", None): {calendar.day_name[d]: weekdays[d + 1] for d in range(7)},
+                (Visit, "month", None): {str(d): monthdays[d] for d in range(1, 32)},
+                (Visit, "year", "months"): {calendar.month_name[m]: months[m] for m in range(1, 13)},
+                (Visit, "year", "weeks"): {str(w): weeks[w] for w in range(1, 53 if 53 not in weeks else 54)},
+                (Visit, "durations", DURATION_CATEGORIES): {duration_label(DURATION_CATEGORIES, c): n for c, n in sorted(distributions["visit_durations"].items())},
+                (Visit, "quiet_times", QUIET_CATEGORIES): {quiet_label(QUIET_CATEGORIES, c): quiet[c] for c in range(max(quiet) + 1)} if quiet else {},
+                (Visit, "doors_per_visit_total", None): dict(sorted(distributions["openings_per_visit"].items())),
+                (Visit, "doors_per_visit_unique", None): dict(sorted(distributions["doors_per_visit"].items())),
+                (Visit, "opens_per_door", None): {f"Door {d}": opened[d] for d in Door.ids},
+                (Visit, "overlap_durations", None): {f"{n} open": round(timedelta(microseconds=doors_open[n]).total_seconds() / 60) for n in range(max(doors_open) + 1)} if doors_open else {},
+                (Opening, "durations", DURATION_CATEGORIES): {duration_label(DURATION_CATEGORIES, c): n for c, n in sorted(distributions["opening_durations"].items())}}
@@ -0,0 +1,61 @@
+'''
+A vectorized engine for segmenting openings into visits at many thresholds at once, for exploring
+how visits depend on the gap that separates them (VISIT_SEPARATION) without rebuilding Visits.
+
+Openings are loaded as NumPy arrays of start and end times (in time order) and doors. The gap before
+each opening (bar the first) is its start less the end of the opening before it, and a visit starts
+at every gap longer than the threshold, as Visit.segment has it. The gaps are computed once, and the
+visit count at every threshold is found in one sort and search. The visits at a threshold are found
+from the gaps with array operations, without a Python loop over openings.
+'''
+import numpy as np
+
+
+def opening_gaps(starts, ends):
+    '''
+    Returns the gap before each opening bar the first, as a NumPy array.
+
+    :param starts: a NumPy array of the start times of openings in time order
+    :param ends: a NumPy array of their end times
+    '''
+    return starts[1:] - ends[:-1]
+
+
+def visit_counts(gaps, thresholds):
+    '''
+    Returns the number of visits at each threshold as a NumPy array (one more than the gaps longer than
+    the threshold), given at least one opening.
+
+    :param gaps: a NumPy array of the gaps between openings (see opening_gaps)
+    :param thresholds: a NumPy array of thresholds (of the same type as gaps)
+    '''
+    return len(gaps) + 1 - np.searchsorted(np.sort(gaps), thresholds, side="right")
+
+
+def visit_starts(gaps, threshold):
+    '''
+    Returns the indices of the openings that start a visit at threshold, as a NumPy array.
+
+    :param gaps: a NumPy array of the gaps between openings (see opening_gaps)
+    :param threshold: the gap between openings that separates visits
+    '''
+    return np.concatenate(([0], np.flatnonzero(gaps > threshold) + 1))
+
+
+def visit_measures(starts, ends, doors, firsts):
+    '''
+    Returns the durations of visits, the number of openings in each and the number of distinct doors
+    opened in each as three NumPy arrays.
+
+    :param starts: a NumPy array of the start times of openings in time order
+    :param ends: a NumPy array of their end times
+    :param doors: a NumPy array of their door IDs
+    :param firsts: a NumPy array of the indices of the openings that start visits (see visit_starts)
+    '''
+    lasts = np.append(firsts[1:], len(starts)) - 1
+    durations = ends[lasts] - starts[firsts]
+    openings = lasts - firsts + 1
+    unique = np.zeros(len(firsts), dtype=np.int64)
+    for door in np.unique(doors):
+        unique += np.add.reduceat(doors == door, firsts) > 0
+    return durations, openings, unique
@@ -0,0 +1,303 @@
+'''
+Zero downtime rebuilds of the data derived from events: Openings, Uptimes and Visits.
+
+The update_* commands rebuild (-R) by deleting every row and recreating them, and readers see the
+tables empty or half built until they are done. Instead the derived tables can be rebuilt into shadow
+tables (copies of the structure of the live tables, indexes and all), written in bulk, validated against
+the live tables (row counts and checksums) and swapped in, in one short transaction. Readers see the old
+data until the swap commits and the new data after it, and the swap waits only on locks, not on the build.
+
+PostgreSQL only, as the shadow tables are built and swapped with PostgreSQL's DDL (which is
+transactional) and catalog.
+
+Used by the rebuild_derived management command.
+'''
+import re
+
+from django.db import connection, transaction
+
+from .conf import UPTIME_CODE, BULK_BATCH_SIZE
+from .pairing import load, pair_door_contacts, pair_updowns
+from .door import Door
+from .event import Event
+from .opening import Opening
+from .uptime import Uptime, UptimeSketch
+from .visit import Visit, VISITS_STAGE
+from .derivation import DerivationState
+from .pipeline import Pipeline, OpeningPairer, UptimePairer, OrphanFlagger
+
+# The models rebuilt, in the order their tables are written (Openings refer to Visits)
+MODELS = [Visit, Opening, Uptime]
+
+
+def shadow_table(model):
+    '''
+    Returns the name of the shadow table of model.
+    '''
+    return f"{model._meta.db_table}_shadow"
+
+
+def checksum_sql(model, table, visits):
+    '''
+    Returns SQL for the row count and a checksum of the table of model (the live or shadow table), with
+    visits the name of the Visit table its openings refer to. The checksum is a sum of hashes of the
+    rows, so it is independent of row order, and covers the derived content not the ids (which a rebuild
+    renumbers). Openings are checked with the start of their visit, in place of its id.
+    '''
+    qn = connection.ops.quote_name
+    if model is Visit:
+        columns = "r.date_time, r.duration, r.prior_quiet, r.doors, r.overlaps, r.doors_open"
+        join = ""
+    elif model is Opening:
+        columns = "r.door_id, r.open_event_id, r.close_event_id, r.date_time, r.duration, v.date_time"
+        join = f"LEFT JOIN {qn(visits)} v ON v.id = r.visit_id"
+    else:
+        columns = "r.door_id, r.online_event_id, r.offline_event_id, r.date_time, r.duration"
+        join = ""
+
+    return (f"SELECT count(*), coalesce(sum(('x' || left(md5(ROW({columns})::text), 15))::bit(60)::bigint), 0) "
+            f"FROM {qn(table)} r {join}")
+
+
+def checksums(cursor, shadow=False):
+    '''
+    Returns a dict of (row count, checksum) 2-tuples keyed on model, of the live tables (or shadow tables).
+    '''
+    def table(model):
+        return shadow_table(model) if shadow else model._meta.db_table
+
+    result = {}
+    for model in MODELS:
+        cursor.execute(checksum_sql(model, table(model), table(Visit)))
+        count, checksum = cursor.fetchone()
+        result[model] = (count, int(checksum))
+    return result
+
+
+def insert(cursor, model, table, objects, pk=False, batch_size=BULK_BATCH_SIZE):
+    '''
+    Inserts unsaved instances of model into table, batch_size rows per query. The values are prepared for
+    the database by the model's fields, as Django prepares them for its own queries.
+
+    :param pk: insert the primary keys the objects have (else the database assigns them)
+    '''
+    qn = connection.ops.quote_name
+    fields = [f for f in model._meta.concrete_fields if pk or not f.primary_key]
+    columns = ", ".join(qn(f.column) for f in fields)
+    row = f"({', '.join(['%s'] * len(fields))})"
+
+    for start in range(0, len(objects), batch_size):
+        batch = objects[start:start + batch_size]
+        params = [f.get_db_prep_save(getattr(obj, f.attname), connection) for obj in batch for f in fields]
+        cursor.execute(f"INSERT INTO {qn(table)} ({columns}) VALUES {', '.join([row] * len(batch))}", params)
+
+
+def indexes(cursor, table):
+    '''
+    Returns a list of (definition, name) 2-tuples of the indexes on table, the definition being the
+    index's definition without its name or table (so that an index and its copy on another table match).
+    '''
+    cursor.execute("SELECT indexname, indexdef FROM pg_indexes WHERE schemaname = current_schema() AND tablename = %s ORDER BY indexname", [table])
+    return [(re.sub(r"^CREATE (UNIQUE )?INDEX \S+ ON \S+ ", r"\1", definition), name) for name, definition in cursor.fetchall()]
+
+
+def sequence(cursor, table):
+    '''
+    Returns the name of the sequence that generates ids for table (its identity column).
+    '''
+    cursor.execute("SELECT relname FROM pg_class WHERE oid = pg_get_serial_sequence(%s, 'id')::regclass", [connection.ops.quote_name(table)])
+    return cursor.fetchone()[0]
+
+
+def foreign_keys(cursor, referencing=None, referenced=None, exclude=()):
+    '''
+    Returns a list of (table, name, definition) 3-tuples of foreign key constraints on table referencing
+    (or on any table bar those in exclude) that reference table referenced (or any table).
+    '''
+    qn = connection.ops.quote_name
+    sql = "SELECT conrelid::regclass::text, conname, pg_get_constraintdef(oid) FROM pg_constraint WHERE contype = 'f'"
+    params = []
+    if referencing:
+        sql += " AND conrelid = %s::regclass"
+        params.append(qn(referencing))
+    if referenced:
+        sql += " AND confrelid = %s::regclass"
+        params.append(qn(referenced))
+    if exclude:
+        sql += " AND NOT conrelid = ANY(%s::regclass[])"
+        params.append([qn(t) for t in exclude])
+    cursor.execute(sql + " ORDER BY conname", params)
+    return cursor.fetchall()
+
+
+def drop_shadows(cursor):
+    qn = connection.ops.quote_name
+    cursor.execute(f"DROP TABLE IF EXISTS {', '.join(qn(shadow_table(m)) for m in MODELS)} CASCADE")
+
+
+def build(batch_size=BULK_BATCH_SIZE, verbosity=0):
+    '''
+    Builds the shadow tables from all events, in one transaction, leaving the live tables untouched.
+
+    Openings and Uptimes are paired with the vectorized engine (see Doors.models.pairing) and Visits
+    grouped from the Openings (see Visit.segment) in memory, then all are written in bulk. The shadow
+    tables are created without foreign keys, which are added (and checked) once they're full.
+
+    :param batch_size: the number of rows to write per query
+    :param verbosity: Django manage.py argument for Verbosity level; 0=minimal output, 1=normal output, 2=verbose output, 3=very verbose output
+    '''
+    qn = connection.ops.quote_name
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        drop_shadows(cursor)
+        for model in MODELS:
+            cursor.execute(f"CREATE TABLE {qn(shadow_table(model))} (LIKE {qn(model._meta.db_table)} INCLUDING ALL)")
+
+        openings = []
+        for door in Door.objects.all():
+            events = Event.objects.filter(door=door, code="doorcontact_state").order_by("timestamp")
+            opens, closes, orphans = pair_door_contacts(*load(events, "value", "Open", "Closed"))
+            for opened, closed in zip(opens.tolist(), closes.tolist()):
+                open_time = Event.datetime_from_timestamp(opened)
+                openings.append(Opening(date_time=open_time,
+                                        duration=Event.datetime_from_timestamp(closed) - open_time,
+                                        door_id=door.id,
+                                        open_event_id=opened,
+                                        close_event_id=closed))
+
+            events = Event.objects.filter(door=door, code=UPTIME_CODE).order_by("timestamp")
+            ups, downs = pair_updowns(*load(events, "type", "online", "offline"))
+            uptimes = []
+            for online, offline in zip(ups.tolist(), downs.tolist()):
+                up_time = Event.datetime_from_timestamp(online)
+                uptimes.append(Uptime(date_time=up_time,
+                                      duration=Event.datetime_from_timestamp(offline) - up_time,
+                                      door_id=door.id,
+                                      online_event_id=online,
+                                      offline_event_id=offline))
+            insert(cursor, Uptime, shadow_table(Uptime), uptimes, batch_size=batch_size)
+
+            if verbosity >= 2:
+                print(f"Paired {len(opens)} openings and {len(uptimes)} uptimes on door {door.id}.")
+
+        # Visits are numbered as they're built, so that their openings can refer to them
+        openings.sort(key=lambda opening: opening.date_time)
+        visits = []
+        for number, (visit_openings, prior_quiet) in enumerate(Visit.segment(openings), 1):
+            start = visit_openings[0].date_time
+            end = visit_openings[-1].end_time
+            visit = Visit(id=number, date_time=start, duration=end - start, prior_quiet=prior_quiet)
+            visit.doors, visit.overlaps, visit.doors_open = Visit.overlaps_of(visit_openings, start, end)
+            visits.append(visit)
+            for opening in visit_openings:
+                opening.visit_id = number
+
+        insert(cursor, Visit, shadow_table(Visit), visits, pk=True, batch_size=batch_size)
+        cursor.execute(f"ALTER TABLE {qn(shadow_table(Visit))} ALTER COLUMN id RESTART WITH {len(visits) + 1}")
+        insert(cursor, Opening, shadow_table(Opening), openings, batch_size=batch_size)
+
+        # The foreign keys of the live tables, with those between them pointed at the shadow tables
+        for model in MODELS:
+            for table, name, definition in foreign_keys(cursor, referencing=model._meta.db_table):
+                for other in MODELS:
+                    definition = definition.replace(f"REFERENCES {qn(other._meta.db_table)}(", f"REFERENCES {qn(shadow_table(other))}(")
+                cursor.execute(f"ALTER TABLE {qn(shadow_table(model))} ADD CONSTRAINT {qn(name)} {definition}")
+
+    if verbosity >= 1:
+        print(f"Built {len(visits)} visits from {len(openings)} openings in the shadow tables.")
+
+
+def swap(verbosity=0):
+    '''
+    Swaps the shadow tables in for the live tables, in one transaction, and drops the live tables. The
+    shadow tables take the names of the live tables, their indexes and their id sequences, and foreign keys
+    from other tables to the live tables are moved to them.
+
+    The recorded states of the stages deriving them (see DerivationState) are forgotten, so the next update
+    resumes from the data swapped in.
+    '''
+    qn = connection.ops.quote_name
+    live = [model._meta.db_table for model in MODELS]
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        # The stages record the last visit, which is in the live table
+        DerivationState.objects.filter(stage__in=(OpeningPairer.name, UptimePairer.name, VISITS_STAGE)).delete()
+
+        # Tables with deferred foreign key checks pending can't be altered, so they're checked now
+        connection.check_constraints()
+
+        external = [fk for table in live for fk in foreign_keys(cursor, referenced=table, exclude=live)]
+        names = {}
+        for model in MODELS:
+            table = model._meta.db_table
+            shadow = shadow_table(model)
+
+            # Match the indexes of the shadow table to those of the live table by definition
+            shadow_indexes = {}
+            for definition, name in indexes(cursor, shadow):
+                shadow_indexes.setdefault(definition, []).append(name)
+            renames = [(shadow_indexes[definition].pop(0), name) for definition, name in indexes(cursor, table) if shadow_indexes.get(definition)]
+
+            names[model] = (renames, sequence(cursor, shadow), sequence(cursor, table))
+
+        for table, name, definition in external:
+            cursor.execute(f"ALTER TABLE {table} DROP CONSTRAINT {qn(name)}")
+
+        cursor.execute(f"DROP TABLE {', '.join(qn(table) for table in live)}")
+
+        for model in MODELS:
+            renames, shadow_sequence, live_sequence = names[model]
+            cursor.execute(f"ALTER TABLE {qn(shadow_table(model))} RENAME TO {qn(model._meta.db_table)}")
+            for shadow_name, name in renames:
+                cursor.execute(f"ALTER INDEX {qn(shadow_name)} RENAME TO {qn(name)}")
+            cursor.execute(f"ALTER SEQUENCE {qn(shadow_sequence)} RENAME TO {qn(live_sequence)}")
+
+        for table, name, definition in external:
+            cursor.execute(f"ALTER TABLE {table} ADD CONSTRAINT {qn(name)} {definition}")
+
+    if verbosity >= 1:
+        print(f"Swapped in {', '.join(live)}.")
+
+
+def rebuild(accept_changes=False, batch_size=BULK_BATCH_SIZE, verbosity=0):
+    '''
+    Rebuilds Openings, Uptimes and Visits from all events into shadow tables, validates them against
+    the live tables and, if they match (or accept_changes), swaps them in. Then brings them up to date with
+    any events saved since the build began (by an incremental update) and refreshes what is kept from them
+    (uptime sketches and, if they changed, event pairing states).
+
+    Returns a dict of (live, shadow) 2-tuples of (row count, checksum) 2-tuples keyed on model, and whether
+    the shadow tables were swapped in.
+
+    :param accept_changes: swap the shadow tables in even if they differ from the live tables
+    :param batch_size: the number of rows to write per query
+    :param verbosity: Django manage.py argument for Verbosity level; 0=minimal output, 1=normal output, 2=verbose output, 3=very verbose output
+    '''
+    build(batch_size=batch_size, verbosity=verbosity)
+
+    with connection.cursor() as cursor:
+        live, shadow = checksums(cursor), checksums(cursor, shadow=True)
+    validation = {model: (live[model], shadow[model]) for model in MODELS}
+
+    changed = [model for model, (live, shadow) in validation.items() if live != shadow]
+    if verbosity >= 1:
+        for model, ((live_count, live_sum), (shadow_count, shadow_sum)) in validation.items():
+            print(f"{model.__name__}: {live_count} rows live, {shadow_count} rebuilt, checksums {'differ' if model in changed else 'match'}.")
+
+    if changed and not accept_changes:
+        with connection.cursor() as cursor:
+            drop_shadows(cursor)
+        if verbosity >= 1:
+            print(f"The rebuilt {', '.join(m.__name__ for m in changed)} differ from the live data, which is left in place.")
+        return validation, False
+
+    swap(verbosity=verbosity)
+
+    for door in Door.objects.all():
+        Pipeline(door, verbosity=verbosity).run()
+        if changed:
+            OrphanFlagger(door, rebuild=True).finish()
+        UptimeSketch.update(door, rebuild=True, batch_size=batch_size)
+    Visit.update_from_openings(batch_size=batch_size, verbosity=verbosity)
+
+    return validation, True
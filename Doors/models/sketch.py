@@ -0,0 +1,141 @@
+'''
+A streaming, mergeable sketch of a distribution of positive values (durations in seconds).
+
+Values are counted in logarithmic buckets, bucket i holding values in (gamma^(i-1), gamma^i] with
+gamma = (1 + accuracy) / (1 - accuracy), so that any quantile is estimated to within that relative
+accuracy (the DDSketch of Masson, Rim and Lee, VLDB 2019). The number of buckets grows with the
+log of the range of values, not with their number, and two sketches merge by adding bucket counts,
+so a sketch can be kept per door, updated with only new values and merged for all doors.
+
+The count, sum, minimum and maximum are kept exactly.
+'''
+import math, numpy as np
+
+from .conf import SKETCH_ACCURACY
+
+
+class LogSketch:
+
+    def __init__(self, accuracy=SKETCH_ACCURACY):
+        self.accuracy = accuracy
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.zeros = 0     # A count of the values that are not positive (have no log)
+        self.buckets = {}  # Counts keyed on bucket index
+
+    def add(self, value, count=1):
+        '''
+        Adds a value (count times) to the sketch.
+        '''
+        self.count += count
+        self.total += value * count
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+        if value <= 0:
+            self.zeros += count
+        else:
+            i = math.ceil(math.log(value) / self.log_gamma)
+            self.buckets[i] = self.buckets.get(i, 0) + count
+
+    def merge(self, other):
+        '''
+        Adds the values counted in another sketch (of the same accuracy) to this one.
+        '''
+        if other.accuracy != self.accuracy:
+            raise ValueError(f"Cannot merge sketches of different accuracy ({self.accuracy} and {other.accuracy}).")
+
+        if other.count:
+            self.count += other.count
+            self.total += other.total
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+            self.zeros += other.zeros
+            for i, count in other.buckets.items():
+                self.buckets[i] = self.buckets.get(i, 0) + count
+
+        return self
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def value(self, i):
+        '''
+        The value that represents bucket i (within the relative accuracy of every value in it).
+        '''
+        return 2 * self.gamma ** i / (self.gamma + 1)
+
+    def values(self):
+        '''
+        A list of (value, count) 2-tuples, one for each non-empty bucket, in order of value.
+        '''
+        values = [(min(0, self.min), self.zeros)] if self.zeros else []
+        values += [(self.value(i), self.buckets[i]) for i in sorted(self.buckets)]
+        return values
+
+    def quantile(self, q):
+        '''
+        Returns an estimate of the q quantile (0 <= q <= 1), or None if the sketch is empty.
+        '''
+        if not self.count:
+            return None
+
+        rank = q * (self.count - 1)
+        seen = 0
+        for value, count in self.values():
+            seen += count
+            if seen > rank:
+                return min(max(value, self.min), self.max)
+
+        return self.max
+
+    def histogram(self):
+        '''
+        Returns a list of (start, end, count) 3-tuples binning the values into evenly spaced bins with
+        whole number edges. The bin width is chosen as numpy's 'auto' does (the smaller of the Sturges
+        and Freedman-Diaconis widths), from the count and interquartile range in the sketch.
+        '''
+        if not self.count:
+            return []
+
+        low, high = self.min, self.max
+        sturges = (high - low) / (math.log2(self.count) + 1)
+        fd = 2 * (self.quantile(0.75) - self.quantile(0.25)) / self.count ** (1 / 3)
+        width = min(fd, sturges) if fd > 0 else sturges
+        bins = math.ceil((high - low) / width) if width > 0 else 1
+
+        # Round the bin edges and add 1 to the last as rounding it down would exclude the maximum
+        edges = sorted(set(round(e) for e in np.linspace(low, high, bins + 1)))
+        edges[-1] += 1
+        if len(edges) == 1:
+            edges.insert(0, edges[0] - 1)
+
+        values, counts = zip(*self.values())
+        hist, edges = np.histogram(np.clip(values, low, high), bins=edges, weights=counts)
+
+        return [(int(s), int(e), int(c)) for s, e, c in zip(edges[:-1], edges[1:], hist)]
+
+    def to_json(self):
+        return {"accuracy": self.accuracy,
+                "count": self.count,
+                "total": self.total,
+                "min": self.min,
+                "max": self.max,
+                "zeros": self.zeros,
+                "buckets": {str(i): count for i, count in self.buckets.items()}}
+
+    @classmethod
+    def from_json(cls, data):
+        sketch = cls(data["accuracy"])
+        sketch.count = data["count"]
+        sketch.total = data["total"]
+        sketch.min = data["min"]
+        sketch.max = data["max"]
+        sketch.zeros = data["zeros"]
+        sketch.buckets = {int(i): count for i, count in data["buckets"].items()}
+        return sketch
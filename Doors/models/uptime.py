@@ -1,14 +1,20 @@
-import humanize, numpy as np
+import humanize
 
-from django.db import models
+from django_rich_views.model import field_render, link_target_url, RichMixIn
 
-from .conf import UPTIME_CODE
+from django.db import models, transaction
+
+from datetime import timedelta
+
+from .conf import UPTIME_CODE, BULK_BATCH_SIZE, PAIRING_PENDING
 from .door import Door
+from .sketch import LogSketch
+from .pairing import load, pair_updowns
 
 from Site.logutils import log
 
 
-class Uptime(models.Model):
+class Uptime(models.Model, RichMixIn):
     '''
     A reinterpretation of Events to pair Online and Offline events into an Up time record.
 
@@ -21,6 +27,18 @@ class Uptime(models.Model):
     online_event = models.ForeignKey('Event', related_name='went_up', on_delete=models.PROTECT)
     offline_event = models.ForeignKey('Event', related_name='went_down', on_delete=models.PROTECT)
 
+    class Meta:
+        # Uptimes are found by door in time order (covering the online event that updates resume from)
+        # and listed in time order across all doors (a page at a time, see Doors.views.keyset).
+        indexes = [models.Index(fields=['door', 'date_time'], include=['online_event'], name='uptime_door_time'),
+                   models.Index(fields=['date_time'], name='uptime_time')]
+
+    # The relations rendered when uptimes are listed (fetched with the list, see Doors.views.generic.with_related)
+    list_select_related = ("online_event", "offline_event")
+
+    # The keys uptimes are listed and browsed in order of (see Doors.views.keyset)
+    ordering_keys = ("date_time", "id")
+
     @property
     def timestamp(self):
         from .event import Event
@@ -43,29 +61,78 @@ class Uptime(models.Model):
         return uptimes[0] if uptimes else None
 
     @classmethod
-    def update_from_events(cls, door, rebuild=False, Rebuild=False, verbosity=0):
+    def update_from_events(cls, door, rebuild=False, Rebuild=False, bulk=True, vectorized=False, verbosity=0):
         '''
         Update opensings from new events (or all events if rebuild requested)
 
         :param door: An instance of Door
         :param rebuild: Rebuild all uptimes (process all events)
         :param Rebuild: Same as rebuild but delete all existing uptimes first (a hard reset)
+        :param bulk: stream events as values and create new uptimes in bulk (see update_from_events_bulk)
+        :param vectorized: pair events with NumPy array operations, fastest for rebuilds (see update_from_events_vectorized)
         :param verbosity: Django manage.py argument for Verbosity level; 0=minimal output, 1=normal output, 2=verbose output, 3=very verbose output
         '''
-        # Find the last opening recorded
         from .event import Event
+        from .pipeline import UptimePairer
+        from .derivation import DerivationState
 
-        last_uptime = cls.last(door)
-
-        # Get all events after it's closing event
-        if last_uptime and not (rebuild or Rebuild):
-            new_events = Event.objects.filter(door=door, code=UPTIME_CODE, timestamp__gt=last_uptime.online_event.timestamp).order_by("timestamp")
+        if bulk and not vectorized:
+            # The bulk engine is the UptimePairer of the derivation pipeline, which resumes from its recorded state
+            pairer = UptimePairer(door, rebuild=rebuild or Rebuild, verbosity=verbosity)
+            since = pairer.since(UPTIME_CODE)
+        else:
+            # The others start down, after the online event of the last uptime recorded (its id is its
+            # timestamp) and leave no state to resume from
+            DerivationState.forget(door, UptimePairer.name)
+            since = None if rebuild or Rebuild else cls.objects.filter(door=door).order_by("-date_time").values_list("online_event_id", flat=True).first()
+
+        # Get all events after it
+        if since and not (rebuild or Rebuild):
+            new_events = Event.objects.filter(door=door, code=UPTIME_CODE, timestamp__gt=since).order_by("timestamp")
         # or all events (if we have no openings for this door yet)
         else:
             if Rebuild:
                 cls.objects.filter(door=door).delete()
             new_events = Event.objects.filter(door=door, code=UPTIME_CODE).order_by("timestamp")
 
+        if vectorized:
+            processed, new_uptimes, first_new, last_new, existing_uptimes = cls.update_from_events_vectorized(door, new_events, verbosity=verbosity)
+        elif bulk:
+            processed, new_uptimes, first_new, last_new, existing_uptimes = cls.update_from_events_bulk(door, new_events, pairer=pairer, verbosity=verbosity)
+        else:
+            processed, new_uptimes, first_new, last_new, existing_uptimes = cls.update_from_events_each(door, new_events, verbosity=verbosity)
+
+        # Record which of the events are paired, orphaned or pending (of those that might have changed,
+        # being those that were pending, unless we've reprocessed all events)
+        if rebuild or Rebuild:
+            Event.update_pairing(door, UPTIME_CODE, new_events)
+        else:
+            Event.update_pairing(door, UPTIME_CODE, Event.objects.filter(door=door, code=UPTIME_CODE, pairing=PAIRING_PENDING))
+
+        # And add the new uptimes to the door's sketch (a rebuild can fill gaps, so rebuilds the sketch)
+        UptimeSketch.update(door, rebuild=rebuild or Rebuild)
+
+        if verbosity >= 1:
+            print(f"Door {door.id}: Processed {processed} events, saved {new_uptimes} new uptimes for the switch on door {door.id}.")
+            if new_uptimes > 0:
+                print(f"\tfrom {first_new} to {last_new}")
+            if existing_uptimes > 0:
+                print(f"\tand found {existing_uptimes} openings already saved.")
+
+        return new_uptimes
+
+    @classmethod
+    def update_from_events_each(cls, door, new_events, verbosity=0):
+        '''
+        Pairs online and offline events into uptimes, looking up and creating each uptime in turn.
+
+        Returns the number of events processed, the number of new uptimes, the times of the first and
+        last of them and the number of uptimes that already existed.
+
+        :param door: An instance of Door
+        :param new_events: A QuerySet of the updown_state Events to process, in timestamp order
+        :param verbosity: Django manage.py argument for Verbosity level; 0=minimal output, 1=normal output, 2=verbose output, 3=very verbose output
+        '''
         if verbosity >= 2:
             print(f"Processing {len(new_events)} Up/Down events for the switch on door {door.id}.")
 
@@ -126,41 +193,209 @@ class Uptime(models.Model):
                     # recorde these ignored events.
                     pass
 
-        if verbosity >= 1:
-            print(f"Door {door.id}: Processed {len(new_events)} events, saved {len(new_uptimes)} new uptimes for the switch on door {door.id}.")
-            if len(new_uptimes) > 0:
-                print(f"\tfrom {new_uptimes[0].date_time} to {new_uptimes[-1].date_time}")
-            if len(existing_uptimes) > 0:
-                print(f"\tand found {len(existing_uptimes)} openings already saved.")
+        first_new = new_uptimes[0].date_time if new_uptimes else None
+        last_new = new_uptimes[-1].date_time if new_uptimes else None
+
+        return len(new_events), len(new_uptimes), first_new, last_new, len(existing_uptimes)
+
+    @classmethod
+    def update_from_events_bulk(cls, door, new_events, pairer=None, batch_size=BULK_BATCH_SIZE, verbosity=0):
+        '''
+        Pairs online and offline events into uptimes, as update_from_events_each does, but streamed.
+
+        Events are read as (timestamp, type) tuples from a server side cursor in chunks, and paired by
+        the UptimePairer stage of the derivation pipeline (see Doors.models.pipeline), which writes
+        uptimes in batches: one query to find which of the batch are already recorded, and one to insert
+        the rest. Uptimes are our most numerous derived records, and only one batch of them is ever in
+        memory.
+
+        Returns the number of events processed, the number of new uptimes, the times of the first and
+        last of them and the number of uptimes that already existed.
+
+        :param door: An instance of Door
+        :param new_events: A QuerySet of the updown_state Events to process, in timestamp order
+        :param pairer: the UptimePairer to pair them with, if resuming from its state (default, a new one assuming the switch is down at outset)
+        :param batch_size: the number of events to read, and uptimes to write, per query
+        :param verbosity: Django manage.py argument for Verbosity level; 0=minimal output, 1=normal output, 2=verbose output, 3=very verbose output
+        '''
+        from .pipeline import UptimePairer
+
+        if pairer is None:
+            pairer = UptimePairer(door, rebuild=True, batch_size=batch_size, verbosity=verbosity)
+
+        with transaction.atomic():
+            for timestamp, event_type in new_events.values_list("timestamp", "type").iterator(chunk_size=batch_size):
+                pairer.event(timestamp, UPTIME_CODE, event_type, None)
+            pairer.save()
+            pairer.record(pending=pairer.pending)
+
+        if verbosity >= 2:
+            print(f"Processed {pairer.processed} Up/Down events for the switch on door {door.id}.")
+
+        return pairer.processed, pairer.new_uptimes, pairer.first_new, pairer.last_new, pairer.existing_uptimes
+
+    @classmethod
+    def update_from_events_vectorized(cls, door, new_events, batch_size=BULK_BATCH_SIZE, verbosity=0):
+        '''
+        Pairs online and offline events into uptimes, as update_from_events_each does, but with NumPy
+        array operations on all the events at once (see Doors.models.pairing). The events are loaded
+        as two columns (timestamp and type), the uptimes already recorded from them fetched in one
+        query, and the new uptimes created in batches in one transaction.
+
+        Returns the number of events processed, the number of new uptimes, the times of the first and
+        last of them and the number of uptimes that already existed.
+
+        :param door: An instance of Door
+        :param new_events: A QuerySet of the updown_state Events to process, in timestamp order
+        :param batch_size: the number of uptimes to insert per query
+        :param verbosity: Django manage.py argument for Verbosity level; 0=minimal output, 1=normal output, 2=verbose output, 3=very verbose output
+        '''
+        from .event import Event
+
+        timestamps, is_up = load(new_events, "type", "online", "offline")
+        ups, downs = pair_updowns(timestamps, is_up)
+
+        # Uptimes already recorded from these online events (of any door, so we can warn of a change in door)
+        if len(timestamps) > 0:
+            existing = {o: (c, t, d, door_id) for o, c, t, d, door_id in
+                        cls.objects.filter(online_event__door=door, online_event_id__gte=timestamps[0])
+                                   .values_list("online_event_id", "offline_event_id", "date_time", "duration", "door_id")}
+        else:
+            existing = {}
+
+        existing_uptimes = 0
+        uptimes = []
+        for online, offline in zip(ups.tolist(), downs.tolist()):
+            up_time = Event.datetime_from_timestamp(online)
+            up_duration = Event.datetime_from_timestamp(offline) - up_time
+
+            if online in existing and existing[online][0] == offline:
+                offline, date_time, duration, door_id = existing[online]
+                if date_time != up_time:
+                    log.warning("Apparant, unexpected, change in Uptime date_time")
+                if duration != up_duration:
+                    log.warning("Apparant, unexpected, change in Uptime duration")
+                if door_id != door.id:
+                    log.warning("Apparant, unexpected, change in Uptime door")
+
+                existing_uptimes += 1
+            else:
+                uptimes.append(cls(date_time=up_time,
+                                   duration=up_duration,
+                                   door=door,
+                                   online_event_id=online,
+                                   offline_event_id=offline))
+
+        with transaction.atomic():
+            cls.objects.bulk_create(uptimes, batch_size=batch_size)
+
+        if verbosity >= 2:
+            print(f"Processed {len(timestamps)} Up/Down events for the switch on door {door.id}.")
+
+        first_new = uptimes[0].date_time if uptimes else None
+        last_new = uptimes[-1].date_time if uptimes else None
+        return len(timestamps), len(uptimes), first_new, last_new, existing_uptimes
+
+    @classmethod
+    def sketch(cls):
+        '''
+        Returns a LogSketch of the durations (in seconds) of all uptimes, merged from the sketches
+        kept per door (see UptimeSketch), in one query.
+        '''
+        sketch = LogSketch()
+        for door_sketch in UptimeSketch.objects.all().values_list("sketch", flat=True):
+            sketch.merge(LogSketch.from_json(door_sketch))
+        return sketch
+
+    @classmethod
+    def statistics(cls, quantiles=(0.5, 0.9, 0.99)):
+        '''
+        Returns a dict of uptime statistics: the count, min, max and average (mean) uptime and the
+        requested quantiles (keyed on q), all durations as timedeltas. From the sketch, without
+        reading any uptimes.
+
+        :param quantiles: the quantiles to estimate (each 0 <= q <= 1)
+        '''
+        sketch = cls.sketch()
+
+        def duration(seconds):
+            return None if seconds is None else timedelta(seconds=seconds)
+
+        return {"count": sketch.count,
+                "min": duration(sketch.min),
+                "max": duration(sketch.max),
+                "avg": duration(sketch.mean),
+                "quantiles": {q: duration(sketch.quantile(q)) for q in quantiles}}
 
     @classmethod
     def histogram(cls):
         '''
         Returns data for populating a histogram of uptimes.
         In the form of a dict with duration band as key and count of uptimes in that band and the value.
+
+        From the sketch, without reading any uptimes, the bands chosen as numpy's 'auto' bins would be
+        (see LogSketch.histogram).
         '''
-        uptimes = cls.objects.all().values_list('duration', flat=True)
+        # remove zero entries
+        return {f"{s}-{e}": c for s, e, c in cls.sketch().histogram() if c != 0}
 
-        # Get the uptimes in seconds ...
-        seconds = list(map(lambda d: d.total_seconds(), uptimes))
+    #########################################################################################
+    # Django Rich Views supports nuanced rendering of the object
 
-        # Ask numpy to create some bins for us
-        bins = np.histogram_bin_edges(seconds, bins='auto')
+    def __str__(self):
+        '''
+        A basic default render. Should be on one line (contain no newlines, plain text.
+        '''
+        return f"{self.date_time} - Sensor on door {self.door_id} up for {humanize.precisedelta(self.duration, format='%0.1f')}"
 
-        # round the bin edges as numpy doesn't have a way of asking for that
-        bins = list(map(round, bins))
-        # Add 1s he last bin edge as if was roduned down if it was under 0.5 and would exclude durations above the original value if rounded down.
-        bins[-1] = bins[-1] + 1
+    def __rich_str__(self, link=None):
+        '''
+        A rich rendering which, should still be on one line (no newlines) but can contain hyperlinks
 
-        # Now ask numpy to bin the values ...
-        hist = np.histogram(seconds, bins)
+        :param link: A django_rich_views.options.field_link_target
+        '''
+        online = field_render("online", link_target_url(self.online_event, link))
+        offline = field_render("offline", link_target_url(self.offline_event, link))
+        return f"{self.date_time} - Sensor on door {self.door_id} {online} and {offline} {humanize.precisedelta(self.duration, format='%0.1f')} later"
 
-        # Create category labels
-        labels = [f"{s}-{e}" for s, e in zip(bins[:-1], bins[1:])]
 
-        # Now create the dict we want to return
-        counts = hist[0]
-        histogram = {l:c for l, c in zip(labels, counts)}
+class UptimeSketch(models.Model):
+    '''
+    A sketch of the distribution of uptime durations on a door (see Doors.models.sketch), kept up to
+    date as uptimes are added, so that uptime statistics never need to read the (numerous) uptimes.
+    '''
+    door = models.OneToOneField(Door, related_name='uptime_sketch', on_delete=models.CASCADE)
+    sketch = models.JSONField('Sketch')
 
-        # remove zero entries
-        return {l:c for l,c in histogram.items() if c != 0}
+    # The timestamp of the online event of the last uptime in the sketch
+    through = models.BigIntegerField('Through', null=True)
+
+    @classmethod
+    def update(cls, door, rebuild=False, batch_size=BULK_BATCH_SIZE):
+        '''
+        Adds the uptimes of door not yet in its sketch to it, reading only those uptimes.
+
+        :param door: An instance of Door
+        :param rebuild: rebuild the sketch from all the uptimes of door
+        :param batch_size: the number of uptimes to read per query
+        '''
+        with transaction.atomic():
+            door_sketch = cls.objects.select_for_update().filter(door=door).first()
+
+            if door_sketch is None or rebuild:
+                door_sketch = door_sketch or cls(door=door)
+                sketch = LogSketch()
+                door_sketch.through = None
+            else:
+                sketch = LogSketch.from_json(door_sketch.sketch)
+
+            uptimes = Uptime.objects.filter(door=door)
+            if door_sketch.through is not None:
+                uptimes = uptimes.filter(online_event_id__gt=door_sketch.through)
+
+            for online, duration in uptimes.order_by("online_event_id").values_list("online_event_id", "duration").iterator(chunk_size=batch_size):
+                sketch.add(duration.total_seconds())
+                door_sketch.through = online
+
+            door_sketch.sketch = sketch.to_json()
+            door_sketch.save()
@@ -1,21 +1,29 @@
-import calendar, humanize
+import calendar, humanize, numpy as np
+
+from django_rich_views.model import field_render, link_target_url, RichMixIn
 
 from django.core.serializers.json import DjangoJSONEncoder
-from django.db.models.functions import TruncDate
-from django.db.models import Count
-from django.db import models
+from django.db.models.functions import TruncDate, Coalesce
+from django.db.models import Count, OuterRef, Subquery
+from django.db import models, transaction
 
 from isodate import parse_duration
 from numbers import Number
 from collections import Counter
 from datetime import datetime, timedelta
 
-from .conf import VISIT_SEPARATION
+from .conf import VISIT_SEPARATION, BULK_BATCH_SIZE
+from .overlaps import pairwise_overlaps, open_door_durations
+from .segmentation import opening_gaps, visit_counts, visit_starts, visit_measures
+from .functions import DurationBucket
 from .door import Door
 from .opening import Opening
 
+# The name Visits are derived under, for their DerivationState
+VISITS_STAGE = "visits"
+
 
-class Visit(models.Model):
+class Visit(models.Model, RichMixIn):
     '''
     A grouping of openings into a single visit. Just a group of openings really but we store
     properties of the group regardless, so we can get anb overview of visits in a standard
@@ -27,6 +35,16 @@ class Visit(models.Model):
     # Populated after creating the object so can be null
     doors = models.JSONField(null=True, encoder=DjangoJSONEncoder)  # List of Door IDs in order opened (can contain duplicates)
     overlaps = models.JSONField(null=True, encoder=DjangoJSONEncoder)  # List of tuples conveying doors open simultaneously (overlapping openings)
+    doors_open = models.JSONField(null=True, encoder=DjangoJSONEncoder)  # List of the time spent with 0, 1, 2 ... doors open at once
+
+    class Meta:
+        indexes = [models.Index(fields=['date_time'], name='visit_time')]
+
+    # The relations rendered when visits are listed (fetched with the list, see Doors.views.generic.with_related)
+    list_prefetch_related = ("openings",)
+
+    # The keys visits are listed and browsed in order of (see Doors.views.keyset)
+    ordering_keys = ("date_time", "id")
 
     # openings = OneToManyField(Opening, related_name='visit') # Implicit by ForeignKey in Opening
 
@@ -43,6 +61,10 @@ class Visit(models.Model):
     def olaps(self):
         return [(olap[0], olap[1], parse_duration(olap[2])) for olap in self.overlaps]
 
+    @property
+    def doors_open_durations(self):
+        return [parse_duration(d) for d in self.doors_open] if self.doors_open else []
+
     @classmethod
     def last(cls):
         visits = cls.objects.all().order_by("-date_time")
@@ -59,14 +81,31 @@ class Visit(models.Model):
         return cls.objects.filter(date_time__gte=from_time).order_by("-date_time")
 
     @classmethod
-    def histogram(cls, htype="day", categories=None):
+    def histogram(cls, htype="day", categories=None, cache=True):
         '''
         Returns data for populating a histogram of visit counts.
         In the form of a dict with category as key and count of visits and the value.
 
+        The histograms of the start, duration and quiet time before visits are computed over the column cache if
+        it is current (see Doors.models.columns), with no query bar the one for its version.
+
         :param htype:
         :param categories:
+        :param cache: read visits from the column cache if it is current
         '''
+        from . import columns
+        cached = columns.current() if cache and htype in ("day", "per_days", "durations", "quiet_times") else None
+        if cached is not None:
+            visits = cached["visits"]
+            if htype == "day":
+                return columns.hour_of_day(visits["start"])
+            elif htype == "per_days" and categories in (None, 1):
+                return columns.per_day(visits["start"])
+            elif htype == "durations" and isinstance(categories, timedelta):
+                return columns.durations(visits["duration"], categories)
+            elif htype == "quiet_times" and isinstance(categories, timedelta):
+                return columns.quiet_times(visits["prior_quiet"], categories)
+
         # Create buckets of timedelta:
         #    hourly buckets for a delta of one day
         #    daily buckets for delta of 7 days or one month
@@ -132,18 +171,10 @@ class Visit(models.Model):
                 def label2(td, i):
                     return f"{label(td, i)}-{label(td, i+1)}"
 
+                # Binned in the database, which returns only the buckets with visits in them
                 field = "duration"
-                durations = list(cls.objects.all().order_by(field).values_list(field, flat=True))
-                longest = durations[-1]
-                cats = round(longest / categories)
-                visit_counts = {f"{label2(categories, c)}":0 for c in range(cats + 1)}
-                for d in durations:
-                    # d is a single value tuple (thanks Django!)
-                    c = round(d / categories)
-                    visit_counts[f"{label2(categories, c)}"] += 1
-
-                # remove empty categories
-                return {l:c for l,c in visit_counts.items() if c !=0 }
+                buckets = cls.objects.annotate(bucket=DurationBucket(field, categories)).values("bucket").annotate(count=Count("id")).order_by("bucket")
+                return {label2(categories, b["bucket"]): b["count"] for b in buckets}
             else:
                 return None
         elif htype == "quiet_times":
@@ -163,15 +194,13 @@ class Visit(models.Model):
                 field = "prior_quiet"
                 # Consider any over 1 day outliers and ignore them.
                 # Missing data assumed to be the cause (for now)
-                quiets = list(cls.objects.filter(prior_quiet__lte=timedelta(days=1)).order_by(field).values_list(field, flat=True))
-                longest = quiets[-1]
-                cats = round(longest / min(categories, timedelta(weeks=8)))
-                visit_counts = {f"{label2(categories, c)}":0 for c in range(cats + 1)}
-                for q in quiets:
-                    # d is a single value tuple (thanks Django!)
-                    c = round(q / categories)
-                    visit_counts[f"{label2(categories, c)}"] += 1
-                return visit_counts
+                # Binned in the database, which returns only the buckets with visits in them, and we
+                # fill in the empty buckets below the longest (which are presented as gaps)
+                buckets = cls.objects.filter(prior_quiet__lte=timedelta(days=1)).annotate(bucket=DurationBucket(field, categories)).values("bucket").annotate(count=Count("id")).order_by("bucket")
+                counts = {b["bucket"]: b["count"] for b in buckets}
+                if not counts:
+                    return {}
+                return {label2(categories, c): counts.get(c, 0) for c in range(max(counts) + 1)}
             else:
                 return None
         elif htype == "per_days":
@@ -197,166 +226,317 @@ class Visit(models.Model):
                     open_counts[f"Door {door}"] += 1
             return open_counts
         elif htype == "doors_per_visit_total":
-            opening_frequency = Counter([o.openings.all().count() for o in cls.objects.all()])
-            return dict(sorted(dict(opening_frequency).items()))
+            # The number of openings in each visit, counted and grouped in the database
+            openings = Opening.objects.filter(visit=OuterRef('pk')).values('visit').annotate(count=Count('id')).values('count')
+            frequency = cls.objects.annotate(openings_in=Coalesce(Subquery(openings), 0)).values('openings_in').annotate(count=Count('id')).order_by('openings_in')
+            return {f['openings_in']: f['count'] for f in frequency}
         elif htype == "doors_per_visit_unique":
-            opening_frequency = Counter([len(set(o.openings.all().values_list('door__id', flat=True))) for o in cls.objects.all()])
-            return dict(sorted(dict(opening_frequency).items()))
+            # The number of distinct doors opened in each visit, counted and grouped in the database
+            doors = Opening.objects.filter(visit=OuterRef('pk')).values('visit').annotate(count=Count('door', distinct=True)).values('count')
+            frequency = cls.objects.annotate(doors_in=Coalesce(Subquery(doors), 0)).values('doors_in').annotate(count=Count('id')).order_by('doors_in')
+            return {f['doors_in']: f['count'] for f in frequency}
         elif htype == "overlap_durations":
             # Duration of multidoor overlaps (five states, no doors open, one door open, two doors open, three doors open, four doors opon)
-            pass
+            # As total minutes spent in each state during visits.
+            totals = []
+            for doors_open in cls.objects.filter(doors_open__isnull=False).values_list("doors_open", flat=True):
+                for n, d in enumerate(doors_open):
+                    if n == len(totals):
+                        totals.append(timedelta())
+                    totals[n] += parse_duration(d)
+            return {f"{n} open": round(total.total_seconds() / 60) for n, total in enumerate(totals)}
         else:
             raise ValueError(f"No historgam defined for {categories=}, {htype=}")
 
     @classmethod
-    def update_from_openings(cls, rebuild=False, Rebuild=False, verbosity=0):
+    def update_from_openings(cls, rebuild=False, Rebuild=False, batch_size=BULK_BATCH_SIZE, verbosity=0):
         '''
         Creates new_visits Visits as needed from newly created Openings.
 
+        Set based, and in one transaction. For N openings making V visits, of which E already exist,
+        with B = batch_size, that is:
+
+            1 query for the state recorded (see DerivationState), 1 for the first opening not in a visit and
+            1 for the last visit, unless rebuilding
+            1 query for the openings
+            1 query for the visits already recorded
+            ceil((V-E)/B) queries to insert new visits
+            ceil(E/B) queries to update existing visits
+            ceil(N/B) queries at most to point openings at their visits (only openings that change are updated)
+            1 query to record the state (2 the first time)
+
+        which is O(1) per batch. A Rebuild adds the deletion of all visits (in batches of 100, by Django).
+
+        An update resumes from the first opening not yet in a visit, reading the openings of the last visit
+        (which new openings may extend) and those after it. Should a door lag the others (its logs fetched
+        late), its new openings fall among the visits recorded, which are reassessed from the one the first
+        of them falls in (visits they join are merged, and the quiet times before visits updated).
+
         :param rebuild: Rebuild all openings (process all events)
         :param Rebuild: same as rebuild but delete all existing visits first (a hard reset)
+        :param batch_size: the number of visits or openings to write per query
         :param verbosity: Django manage.py argument for Verbosity level; 0=minimal output, 1=normal output, 2=verbose output, 3=very verbose output
         '''
-        # Find the last visit recorded
-        last_visit = cls.last()
+        from .derivation import DerivationState
 
-        # Get all openings after the start of the last visit (we reasses the last visit too)
-        if last_visit and not (rebuild or Rebuild):
-            new_openings = Opening.objects.filter(date_time__gt=last_visit.date_time).order_by("date_time")
-        # or all openings (if we have no visits for this door yet)
-        else:
+        with transaction.atomic():
             if Rebuild:
                 cls.objects.all().delete()
-            new_openings = Opening.objects.all().order_by("date_time")
 
-        if new_openings:
-            if verbosity >= 2:
-                print(f"Processing {len(new_openings)} openings.")
-        else:
-            if verbosity >= 2:
-                print(f"No new openings to process")
-            return
-
-        # Break new_openings down into sets of openings each one a visit
-        new_openings_by_visit = []
-        visit_openings = []
-        previous_opening = new_openings[0].previous
-        end_of_previous_opening = previous_opening.date_time if previous_opening else new_openings[0].date_time
-        previous_gap = previous_opening.visit.prior_quiet if previous_opening else timedelta()
-        visit_threshold = timedelta(minutes=VISIT_SEPARATION)
-        existing_visits = []
-        new_visits = []
-        first_new_opening = True
-        started_mid_visit = False
-        for opening in new_openings:
+            if rebuild or Rebuild:
+                anchor = None
+            else:
+                # The first opening not yet in a visit is where visits need reassessing from
+                first_new = Opening.objects.filter(visit__isnull=True).order_by("date_time").values_list("date_time", flat=True).first()
+                if first_new is None:
+                    if verbosity >= 2:
+                        print(f"No new openings to process")
+                    return
+
+                # The last visit is provisional (new openings may extend it) and recorded in the state, or found
+                state = DerivationState.of(None, VISITS_STAGE)
+                last_visit = state.visit if state and state.visit_id else cls.objects.order_by("-date_time").first()
+
+                if last_visit is None or last_visit.date_time <= first_new:
+                    anchor = last_visit
+                else:
+                    # A door lagged the others, and its new openings fall among the visits recorded
+                    anchor = cls.objects.filter(date_time__lte=first_new).order_by("-date_time").first()
+
+            # The openings of the anchor visit and all after it (or all openings if there is none)
+            new_openings = Opening.objects.all() if anchor is None else Opening.objects.filter(date_time__gte=anchor.date_time)
+
+            fields = ("id", "date_time", "duration", "door_id", "visit_id", "open_event_id")
+            new_openings = list(new_openings.order_by("date_time").only(*fields))
+
+            if new_openings:
+                if verbosity >= 2:
+                    print(f"Processing {len(new_openings)} openings.")
+            else:
+                if verbosity >= 2:
+                    print(f"No new openings to process")
+                return
+
+            # Break new_openings down into sets of openings each one a visit. The quiet time before the first
+            # is that before the anchor visit (which starts it), as the openings before it are not read.
+            new_openings_by_visit = cls.segment(new_openings, verbosity=verbosity)
+            if anchor:
+                new_openings_by_visit[0] = (new_openings_by_visit[0][0], anchor.prior_quiet)
+
+            # Consider the start time a pseudo key ... if a visit exists that started then it's our
+            # visit surely. It was created earlier and has a prior_quiet and a duration (which may
+            # be wrong because new openings may have extended it).
+            first_start = new_openings_by_visit[0][0][0].date_time
+            recorded_visits = {visit.date_time: visit for visit in cls.objects.filter(date_time__gte=first_start)}
+
+            # Now create new Visits for each set of openings thus collected
+            existing_visits = []
+            new_visits = []
+            visits = []
+            for openings, prior_quiet in new_openings_by_visit:
+                start = openings[0].date_time
+                end = openings[-1].end_time
+                duration = end - start
+
+                if start in recorded_visits:
+                    visit = recorded_visits.pop(start)
+
+                    # Update the duration (new openings may have extended the visit) and the quiet time before
+                    # it (a lagging door's openings may have shortened it)
+                    visit.duration = duration
+                    visit.prior_quiet = prior_quiet
+
+                    existing_visits.append(visit)
+
+                    if verbosity >= 3:
+                        print(f"\tVisit already exists at {visit.date_time} for {humanize.precisedelta(visit.duration,format='%0.1f')}.")
+                else:
+                    visit = cls(prior_quiet=prior_quiet, date_time=start, duration=duration)
+
+                    new_visits.append(visit)
+
+                    if verbosity >= 3:
+                        print(f"\tNew visit at {visit.date_time} for {humanize.precisedelta(visit.duration,format='%0.1f')}.")
+
+                visit.doors, visit.overlaps, visit.doors_open = cls.overlaps_of(openings, start, end)
+                visits.append((visit, openings))
+
+            cls.objects.bulk_create(new_visits, batch_size=batch_size)
+            cls.objects.bulk_update(existing_visits, ["duration", "prior_quiet", "doors", "overlaps", "doors_open"], batch_size=batch_size)
+
+            # Point all the openings in each visit to it (those not already pointing at it)
+            changed_openings = []
+            for visit, openings in visits:
+                for opening in openings:
+                    if opening.visit_id != visit.pk:
+                        opening.visit_id = visit.pk
+                        changed_openings.append(opening)
+
+            Opening.objects.bulk_update(changed_openings, ["visit"], batch_size=batch_size)
+
+            # The visits recorded that no longer start a visit (merged into an earlier one by a lagging door's openings)
+            merged = list(recorded_visits.values())
+            if merged:
+                cls.objects.filter(pk__in=[visit.pk for visit in merged]).delete()
+
+            # And record where we got to, for the next update to resume from
+            DerivationState.record(None, VISITS_STAGE, through=max(o.open_event_id for o in new_openings), visit=visits[-1][0])
+
+        if verbosity >= 1:
+            print(f"Processed {len(new_openings)} openings, saved {len(new_visits)} new visits.")
+            if len(new_visits) > 0:
+                print(f"\tfrom {new_visits[0].date_time} to {new_visits[-1].date_time}")
+            if len(existing_visits) > 0:
+                print(f"\tfound {len(existing_visits)} visits, reprocessed.")
+            if len(merged) > 0:
+                print(f"\tmerged {len(merged)} visits into others.")
+
+    @classmethod
+    def segment(cls, openings, visit_openings=(), prior_quiet=timedelta(), separation=timedelta(minutes=VISIT_SEPARATION), verbosity=0):
+        '''
+        Groups openings into visits, each a set of openings separated from the one before by a gap longer
+        than separation. Returns a list of (openings, prior_quiet) 2-tuples, one per visit, being its
+        openings and the quiet time before it.
+
+        The last set of openings forms a visit without a gap defining its end, and is provisional (later
+        openings may extend it).
+
+        :param openings: Openings in temporal order
+        :param visit_openings: the openings of a visit (the last) that openings follow and may extend
+        :param prior_quiet: the quiet time before that visit
+        :param separation: the gap between openings that separates visits
+        :param verbosity: Django manage.py argument for Verbosity level; 0=minimal output, 1=normal output, 2=verbose output, 3=very verbose output
+        '''
+        if not openings and not visit_openings:
+            return []
+
+        visits = []
+        visit_openings = list(visit_openings)
+        end_of_previous_opening = visit_openings[-1].end_time if visit_openings else openings[0].date_time
+        previous_gap = prior_quiet if visit_openings else timedelta()
+        for opening in openings:
             gap = opening.date_time - end_of_previous_opening
 
             if verbosity >= 2:
-                print(f"\tDoor {opening.door.id} opened at {opening.date_time} for {humanize.precisedelta(opening.duration,format='%0.1f')} after {humanize.precisedelta(gap,format='%0.1f')}")
+                print(f"\tDoor {opening.door_id} opened at {opening.date_time} for {humanize.precisedelta(opening.duration,format='%0.1f')} after {humanize.precisedelta(gap,format='%0.1f')}")
 
-            if gap > visit_threshold:
+            if gap > separation:
                 if visit_openings:
-                    new_openings_by_visit.append((visit_openings, previous_gap))
+                    visits.append((visit_openings, previous_gap))
                     visit_openings = []
                     previous_gap = gap
-            elif first_new_opening and previous_opening:
-                started_mid_visit = True
-            first_new_opening = False
 
             visit_openings.append(opening)
             end_of_previous_opening = opening.end_time
 
-        # The last set of openings form  a visit without a gap defining them amd may cause us to
-        # start next update mid visit. But we group them as a provisional visit
         if visit_openings:
-            new_openings_by_visit.append((visit_openings, previous_gap))
+            visits.append((visit_openings, previous_gap))
 
         if verbosity >= 2:
-            print(f"Identified {len(new_openings_by_visit)} visits (groups of openings, separated by at least {humanize.precisedelta(visit_threshold)}).")
-
-        # Now create new Visits for each set of openings thus collected
-        for i, (openings, prior_quiet) in enumerate(new_openings_by_visit):
-            # Create a new visit with those openings
-            start = previous_opening.visit.date_time if (i == 0 and started_mid_visit) else openings[0].date_time
-            end = openings[-1].end_time
-            duration = end - start
-
-            try:
-                # Consider the start time a pseudo key ... if a visit exists that started then it's our
-                # visit surely. It was created earlier and has a prior_quiet and a duration (which may
-                # be wrong because we may have an updated end time if we started mid visit above.
-                visit = cls.objects.get(date_time=start)
-
-                # Update the duration (we add this now to cater for the edge case of started_mid_visit)
-                # The visit will exits and need updating.
-                visit.duration = duration
-
-                existing_visits.append(visit)
-
-                if verbosity >= 3:
-                    print(f"\tVisit already exists at {visit.date_time} for {humanize.precisedelta(visit.duration,format='%0.1f')}.")
-            except cls.DoesNotExist:
-                visit = cls.objects.create(prior_quiet=prior_quiet, date_time=start, duration=duration)
-
-                new_visits.append(visit)
-
-                if verbosity >= 3:
-                    print(f"\tNew visit at {visit.date_time} for {humanize.precisedelta(visit.duration,format='%0.1f')}.")
-
-            # Point all the openings in this visit to it
-            for opening in openings:
-                opening.visit = visit
-                opening.save()
-
-            # Work out the door opening overlaps
-            visit_doors = []
-            visit_olaps = []
-
-            previous_spans = []  # Record or previous spans in (span_end_time, door) 2-tuples
-
-            # Measure of overlap keyed on door pairs
-            # A 2D dict such that the first index is the door newly opened while the second door is already open
-            # The number of doors already open when a door is openned can thus easily be determined by the non
-            # zero entries for overlap time. timedelta() is a zero duration and we initialise the 2D block
-            # with  zeros so that teh accumulator can just add overlaps as detected.
-            door_olap = {i: {j: timedelta() for j in Door.ids} for i in Door.ids}
-
-            # Check each opening of the visit in temporal order for overlapping spans in time.
-            for opening in openings:
-                span_start = opening.date_time
-                span_end = opening.end_time
-                span_door = opening.door.id
-
-                # Check for previous spans still running when this one starts
-                # previous_spans is a list of (span_end_time, door) 2-tuples
-                for pspan_end, pspan_door in previous_spans:
-                    # For each previous span that overlaps we accumular the list of overlapping doors
-                    # and the duration of total overlap
-                    if span_start < pspan_end:
-                        span_olap = min(pspan_end, span_end) - span_start
-                        # Accumulate the overlap total and per door
-                        # It is accumulated twice, once for each door in the overlap.
-                        door_olap[span_door][pspan_door] += span_olap
-
-                previous_spans.append((span_end, span_door))
-                visit_doors.append(span_door)
-
-            for door_i in Door.ids:
-                olap = []
-                for door_j in Door.ids:
-                    if door_olap[door_i][door_j] > timedelta():
-                        olap.append((door_i, door_j, door_olap[door_i][door_j]))
-                if olap:
-                    visit_olaps.extend(olap)
-
-            visit.doors = visit_doors
-            visit.overlaps = visit_olaps
-            visit.save()
+            print(f"Identified {len(visits)} visits (groups of openings, separated by at least {humanize.precisedelta(separation)}).")
 
-        if verbosity >= 1:
-            print(f"Processed {len(new_openings)} openings, saved {len(new_visits)} new visits.")
-            if len(new_visits) > 0:
-                print(f"\tfrom {new_visits[0].date_time} to {new_visits[-1].date_time}")
-            if len(existing_visits) > 0:
-                print(f"\tfound {len(existing_visits)} visits, reprocessed.")
+        return visits
 
+    @classmethod
+    def segmentation(cls, thresholds, categories=timedelta(seconds=30), cache=True):
+        '''
+        Segments all openings into visits at each of thresholds, as update_from_openings does at
+        VISIT_SEPARATION, and summarises the visits found without writing any, for exploring how visits
+        depend on the threshold. In one query (for the openings, none if they're read from the column cache,
+        see Doors.models.columns), with NumPy array operations on them (see Doors.models.segmentation).
+
+        Returns a dict keyed on threshold of dicts of:
+
+            visits:                 the number of visits
+            median_duration:        their median duration
+            durations:              a histogram of their durations (as histogram("durations", categories))
+            doors_per_visit_total:  a histogram of the openings per visit (as histogram("doors_per_visit_total"))
+            doors_per_visit_unique: a histogram of the doors opened per visit (as histogram("doors_per_visit_unique"))
+
+        :param thresholds: a list of the gaps between openings that separate visits (timedeltas)
+        :param categories: the width of the bins of the durations histograms (a timedelta)
+        :param cache: read the openings from the column cache if it is current
+        '''
+        def label(td, i):
+            secs = round((i * td).total_seconds())
+            mins, secs = divmod(secs, 60)
+            return f"{mins}:{secs:02d}"
+
+        def label2(td, i):
+            return f"{label(td, i)}-{label(td, i+1)}"
+
+        def counts(values):
+            return {int(value): int(count) for value, count in zip(*np.unique(values, return_counts=True))}
+
+        # The openings from the column cache if it is current, else from the database
+        from .columns import current
+        cached = current() if cache else None
+        if cached is not None:
+            openings = cached["openings"]
+            starts, doors = openings["start"], openings["door"]
+            ends = starts + openings["duration"]
+        else:
+            openings = list(Opening.objects.order_by("date_time").values_list("date_time", "duration", "door_id"))
+            starts = np.array([o[0] for o in openings], dtype="datetime64[us]")
+            ends = starts + np.array([o[1] for o in openings], dtype="timedelta64[us]")
+            doors = np.array([o[2] for o in openings], dtype=np.int64)
+
+        if len(starts) == 0:
+            return {threshold: {"visits": 0, "median_duration": None, "durations": {}, "doors_per_visit_total": {}, "doors_per_visit_unique": {}}
+                    for threshold in thresholds}
+
+        gaps = opening_gaps(starts, ends)
+        limits = np.array(thresholds, dtype="timedelta64[us]")
+
+        result = {}
+        for threshold, limit, count in zip(thresholds, limits, visit_counts(gaps, limits).tolist()):
+            durations, visit_openings, visit_doors = visit_measures(starts, ends, doors, visit_starts(gaps, limit))
+            buckets = np.round(durations / np.timedelta64(categories)).astype(np.int64)
+            result[threshold] = {"visits": count,
+                                 "median_duration": timedelta(microseconds=float(np.median(durations.astype(np.int64)))),
+                                 "durations": {label2(categories, b): c for b, c in counts(buckets).items()},
+                                 "doors_per_visit_total": counts(visit_openings),
+                                 "doors_per_visit_unique": counts(visit_doors)}
+        return result
+
+    @classmethod
+    def overlaps_of(cls, openings, start=None, end=None):
+        '''
+        Returns the doors opened in a visit, the door opening overlaps and the time spent with
+        0, 1, 2 ... doors open at once (see Doors.models.overlaps).
+
+        The doors are a list of door IDs in the order they were opened, and the overlaps a list of
+        (door_i, door_j, overlap) 3-tuples, being the time door_i was open while door_j already was.
+
+        :param openings: the openings of a visit, in temporal order
+        :param start: the start of the visit (defaults to the first opening)
+        :param end: the end of the visit (defaults to the last closing)
+        '''
+        spans = [(opening.date_time, opening.end_time, opening.door_id) for opening in openings]
+
+        visit_doors = [door for start, end, door in spans]
+        door_olap = pairwise_overlaps(spans)
+        visit_olaps = [(door_i, door_j, door_olap[(door_i, door_j)]) for door_i, door_j in sorted(door_olap) if door_olap[(door_i, door_j)] > timedelta()]
+        doors_open = open_door_durations(spans, start, end)
+
+        return visit_doors, visit_olaps, doors_open
+
+    #########################################################################################
+    # Django Rich Views supports nuanced rendering of the object
+
+    def __str__(self):
+        '''
+        A basic default render. Should be on one line (contain no newlines, plain text.
+        '''
+        return f"{self.date_time} - Visit for {humanize.precisedelta(self.duration, format='%0.1f')} opening doors {', '.join(map(str, self.doors or []))}"
+
+    def __rich_str__(self, link=None):
+        '''
+        A rich rendering which, should still be on one line (no newlines) but can contain hyperlinks
+
+        :param link: A django_rich_views.options.field_link_target
+        '''
+        # Read through all() so that prefetched openings are used (see list_prefetch_related)
+        openings = sorted(self.openings.all(), key=lambda opening: opening.date_time)
+        doors = ', '.join(field_render(str(opening.door_id), link_target_url(opening, link)) for opening in openings)
+        return f"{self.date_time} - Visit for {humanize.precisedelta(self.duration, format='%0.1f')} opening doors {doors}"
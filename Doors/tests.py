@@ -1,3 +1,1415 @@
-from django.test import TestCase
+import os, math, random, shutil, tempfile, threading, numpy as np
 
-# Create your tests here.
+from collections import Counter
+from unittest import skipUnless, mock
+from datetime import date, datetime, timedelta
+
+from django.core.exceptions import BadRequest
+from django.core.management import call_command
+from django.http import QueryDict
+from django.http.response import HttpResponse
+from django.db import connection
+from django.db.models.functions import Trunc
+from django.test import TestCase, TransactionTestCase, RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.views import View
+
+from Doors.models import Door, Event, Opening, Visit, Uptime, UptimeSketch, DerivationState, DataFetch, Histogram, DailyRollup
+from Doors.models.plans import check_plans, seq_scans
+from Doors.models.pipeline import Pipeline, STAGES
+from Doors.models.conf import VISIT_SEPARATION, BATTERY_POINTS
+from Doors.models.battery import lttb, replacement
+from Doors.models.overlaps import open_door_durations
+from Doors.models import shadow
+from Doors.models.histogram import DURATION_CATEGORIES
+from Doors.models.rollup import ROLLUP_HISTOGRAMS
+from Doors.models import columns
+from Doors.views.cache import CachedPage, page_cache
+from Doors.views.context import general_context
+from Doors.views.doors import graph, trends_range
+from Doors.views.generic import with_related
+from Doors.views import keyset
+from Site.logutils import QueryCountMiddleware
+
+
+def synthetic_log(count, start=1670000000000, step=60000):
+    '''
+    A list of Tuya log entries, as found in the logs of a tinytuya.Cloud.getdevicelog result,
+    alternating door open and close events.
+    '''
+    return [{'event_id': 7,
+             'event_from': '1',
+             'event_time': start + i * step,
+             'code': 'doorcontact_state',
+             'value': 'true' if i % 2 == 0 else 'false'} for i in range(count)]
+
+
+def synthetic_events(door, count, start=1670000000000, seed=1):
+    '''
+    Saves count door contact events for door, mostly alternating Open and Closed but with
+    the occasional bounce (repeated Open or Closed), as the sensors deliver them.
+    '''
+    rng = random.Random(seed)
+    events = []
+    timestamp = start
+    is_open = False
+    for i in range(count):
+        timestamp += rng.randint(1000, 600000)
+        if rng.random() > 0.05:
+            is_open = not is_open
+        events.append(Event(timestamp=timestamp, source="device itself", code="doorcontact_state", type="data report",
+                            value="Open" if is_open else "Closed", door=door))
+    Event.objects.bulk_create(events)
+    return events
+
+
+class FakeCloud:
+    '''
+    Stands in for tinytuya.Cloud, serving a canned log in pages, using the offset of the
+    page as its row key. Can be asked to fail after a number of calls, to simulate an
+    interrupted fetch.
+    '''
+
+    def __init__(self, logs, page_size=3, fail_after=None):
+        self.logs = logs
+        self.page_size = page_size
+        self.fail_after = fail_after
+        self.row_keys = []
+
+    def getdevicelog(self, deviceid, start=None, end=None, size=0, max_fetches=50, start_row_key=None, **kwargs):
+        if self.fail_after is not None and len(self.row_keys) >= self.fail_after:
+            raise ConnectionError("Fake network failure")
+
+        self.row_keys.append(start_row_key)
+
+        offset = int(start_row_key) if start_row_key else 0
+        end = offset + self.page_size
+        has_next = end < len(self.logs)
+
+        return {'result': {'logs': self.logs[offset:end],
+                           'current_row_key': str(offset),
+                           'has_next': has_next,
+                           'next_row_key': str(end) if has_next else None},
+                'success': True}
+
+
+class FetchTests(TestCase):
+
+    def setUp(self):
+        # Just the one door (the migrations add the Montagu Street Library's doors)
+        Door.objects.all().delete()
+        self.door = Door.objects.create(tuya_device_id="fake", contents="Test door")
+        self.logs = synthetic_log(10)
+
+        # Fetches write a column cache, which is kept apart
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        cache = override_settings(COLUMN_CACHE=directory)
+        cache.enable()
+        self.addCleanup(cache.disable)
+
+    def test_pages_follow_row_keys(self):
+        cloud = FakeCloud(self.logs)
+        pages = list(DataFetch.log_pages(cloud, self.door, start=1, verbosity=0))
+
+        self.assertEqual(len(pages), 4)
+        self.assertEqual(cloud.row_keys, [None, "3", "6", "9"])
+        self.assertEqual([e for log, row_key in pages for e in log['result']['logs']], self.logs)
+        self.assertEqual([row_key for log, row_key in pages], ["3", "6", "9", None])
+
+    def test_fetch_saves_every_page(self):
+        DataFetch.fetch_logs(cloud=FakeCloud(self.logs), rate=0, verbosity=0)
+
+        self.assertEqual(Event.objects.count(), 10)
+        self.assertTrue(DataFetch.objects.get().complete)
+
+    def test_interrupted_fetch_resumes(self):
+        with self.assertRaises(ConnectionError):
+            DataFetch.fetch_logs(cloud=FakeCloud(self.logs, fail_after=2), rate=0, verbosity=0)
+
+        fetch = DataFetch.objects.get()
+        self.assertFalse(fetch.complete)
+        self.assertEqual(fetch.row_keys[str(self.door.id)]["row_key"], "6")
+        self.assertEqual(Event.objects.count(), 6)
+
+        cloud = FakeCloud(self.logs)
+        DataFetch.fetch_logs(cloud=cloud, rate=0, verbosity=0)
+
+        self.assertEqual(cloud.row_keys, ["6", "9"])
+        self.assertEqual(Event.objects.count(), 10)
+        self.assertEqual(DataFetch.objects.get().pk, fetch.pk)
+        self.assertTrue(DataFetch.objects.get().complete)
+
+    def test_every_finish_is_a_new_version(self):
+        DataFetch.fetch_logs(cloud=FakeCloud(self.logs), rate=0, budget=2, verbosity=0)
+        version = DataFetch.version()
+        self.assertIsNotNone(version)
+        self.assertFalse(DataFetch.objects.get().complete)
+
+        # Resumed, the same fetch finishes again, with more data
+        DataFetch.fetch_logs(cloud=FakeCloud(self.logs), rate=0, verbosity=0)
+        self.assertEqual(DataFetch.objects.count(), 1)
+        self.assertGreater(DataFetch.version(), version)
+        self.assertEqual(columns.current_version(columns.cache_dir()), DataFetch.version())
+
+    def test_colliding_events_are_not_counted(self):
+        # The timestamp is the primary key, so an event on another door at the same time is not saved
+        other = Door.objects.create(tuya_device_id="other", contents="Other door")
+        Event.objects.create(timestamp=self.logs[0]['event_time'], source="device itself", code="doorcontact_state",
+                             type="data report", value="Open", door=other)
+
+        with self.assertLogs("MSL", "WARNING") as logged:
+            added = Event.save_logs(self.door, {'result': {'logs': self.logs}}, bulk=True)
+
+        self.assertEqual(added, 9)
+        self.assertEqual(len(logged.records), 1)
+        self.assertEqual(Event.objects.filter(door=self.door).count(), 9)
+
+
+class FakeClouds:
+    '''
+    Stands in for tinytuya.Cloud serving the logs of several doors, keyed on their Tuya device ID,
+    each from its own FakeCloud.
+    '''
+
+    def __init__(self, clouds):
+        self.clouds = clouds
+
+    def getdevicelog(self, deviceid, **kwargs):
+        return self.clouds[deviceid].getdevicelog(deviceid, **kwargs)
+
+
+class ConcurrentFetchTests(TransactionTestCase):
+    '''
+    Doors fetched concurrently, in worker threads, each with its own database connection (and so not
+    in a TestCase, whose data other connections never see).
+    '''
+
+    def setUp(self):
+        Door.objects.all().delete()
+        self.doors = [Door.objects.create(tuya_device_id=f"fake{i}", contents=f"Test door {i}") for i in range(2)]
+        self.logs = {door.tuya_device_id: synthetic_log(10, start=1670000000000 + i) for i, door in enumerate(self.doors)}
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        cache = override_settings(COLUMN_CACHE=directory)
+        cache.enable()
+        self.addCleanup(cache.disable)
+
+    def test_failed_page_leaves_no_checkpoint(self):
+        steady, failing = self.doors
+        failed = threading.Event()
+        checkpoint = DataFetch.checkpoint
+        fetch_door_in_thread = DataFetch.fetch_door_in_thread
+
+        # The failing door's second page fails once checkpointed (as if its commit failed), and the
+        # steady door only checkpoints once that page has been rolled back
+        def checkpoint_or_fail(fetch, door, start, row_key, done=False):
+            if door == steady:
+                failed.wait(30)
+            checkpoint(fetch, door, start, row_key, done=done)
+            if door == failing and row_key == "6":
+                raise ConnectionError("Fake commit failure")
+
+        def fetch_door_and_signal(fetch, cloud, door, verbosity=1):
+            try:
+                return fetch_door_in_thread(fetch, cloud, door, verbosity=verbosity)
+            finally:
+                if door == failing:
+                    failed.set()
+
+        with mock.patch.object(DataFetch, "checkpoint", checkpoint_or_fail), \
+             mock.patch.object(DataFetch, "fetch_door_in_thread", fetch_door_and_signal), \
+             self.assertRaises(ConnectionError):
+            DataFetch.fetch_logs(cloud=FakeClouds({d: FakeCloud(logs) for d, logs in self.logs.items()}), workers=2, rate=0, verbosity=0)
+
+        fetch = DataFetch.objects.get()
+        self.assertFalse(fetch.complete)
+        self.assertTrue(fetch.row_keys[str(steady.id)]["done"])
+        self.assertEqual(fetch.row_keys[str(failing.id)]["row_key"], "3")
+        self.assertEqual(Event.objects.filter(door=steady).count(), 10)
+        self.assertEqual(Event.objects.filter(door=failing).count(), 3)
+
+        # Resumed from the first page not saved
+        clouds = {d: FakeCloud(logs) for d, logs in self.logs.items()}
+        DataFetch.fetch_logs(cloud=FakeClouds(clouds), workers=2, rate=0, verbosity=0)
+
+        self.assertEqual(clouds[failing.tuya_device_id].row_keys, ["3", "6", "9"])
+        self.assertEqual(Event.objects.count(), 20)
+        self.assertTrue(DataFetch.objects.get().complete)
+
+
+class OpeningTests(TestCase):
+
+    def setUp(self):
+        Door.objects.all().delete()
+        self.door = Door.objects.create(tuya_device_id="fake", contents="Test door")
+        synthetic_events(self.door, 2000)
+
+    def pairs(self):
+        return list(Opening.objects.order_by("date_time").values_list("open_event_id", "close_event_id", "duration"))
+
+    def test_bulk_matches_each(self):
+        Opening.update_from_events(self.door, Rebuild=True, bulk=False)
+        each_pairs = self.pairs()
+
+        Opening.update_from_events(self.door, Rebuild=True, bulk=True)
+        bulk_pairs = self.pairs()
+
+        self.assertTrue(len(bulk_pairs) > 900)
+        self.assertEqual(bulk_pairs, each_pairs)
+
+    def test_bulk_is_incremental(self):
+        Opening.update_from_events(self.door)
+        count = Opening.objects.count()
+
+        # A rebuild finds them all recorded already, and an update finds nothing new
+        self.assertEqual(Opening.update_from_events(self.door, rebuild=True), [])
+        self.assertEqual(Opening.update_from_events(self.door), [])
+        self.assertEqual(Opening.objects.count(), count)
+
+    def test_change_of_door_is_warned(self):
+        Opening.update_from_events(self.door)
+
+        # An opening recorded against another door is found, not recorded again
+        other = Door.objects.create(tuya_device_id="other", contents="Other door")
+        Opening.objects.filter(pk=Opening.objects.order_by("date_time").first().pk).update(door=other)
+        count = Opening.objects.count()
+
+        for engine in ({"bulk": True}, {"vectorized": True}):
+            with self.assertLogs("MSL", "WARNING") as logged:
+                Opening.update_from_events(self.door, rebuild=True, **engine)
+            self.assertEqual(logged.output, ["WARNING:MSL:Apparant, unexpected, change in Opening door"], engine)
+            self.assertEqual(Opening.objects.count(), count)
+
+
+class VisitTests(TestCase):
+
+    def setUp(self):
+        Door.objects.all().delete()
+        self.door = Door.objects.create(tuya_device_id="fake", contents="Test door")
+        synthetic_events(self.door, 400)
+        Opening.update_from_events(self.door)
+
+    def test_rebuild_query_count(self):
+        batch_size = 10
+        openings = Opening.objects.count()
+        Visit.update_from_openings(batch_size=batch_size)
+        visits = Visit.objects.count()
+        self.assertTrue(visits > 1)
+        Visit.objects.all().delete()
+
+        # A savepoint and its release, visits to delete (none), the openings, visits recorded, the state
+        # recorded, then per batch one insert of visits and one update of openings
+        with self.assertNumQueries(2 + 4 + math.ceil(visits / batch_size) + math.ceil(openings / batch_size)):
+            Visit.update_from_openings(Rebuild=True, batch_size=batch_size)
+
+        # Rebuilding finds the visits recorded and openings pointing at them, so updates just the visits
+        with self.assertNumQueries(2 + 3 + math.ceil(visits / batch_size)):
+            Visit.update_from_openings(rebuild=True, batch_size=batch_size)
+
+        self.assertEqual(Visit.objects.count(), visits)
+        self.assertFalse(Opening.objects.filter(visit=None).exists())
+
+    def test_doors_open_spans_visit(self):
+        Visit.update_from_openings()
+
+        for visit in Visit.objects.all():
+            self.assertEqual(sum(visit.doors_open_durations, timedelta()), visit.duration)
+
+        histogram = Visit.histogram("overlap_durations")
+        self.assertIn("1 open", histogram)
+
+    def test_doors_open_with_inverted_openings(self):
+        # When daylight saving ends an opening can end before it starts, it's counted as open no time
+        t = datetime(2022, 4, 3, 2, 30)
+        spans = [(t, t + timedelta(minutes=2), 1), (t + timedelta(minutes=1), t - timedelta(minutes=50), 2)]
+
+        with self.assertLogs("MSL", "WARNING"):
+            self.assertEqual(open_door_durations(spans), [timedelta(), timedelta(minutes=2)])
+            self.assertEqual(open_door_durations(spans[1:]), [])
+
+
+class HistogramTests(TestCase):
+
+    def setUp(self):
+        Door.objects.all().delete()
+        self.door = Door.objects.create(tuya_device_id="fake", contents="Test door")
+        synthetic_events(self.door, 400)
+        Opening.update_from_events(self.door)
+        Visit.update_from_openings()
+
+    def test_refresh_is_consistent(self):
+        Histogram.refresh()
+        self.assertEqual(Histogram.verify(), [])
+
+        with self.assertNumQueries(1):
+            histograms = Histogram.all()
+
+        self.assertEqual(histograms[(Visit, "day", None)], Visit.histogram("day"))
+
+    def test_refresh_follows_new_data(self):
+        Histogram.refresh()
+
+        synthetic_events(self.door, 100, start=Event.last().timestamp + 1000)
+        Opening.update_from_events(self.door)
+        Visit.update_from_openings()
+        self.assertNotEqual(Histogram.verify(), [])
+
+        Histogram.refresh()
+        self.assertEqual(Histogram.verify(), [])
+
+    def test_refresh_from_rollups(self):
+        DailyRollup.update()
+
+        # Summed from the rollups, no Visits are read (and Openings only for the first)
+        with CaptureQueriesContext(connection) as captured:
+            Histogram.refresh()
+        self.assertFalse([q for q in captured.captured_queries if Visit._meta.db_table in q["sql"]])
+        self.assertEqual(len([q for q in captured.captured_queries if Opening._meta.db_table in q["sql"]]), 1)
+        self.assertEqual(Histogram.verify(), [])
+
+        # A fetch's new events, and the rollups of the days it touched
+        fetch = DataFetch.objects.create(date_time=datetime.now())
+        new_events = synthetic_events(self.door, 100, start=Event.last().timestamp + 1000)
+        Event.objects.filter(timestamp__in=[e.timestamp for e in new_events]).update(data_fetch=fetch)
+        Opening.update_from_events(self.door)
+        Visit.update_from_openings()
+        DailyRollup.update(*DailyRollup.touched(fetch))
+
+        Histogram.refresh()
+        self.assertEqual(Histogram.verify(), [])
+
+    def test_refresh_from_scratch_until_rollups_cover_all_days(self):
+        DailyRollup.update(start=Visit.objects.order_by("date_time").last().date_time.date())
+        self.assertFalse(DailyRollup.cover_all_days())
+
+        Histogram.refresh()
+        self.assertEqual(Histogram.verify(), [])
+
+
+class RollupTests(TestCase):
+
+    def setUp(self):
+        Door.objects.all().delete()
+        self.doors = [Door.objects.create(tuya_device_id=f"door{i}") for i in range(2)]
+
+        # Openings and battery reports spread over a fortnight, minutes to hours apart, so there are many visits
+        # (and a lull of some days, a quiet time Visit.histogram ignores)
+        rng = random.Random(2)
+        for i, door in enumerate(self.doors):
+            events, timestamp = [], 1670000000000 + 2 * i
+            for n in range(300):
+                timestamp += rng.randint(1000, 8000000) if n % 2 == 0 else rng.randint(1000, 120000)
+                if n == 150:
+                    timestamp += 3 * 86400000
+                events.append(Event(timestamp=timestamp, source="device itself", code="doorcontact_state", type="data report",
+                                    value="Open" if n % 2 == 0 else "Closed", door=door))
+                if n % 25 == 1:
+                    events.append(Event(timestamp=timestamp + 1, source="device itself", code="battery_state", type="data report",
+                                        value=["high", "middle", "low"][n // 100], door=door))
+            Event.objects.bulk_create(events)
+            Pipeline(door).run()
+        Visit.update_from_openings()
+
+    def rollups(self):
+        return list(DailyRollup.objects.order_by("door", "date").values_list("door", "date", "openings", "open_time", "first_activity", "last_activity",
+                                                                             "visits", "visits_opened", "battery", "distributions"))
+
+    def test_all_days_match_histograms(self):
+        DailyRollup.update()
+        self.assertTrue(DailyRollup.objects.count() > 10)
+        self.assertEqual(sum(DailyRollup.objects.values_list("visits", flat=True)), Visit.objects.count())
+
+        histograms = DailyRollup.histograms()
+        for model, htype, categories in ROLLUP_HISTOGRAMS:
+            self.assertEqual(histograms[(model, htype, categories)], model.histogram(htype, categories), (model.__name__, htype, categories))
+
+    def test_range_of_days(self):
+        DailyRollup.update()
+        start = Visit.objects.order_by("date_time").first().date_time.date() + timedelta(days=3)
+        end = start + timedelta(days=4)
+
+        with self.assertNumQueries(2):
+            histograms = DailyRollup.histograms(start, end)
+
+        visits = Visit.objects.filter(date_time__date__gte=start, date_time__date__lte=end)
+        openings = Opening.objects.filter(date_time__date__gte=start, date_time__date__lte=end)
+        self.assertTrue(0 < visits.count() < Visit.objects.count())
+        self.assertEqual(sum(histograms[(Visit, "week", None)].values()), visits.count())
+        self.assertEqual(sum(histograms[(Visit, "per_days", None)].values()), len(set(visits.values_list("date_time__date", flat=True))))
+        self.assertEqual(sum(histograms[(Opening, "durations", DURATION_CATEGORIES)].values()), openings.count())
+        self.assertEqual(DailyRollup.summary(start, end)["openings"], openings.count())
+
+    def test_update_of_days_touched_matches_rebuild(self):
+        DailyRollup.update()
+
+        # A fetch of events on the last day and the next
+        last = Event.last()
+        fetch = DataFetch.objects.create(date_time=datetime.now())
+        Event.objects.bulk_create([Event(timestamp=last.timestamp + n * 900000, source="device itself", code="doorcontact_state", type="data report",
+                                         value="Open" if n % 2 else "Closed", door=last.door, data_fetch=fetch) for n in range(1, 200)])
+        Pipeline(last.door).run()
+        Visit.update_from_openings()
+
+        start, end = DailyRollup.touched(fetch)
+        self.assertEqual(start, last.date_time.date() - timedelta(days=1))
+        DailyRollup.update(start, end)
+        incremental = self.rollups()
+
+        DailyRollup.update()
+        self.assertEqual(incremental, self.rollups())
+
+    def test_trends_range(self):
+        today = date.today()
+        self.assertEqual(trends_range(QueryDict("")), (None, None))
+        self.assertEqual(trends_range(QueryDict("days=30")), (today - timedelta(days=29), today))
+        self.assertEqual(trends_range(QueryDict("year=2023")), (date(2023, 1, 1), date(2023, 12, 31)))
+        self.assertEqual(trends_range(QueryDict("start=2023-03-01")), (date(2023, 3, 1), None))
+        for bad in ("days=0", "year=twenty", "end=yesterday"):
+            with self.assertRaises(BadRequest):
+                trends_range(QueryDict(bad))
+
+
+class ColumnCacheTests(TestCase):
+
+    def setUp(self):
+        Door.objects.all().delete()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+        cache = override_settings(COLUMN_CACHE=self.directory)
+        cache.enable()
+        self.addCleanup(cache.disable)
+
+        for i in range(2):
+            door = Door.objects.create(tuya_device_id=f"door{i}")
+            synthetic_events(door, 300, start=1670000000000 + 3 * i, seed=i)
+            synthetic_uptimes(door, 100, start=1670000000001 + 3 * i, seed=i)
+            synthetic_batteries(door, ["high", "middle", "middle", "low", "high", "middle"] * 5, start=1670000000002 + 3 * i)
+        self.fetch = self.fetched(Event.objects.all())
+
+    def fetched(self, events):
+        # A fetch that finished, having saved events, and the data derived from them
+        fetch = DataFetch.objects.create(date_time=datetime.now(), finished=datetime.now(), complete=True)
+        events.update(data_fetch=fetch)
+        for door in Door.objects.all():
+            Pipeline(door).run()
+        Visit.update_from_openings()
+        DataFetch.new_version(fetch)
+        return fetch
+
+    def assertMatchesDatabase(self, cached):
+        for table in columns.TABLES:
+            for column, array in columns.rows(table).items():
+                self.assertTrue(np.array_equal(cached[table][column], array), f"{table}.{column}")
+
+    def test_matches_database(self):
+        self.assertIsNone(columns.current())
+        columns.refresh(self.fetch.data_version)
+
+        cached = columns.current()
+        self.assertMatchesDatabase(cached)
+        self.assertIsInstance(cached["events"]["timestamp"], np.memmap)
+        self.assertFalse(cached["events"]["timestamp"].flags.writeable)
+
+        # Analytics over the columns agree with the ORM, and ask the database only for the version of the data
+        with self.assertNumQueries(1):
+            series = Event.battery_series()
+        self.assertEqual(series, Event.battery_series(cache=False))
+        self.assertEqual(len(series), 2)
+
+        thresholds = [timedelta(minutes=m) for m in (1, 3, VISIT_SEPARATION)]
+        self.assertEqual(Visit.segmentation(thresholds), Visit.segmentation(thresholds, cache=False))
+
+        histograms = [(Visit, "per_days", None), (Visit, "day", None), (Visit, "durations", DURATION_CATEGORIES),
+                      (Visit, "quiet_times", timedelta(minutes=30)), (Opening, "durations", DURATION_CATEGORIES)]
+        for model, htype, categories in histograms:
+            with self.assertNumQueries(1):
+                histogram = model.histogram(htype, categories)
+            self.assertEqual(histogram, model.histogram(htype, categories, cache=False), (model.__name__, htype))
+
+    def test_only_current_version_is_read(self):
+        columns.refresh(self.fetch.data_version)
+        self.assertIsNotNone(columns.current())
+
+        # A fetch finished and not yet cached
+        later = DataFetch.objects.create(date_time=datetime.now(), finished=datetime.now(), complete=True)
+        version = DataFetch.new_version(later)
+        self.assertIsNone(columns.current())
+        self.assertEqual(Event.battery_series(), Event.battery_series(cache=False))
+
+        columns.refresh(version)
+        self.assertIsNotNone(columns.current())
+        self.assertEqual(sorted(os.listdir(self.directory)), sorted(["current", str(version)]))
+
+    def test_refresh_is_incremental(self):
+        columns.refresh(self.fetch.data_version)
+        opened = columns.current()
+        rows = {table: len(opened[table][columns.TIME_COLUMNS[table]]) for table in columns.TABLES}
+
+        # A fetch of events a day on, on one door
+        last = Event.last()
+        Event.objects.bulk_create([Event(timestamp=last.timestamp + 86400000 + n * 300000, source="device itself", code="doorcontact_state", type="data report",
+                                         value="Closed" if n % 2 else "Open", door=last.door) for n in range(40)])
+        fetch = self.fetched(Event.objects.filter(data_fetch=None))
+
+        kept = columns.refresh(fetch.data_version)
+        for table in columns.TABLES:
+            self.assertTrue(0 < kept[table] <= rows[table], table)
+        self.assertTrue(kept["events"] < Event.objects.count())
+        self.assertMatchesDatabase(columns.current())
+
+        # The version read before is unchanged (a worker can go on reading it)
+        self.assertEqual(len(opened["events"]["timestamp"]), rows["events"])
+
+    def test_resumed_fetch_is_cached(self):
+        columns.refresh(self.fetch.data_version)
+
+        # The same fetch, resumed, saves events a day on, on one door, and finishes again
+        last = Event.last()
+        Event.objects.bulk_create([Event(timestamp=last.timestamp + 86400000 + n * 300000, source="device itself", code="doorcontact_state", type="data report",
+                                         value="Closed" if n % 2 else "Open", door=last.door, data_fetch=self.fetch) for n in range(40)])
+        for door in Door.objects.all():
+            Pipeline(door).run()
+        Visit.update_from_openings()
+
+        columns.refresh(DataFetch.new_version(self.fetch))
+        self.assertMatchesDatabase(columns.current())
+
+    def test_version_written_again(self):
+        columns.refresh(self.fetch.data_version)
+        Visit.objects.filter(pk=Visit.objects.order_by("date_time").first().pk).delete()
+
+        self.assertEqual(columns.refresh(self.fetch.data_version)["visits"], 0)
+        self.assertMatchesDatabase(columns.current())
+
+    def test_rebuilt_visits_are_cached(self):
+        columns.refresh(self.fetch.data_version)
+
+        # Openings and Visits changed, and rebuilt, other than by a fetch (a new version of the data)
+        Opening.objects.filter(pk=Opening.objects.order_by("date_time").first().pk).delete()
+        call_command("update_visits", Rebuild=True, verbosity=0)
+
+        self.assertMatchesDatabase(columns.current())
+
+    def test_histograms_refreshed_from_the_database(self):
+        columns.refresh(self.fetch.data_version)
+
+        # Visits changed as by a fetch still deriving data (the cache still current, of the last version)
+        Visit.objects.filter(pk=Visit.objects.order_by("date_time").first().pk).delete()
+        self.assertIsNotNone(columns.current())
+
+        Histogram.refresh(rebuild=True)
+        self.assertEqual(Histogram.verify(), [])
+        self.assertEqual(Histogram.live(Visit, "durations", DURATION_CATEGORIES),
+                         [[category, count] for category, count in Visit.histogram("durations", DURATION_CATEGORIES, cache=False).items()])
+
+    def test_rows_changed_otherwise_are_rewritten(self):
+        columns.refresh(self.fetch.data_version)
+        Visit.objects.filter(pk=Visit.objects.order_by("date_time").first().pk).delete()
+        later = DataFetch.objects.create(date_time=datetime.now(), finished=datetime.now(), complete=True)
+
+        self.assertEqual(columns.refresh(DataFetch.new_version(later))["visits"], 0)
+        self.assertMatchesDatabase(columns.current())
+
+
+class CachedPageTests(TestCase):
+
+    renders = 0
+
+    class CountedView(View):
+        def get(self, request, *args, **kwargs):
+            CachedPageTests.renders += 1
+            return HttpResponse(f"Render {CachedPageTests.renders}")
+
+    class CachedView(CachedPage, CountedView):
+        pass
+
+    def setUp(self):
+        CachedPageTests.renders = 0
+        page_cache().clear()
+        self.request = RequestFactory().get("/cached/")
+        self.view = self.CachedView.as_view()
+
+    def test_cached_until_next_fetch(self):
+        DataFetch.new_version(DataFetch.objects.create(date_time=datetime.now(), finished=datetime.now()))
+
+        self.assertEqual(self.view(self.request).content, b"Render 1")
+        self.assertEqual(self.view(self.request).content, b"Render 1")
+
+        # A fetch in progress changes nothing, one that's finished invalidates the page
+        fetch = DataFetch.objects.create(date_time=datetime.now())
+        self.assertEqual(self.view(self.request).content, b"Render 1")
+
+        fetch.finished = datetime.now()
+        fetch.save()
+        DataFetch.new_version(fetch)
+        self.assertEqual(self.view(self.request).content, b"Render 2")
+
+        # As does the same fetch finishing again, resumed
+        DataFetch.new_version(fetch)
+        self.assertEqual(self.view(self.request).content, b"Render 3")
+
+    @override_settings(COLUMN_CACHE=None)
+    def test_cached_until_data_changed(self):
+        DataFetch.new_version(DataFetch.objects.create(date_time=datetime.now(), finished=datetime.now()))
+        self.assertEqual(self.view(self.request).content, b"Render 1")
+
+        # Data derived other than by a fetch invalidates the page too
+        call_command("update_histograms", verbosity=0)
+        self.assertEqual(self.view(self.request).content, b"Render 2")
+
+        # While a check changes nothing
+        call_command("update_histograms", check=True, verbosity=0)
+        self.assertEqual(self.view(self.request).content, b"Render 2")
+
+
+class DataStatsTests(TestCase):
+
+    def setUp(self):
+        Door.objects.all().delete()
+        door = Door.objects.create(tuya_device_id="door1")
+        synthetic_events(door, 100)
+        Opening.update_from_events(door)
+        Visit.update_from_openings()
+        DataFetch.objects.create(date_time=datetime.now(), finished=datetime.now(), stats=DataFetch.live_stats())
+
+        self.view = View()
+        self.view.request = RequestFactory().get("/")
+        self.view.request.resolver_match = type("ResolverMatch", (), {"view_name": "home"})
+
+    def test_general_context_in_one_query(self):
+        with self.assertNumQueries(1):
+            stats = general_context(self.view, {})["data_stats"]
+
+        self.assertEqual(stats["event_count"], 100)
+        self.assertEqual(stats["open_count"], Opening.objects.count())
+        self.assertEqual(stats["visit_count"], Visit.objects.count())
+        self.assertEqual(stats["first_event"], Event.first().date_time)
+        self.assertEqual(stats["last_event"], Event.last().date_time)
+
+    def test_query_count_middleware(self):
+        def get_response(request):
+            general_context(self.view, {})
+            return HttpResponse()
+
+        with override_settings(QUERY_COUNT_HEADERS=True):
+            response = QueryCountMiddleware(get_response)(self.view.request)
+        self.assertEqual(response["X-Query-Count"], "1")
+        self.assertEqual(self.view.request.query_count, 1)
+
+        # And not on the live site
+        with override_settings(QUERY_COUNT_HEADERS=False):
+            response = QueryCountMiddleware(get_response)(self.view.request)
+        self.assertFalse(response.has_header("X-Query-Count"))
+        self.assertFalse(response.has_header("Server-Timing"))
+
+
+class OrphanTests(TestCase):
+
+    def setUp(self):
+        Door.objects.all().delete()
+        for i in range(2):
+            door = Door.objects.create(tuya_device_id=f"door{i}")
+            synthetic_events(door, 200, seed=i)
+            Opening.update_from_events(door)
+
+    def test_analysis_matches_neighbours(self):
+        orphans = Event.orphan_analysis()
+        self.assertEqual([o.timestamp for o in orphans], [e.timestamp for e in Event.orphans.order_by("door_id", "timestamp")])
+
+        for o in orphans:
+            event = Event.objects.get(pk=o.timestamp)
+            before, after = event.neighbours
+            self.assertEqual(o.door_id, event.door_id)
+            self.assertEqual(o.before, (before.neighbours[0].value if before and before.neighbours[0] else None, before.value if before else None))
+            self.assertEqual(o.after, (after.value if after else None, after.neighbours[1].value if after and after.neighbours[1] else None))
+            self.assertEqual(o.valid, bool(before and after and before.value == after.value))
+
+    def test_analysis_in_one_query(self):
+        with self.assertNumQueries(1):
+            orphans = Event.orphan_analysis()
+        self.assertGreater(len(orphans), 2)
+
+
+class PairingTests(TestCase):
+
+    def setUp(self):
+        Door.objects.all().delete()
+        self.door = Door.objects.create(tuya_device_id="door1")
+        synthetic_events(self.door, 200)
+
+    def test_pairing_follows_openings(self):
+        self.assertEqual(Event.orphans.count(), 200)
+
+        Opening.update_from_events(self.door)
+        anti_join = Event.objects.filter(openings__isnull=True, closings__isnull=True, code='doorcontact_state')
+        self.assertEqual(set(Event.orphans), set(anti_join))
+        self.assertEqual(Event.objects.filter(pairing="open").count(), Opening.objects.count())
+        self.assertEqual(Event.pairing_drift(), {})
+
+        # New events after the last opening are pending until paired
+        last = Event.objects.order_by("-timestamp").first()
+        synthetic_events(self.door, 20, start=last.timestamp + 1, seed=2)
+        Opening.update_from_events(self.door)
+        self.assertEqual(set(Event.orphans), set(anti_join))
+        self.assertEqual(Event.pairing_drift(), {})
+
+    def test_drift_is_reported_and_fixed(self):
+        Opening.update_from_events(self.door)
+        Event.objects.filter(pairing="open").update(pairing="orphan")
+
+        drift = Event.pairing_drift(fix=True)
+        self.assertEqual(drift, {("doorcontact_state", "orphan", "open"): Opening.objects.count()})
+        self.assertEqual(Event.pairing_drift(), {})
+
+
+@skipUnless(connection.vendor == "postgresql", "Query plans are only checked on PostgreSQL")
+class QueryPlanTests(TestCase):
+    """
+    A small dataset is scanned sequentially however well indexed, so sequential scans are disabled
+    and the planner uses an index wherever one can serve, which must be the one designed for the query
+    (see HOT_INDEXES). The explain_queries command does the same checks against a large dataset with
+    the planner's defaults.
+    """
+
+    def setUp(self):
+        Door.objects.all().delete()
+
+        # Several doors, with their uptimes, so that an index on time alone is not as cheap as one on door and code,
+        # and one whose openings are not yet in visits (as Visit.update_from_openings resumes from)
+        for i in range(4):
+            door = Door.objects.create(tuya_device_id=f"door{i}")
+            synthetic_events(door, 200, start=1670000000000 + 2 * i, seed=i)
+            synthetic_uptimes(door, 50, start=1670000000001 + 2 * i, seed=i)
+            if i == 3:
+                Visit.update_from_openings()
+            Pipeline(door).run()
+        self.door = door
+
+        # With statistics of this dataset (not those left by another test), for the planner to choose by
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE "Doors_event", "Doors_opening", "Doors_uptime", "Doors_visit"')
+            cursor.execute("SET LOCAL enable_seqscan = off")
+
+    def test_hot_queries_use_indexes(self):
+        recent = Event.objects.order_by("-timestamp").values_list("timestamp", flat=True)[10]
+        self.assertEqual(check_plans(self.door, recent), {})
+
+    def test_lost_indexes_are_found(self):
+        # Another index serves the query, if not as well
+        with connection.cursor() as cursor:
+            cursor.execute("DROP INDEX opening_unvisited")
+
+        recent = Event.objects.order_by("-timestamp").values_list("timestamp", flat=True)[10]
+        self.assertEqual(check_plans(self.door, recent), {"Visit.update_from_openings (resume)": ["opening_unvisited not used"]})
+
+    def test_sequential_scans_are_found(self):
+        self.assertEqual(seq_scans(Event.objects.filter(source="device itself")), ["Doors_event"])
+
+
+class BinningTests(TestCase):
+
+    def setUp(self):
+        Door.objects.all().delete()
+        for i in range(3):
+            door = Door.objects.create(tuya_device_id=f"door{i}")
+            synthetic_events(door, 300, seed=i)
+            Opening.update_from_events(door)
+        Visit.update_from_openings()
+
+    def test_durations_binned_as_in_python(self):
+        width = timedelta(seconds=30)
+        for model in (Visit, Opening):
+            buckets = Counter(round(d / width) for d in model.objects.values_list("duration", flat=True))
+            self.assertEqual(list(model.histogram("durations", width).values()), [buckets[b] for b in sorted(buckets)])
+
+    def test_quiet_times_binned_as_in_python(self):
+        width = timedelta(minutes=30)
+        quiets = Visit.objects.filter(prior_quiet__lte=timedelta(days=1)).values_list("prior_quiet", flat=True)
+        buckets = Counter(round(q / width) for q in quiets)
+        self.assertEqual(list(Visit.histogram("quiet_times", width).values()), [buckets[b] for b in range(max(buckets) + 1)])
+
+    def test_doors_per_visit_in_one_query(self):
+        visits = Visit.objects.prefetch_related("openings")
+        total = Counter(len(v.openings.all()) for v in visits)
+        unique = Counter(len({o.door_id for o in v.openings.all()}) for v in visits)
+
+        with self.assertNumQueries(2):
+            self.assertEqual(Visit.histogram("doors_per_visit_total"), dict(sorted(total.items())))
+            self.assertEqual(Visit.histogram("doors_per_visit_unique"), dict(sorted(unique.items())))
+
+
+def synthetic_uptimes(door, count, start=1670000000000, seed=1):
+    '''
+    Saves count online and offline events for door, alternating, with uptimes from a second to a day.
+    '''
+    rng = random.Random(seed)
+    events = []
+    timestamp = start
+    for i in range(count):
+        timestamp += int(rng.lognormvariate(12, 2)) + 1 if i % 2 == 0 else rng.randint(1000, 60000)
+        events.append(Event(timestamp=timestamp, source="device itself", code="updown_state", type="online" if i % 2 == 0 else "offline",
+                            value="", door=door))
+    Event.objects.bulk_create(events)
+    return events
+
+
+class SketchTests(TestCase):
+
+    def setUp(self):
+        Door.objects.all().delete()
+        self.doors = [Door.objects.create(tuya_device_id=f"door{i}") for i in range(2)]
+        for i, door in enumerate(self.doors):
+            synthetic_uptimes(door, 1000, start=1670000000000 + i, seed=i)
+            Uptime.update_from_events(door)
+
+    def test_statistics_match_uptimes(self):
+        seconds = sorted(d.total_seconds() for d in Uptime.objects.values_list("duration", flat=True))
+        stats = Uptime.statistics()
+
+        self.assertEqual(stats["count"], len(seconds))
+        self.assertAlmostEqual(stats["min"].total_seconds(), seconds[0], places=3)
+        self.assertAlmostEqual(stats["max"].total_seconds(), seconds[-1], places=3)
+        self.assertAlmostEqual(stats["avg"].total_seconds(), sum(seconds) / len(seconds), places=3)
+
+        for q, estimate in stats["quantiles"].items():
+            exact = seconds[math.floor(q * (len(seconds) - 1))]
+            self.assertLessEqual(abs(estimate.total_seconds() - exact), exact * 0.01 + 1e-6)
+
+        self.assertEqual(sum(Uptime.histogram().values()), len(seconds))
+
+    def test_incremental_sketch_matches_rebuild(self):
+        door = self.doors[0]
+        last = Event.objects.filter(door=door).order_by("-timestamp").first()
+        synthetic_uptimes(door, 100, start=last.timestamp + 2, seed=3)
+        Uptime.update_from_events(door)
+        incremental = UptimeSketch.objects.get(door=door).sketch
+
+        UptimeSketch.update(door, rebuild=True)
+        rebuilt = UptimeSketch.objects.get(door=door).sketch
+
+        self.assertEqual(incremental["count"], Uptime.objects.filter(door=door).count())
+        self.assertEqual(incremental["buckets"], rebuilt["buckets"])
+        self.assertAlmostEqual(incremental["total"], rebuilt["total"])
+
+    def test_statistics_read_no_uptimes(self):
+        with self.assertNumQueries(2):
+            Uptime.statistics()
+            Uptime.histogram()
+
+
+class VectorizedPairingTests(TestCase):
+    """
+    Property tests: on randomized event sequences (runs of repeated states, and the odd unknown state),
+    the vectorized engine pairs exactly as the event by event state machines do.
+    """
+    cases = 30
+
+    def setUp(self):
+        Door.objects.all().delete()
+        self.door = Door.objects.create(tuya_device_id="door1")
+        self.rng = random.Random(16)
+
+    def random_events(self, code, field, states):
+        Event.objects.filter(door=self.door).delete()
+        events = []
+        timestamp = 1670000000000
+        for i in range(self.rng.randint(0, 120)):
+            timestamp += self.rng.randint(1000, 600000)
+            state = self.rng.choice(states) if self.rng.random() > 0.02 else "Unknown"
+            fields = {"type": "data report", "value": "", field: state}
+            events.append(Event(timestamp=timestamp, source="device itself", code=code, door=self.door, **fields))
+        Event.objects.bulk_create(events)
+
+    def test_openings_match_loop(self):
+        for case in range(self.cases):
+            Opening.objects.all().delete()
+            self.random_events("doorcontact_state", "value", ["Open", "Closed"])
+            events = Event.objects.filter(door=self.door, code="doorcontact_state").order_by("timestamp")
+
+            processed, loop, existing, loop_orphans = Opening.update_from_events_each(self.door, events)
+            Opening.objects.all().delete()
+            processed, vectorized, existing, vectorized_orphans = Opening.update_from_events_vectorized(self.door, events)
+
+            self.assertEqual([(o.open_event_id, o.close_event_id) for o in vectorized],
+                             [(o.open_event_id, o.close_event_id) for o in loop])
+            self.assertEqual(vectorized_orphans, [e.timestamp for e in loop_orphans])
+
+    def test_uptimes_match_loop(self):
+        for case in range(self.cases):
+            Uptime.objects.all().delete()
+            self.random_events("updown_state", "type", ["online", "offline"])
+            events = Event.objects.filter(door=self.door, code="updown_state").order_by("timestamp")
+
+            Uptime.update_from_events_each(self.door, events)
+            loop = list(Uptime.objects.order_by("date_time").values_list("online_event_id", "offline_event_id"))
+            Uptime.objects.all().delete()
+            processed, new_uptimes, first_new, last_new, existing = Uptime.update_from_events_vectorized(self.door, events)
+
+            self.assertEqual(list(Uptime.objects.order_by("date_time").values_list("online_event_id", "offline_event_id")), loop)
+            self.assertEqual(new_uptimes, len(loop))
+
+    def test_vectorized_is_incremental(self):
+        synthetic_events(self.door, 200)
+        Opening.update_from_events(self.door, vectorized=True)
+        count = Opening.objects.count()
+
+        Opening.update_from_events(self.door, rebuild=True, vectorized=True)
+        self.assertEqual(Opening.objects.count(), count)
+
+
+def synthetic_batteries(door, charges, start=1670000000000, step=3600007):
+    '''
+    Saves a battery_state event for door for each of charges, step milliseconds apart.
+    '''
+    events = [Event(timestamp=start + i * step, source="device itself", code="battery_state", type="data report",
+                    value=charge, door=door) for i, charge in enumerate(charges)]
+    Event.objects.bulk_create(events)
+    return events
+
+
+class PipelineTests(TestCase):
+
+    def setUp(self):
+        Door.objects.all().delete()
+        self.door = Door.objects.create(tuya_device_id="door1")
+        synthetic_events(self.door, 300)
+        synthetic_uptimes(self.door, 300, start=1670000000001)
+        synthetic_batteries(self.door, ["high"] * 5 + ["middle"] * 5)
+
+    def derived(self):
+        return (list(Opening.objects.order_by("date_time").values_list("open_event_id", "close_event_id", "duration")),
+                list(Uptime.objects.order_by("date_time").values_list("online_event_id", "offline_event_id", "duration")),
+                list(Event.objects.order_by("timestamp").values_list("timestamp", "pairing")))
+
+    def test_pipeline_matches_stages(self):
+        Pipeline(self.door).run()
+
+        # And incrementally, as new events arrive
+        last = Event.objects.order_by("-timestamp").first()
+        synthetic_events(self.door, 100, start=last.timestamp + 1, seed=2)
+        synthetic_uptimes(self.door, 100, start=last.timestamp + 2, seed=2)
+        Pipeline(self.door).run()
+        pipelined = self.derived()
+
+        Opening.objects.all().delete()
+        Uptime.objects.all().delete()
+        DerivationState.objects.all().delete()
+        Event.objects.update(pairing="pending")
+        Opening.update_from_events(self.door)
+        Uptime.update_from_events(self.door)
+
+        self.assertTrue(len(pipelined[0]) > 150 and len(pipelined[1]) > 150)
+        for pipelined, derived in zip(pipelined, self.derived()):
+            self.assertEqual(pipelined, derived)
+        self.assertEqual(Event.pairing_drift(), {})
+        self.assertEqual(UptimeSketch.objects.get(door=self.door).sketch["count"], Uptime.objects.count())
+
+    def test_events_read_once(self):
+        with CaptureQueriesContext(connection) as queries:
+            timing = Pipeline(self.door).run()
+
+        # Read in a SELECT (or on PostgreSQL a server side cursor DECLAREd for one)
+        reads = [q["sql"] for q in queries.captured_queries if 'FROM "Doors_event"' in q["sql"]]
+        self.assertEqual(len(reads), 1)
+        self.assertEqual(set(timing), {stage.name for stage in STAGES} | {"read"})
+
+        # And with nothing new, the pipeline derives nothing
+        self.assertEqual(Pipeline(self.door).run().keys(), timing.keys())
+        self.assertEqual(Pipeline(self.door).processed, 0)
+
+    def test_battery_charge_tracked(self):
+        Pipeline(self.door).run()
+        self.door.refresh_from_db()
+        self.assertEqual(self.door.battery, "middle")
+        self.assertEqual(self.door.battery_event_id, 1670000000000 + 5 * 3600007)
+
+        # Reports of the same charge don't move it, a new charge does
+        synthetic_batteries(self.door, ["middle", "low", "low"], start=1680000000000)
+        Pipeline(self.door, stages=[s for s in STAGES if s.name == "battery"]).run()
+        self.door.refresh_from_db()
+        self.assertEqual(self.door.battery, "low")
+        self.assertEqual(self.door.battery_event_id, 1680000000000 + 3600007)
+
+
+class BatterySeriesTests(TestCase):
+
+    def setUp(self):
+        Door.objects.all().delete()
+        self.doors = [Door.objects.create(tuya_device_id=f"door{i}") for i in range(2)]
+
+        # A battery that runs down, and one that flaps between charges as the sensors' coarse reports do
+        synthetic_batteries(self.doors[0], ["high"] * 600 + ["middle"] * 300 + ["low"] * 100)
+        rng = random.Random(1)
+        synthetic_batteries(self.doors[1], [rng.choice(["middle", "high"]) for i in range(3000)], start=1670000000001)
+
+    def test_series_are_bounded(self):
+        with CaptureQueriesContext(connection) as queries:
+            series = Event.battery_series()
+        self.assertEqual(len(queries.captured_queries), 1)
+
+        # The first door's series is its steps, and it went low when the first low was reported
+        steps = series[self.doors[0].id]
+        self.assertEqual(steps["y"], [3, 2, 1, 1])
+        self.assertEqual(steps["x"][-1], Event.days_from_timestamp_diff(999 * 3600007))
+        self.assertEqual(steps["replace"], Event.datetime_from_timestamp(1670000000000 + 900 * 3600007))
+        self.assertEqual(len(steps["smooth_x"]), BATTERY_POINTS)
+
+        # The second door's steps are downsampled, keeping the first and last
+        flaps = series[self.doors[1].id]
+        self.assertEqual(len(flaps["x"]), BATTERY_POINTS)
+        self.assertEqual(flaps["x"][0], 0)
+        self.assertEqual(flaps["x"][-1], Event.days_from_timestamp_diff(2999 * 3600007))
+        self.assertTrue(set(flaps["y"]) == {2, 3})
+
+        self.assertEqual(Event.battery_graph(self.doors[0]), dict(zip(steps["x"], steps["y"])))
+        self.assertTrue(graph(flaps, "Time (days)", "Battery Charge")["div"])
+
+    def test_replacement_projected(self):
+        Event.objects.filter(door=self.doors[0], value="low").delete()
+        replace = Event.battery_series(self.doors[0])[self.doors[0].id]["replace"]
+        self.assertTrue(replace > Event.datetime_from_timestamp(1670000000000 + 899 * 3600007))
+
+        # A new battery resets the projection, and a battery that isn't running down has none
+        synthetic_batteries(self.doors[0], ["high"] * 10, start=1680000000000)
+        self.assertIsNone(Event.battery_series(self.doors[0])[self.doors[0].id]["replace"])
+
+    def test_single_report(self):
+        door = self.doors[1]
+        Event.objects.filter(door=door).delete()
+        synthetic_batteries(door, ["middle"], start=1500000000003)
+
+        series = Event.battery_series(door)[door.id]
+        self.assertEqual(series["y"], [2])
+        self.assertEqual(series["smooth_y"], [2.0] * len(series["smooth_x"]))
+        self.assertIsNone(series["replace"])
+
+    def test_replacement_within_horizon(self):
+        # A battery that reported high for long and only just fell to middle projects no replacement (rather
+        # than one beyond the dates Python can represent)
+        door = self.doors[1]
+        Event.objects.filter(door=door).delete()
+        synthetic_batteries(door, ["high"] * 20000 + ["middle"], start=1500000000003, step=86400000)
+        self.assertIsNone(Event.battery_series(door)[door.id]["replace"])
+
+        x = np.arange(1001, dtype=float)
+        y = np.array([3] * 1000 + [2])
+        self.assertIsNone(replacement(x, y, horizon=365))
+        self.assertGreater(replacement(x, y, horizon=10 ** 9), 1000 + 365)
+
+    def test_lttb_keeps_extremes(self):
+        x = np.arange(10000, dtype=float)
+        y = np.sin(x / 1000)
+        lx, ly = lttb(x, y, 50)
+        self.assertEqual(len(lx), 50)
+        self.assertEqual((lx[0], lx[-1]), (0, 9999))
+        self.assertAlmostEqual(ly.max(), 1, places=3)
+        self.assertAlmostEqual(ly.min(), -1, places=3)
+
+
+class ListRenderingTests(TestCase):
+
+    def setUp(self):
+        Door.objects.all().delete()
+        for i in range(2):
+            door = Door.objects.create(tuya_device_id=f"door{i}")
+            synthetic_events(door, 200, start=1670000000000 + 2 * i, seed=i)
+            synthetic_uptimes(door, 200, start=1670000000001 + 2 * i, seed=i)
+            synthetic_batteries(door, ["high"] * 10, start=1670000000003 + 2 * i)
+
+            # And openings well apart, each a visit
+            Event.objects.bulk_create([Event(timestamp=1680000000000 + 2 * i + n * 1200000 + (60000 if n % 2 else 0), source="device itself",
+                                             code="doorcontact_state", type="data report", value="Closed" if n % 2 else "Open", door=door)
+                                       for n in range(120)])
+            Pipeline(door).run()
+        Visit.update_from_openings()
+
+    def rendering_queries(self, model, size):
+        with CaptureQueriesContext(connection) as queries:
+            for obj in with_related(model.objects.order_by("pk"))[:size]:
+                str(obj)
+                obj.__rich_str__()
+        return len(queries.captured_queries)
+
+    def test_fixed_queries_per_page(self):
+        for model, queries in ((Event, 5), (Opening, 1), (Uptime, 1), (Visit, 2)):
+            self.assertTrue(model.objects.count() >= 50)
+            self.assertEqual(self.rendering_queries(model, 5), queries, model.__name__)
+            self.assertEqual(self.rendering_queries(model, 50), queries, model.__name__)
+
+
+class KeysetTests(TestCase):
+
+    size = 7
+
+    def setUp(self):
+        Door.objects.all().delete()
+        # Two doors with events a millisecond apart, and openings and uptimes truncated to the second, so
+        # that their times tie in pairs and they're ordered by id among them
+        self.doors = [Door.objects.create(tuya_device_id=f"door{i}") for i in range(2)]
+        for i, door in enumerate(self.doors):
+            synthetic_events(door, 60, start=1670000000000 + 2 * i, seed=0)
+            synthetic_uptimes(door, 20, start=1670000000001 + 2 * i, seed=0)
+
+            # And openings well apart, each a visit
+            Event.objects.bulk_create([Event(timestamp=1680000000000 + 2 * i + n * 1200000 + (60000 if n % 2 else 0), source="device itself",
+                                             code="doorcontact_state", type="data report", value="Closed" if n % 2 else "Open", door=door)
+                                       for n in range(40)])
+            Pipeline(door).run()
+        Visit.update_from_openings()
+        for model in (Opening, Uptime):
+            model.objects.update(date_time=Trunc("date_time", "second"))
+
+    def in_order(self, model):
+        return list(model.objects.order_by(*keyset.ordering_keys(model)).values_list("pk", flat=True))
+
+    def pks(self, page):
+        return [obj.pk for obj in page.object_list]
+
+    def test_pages_cover_all_in_order(self):
+        for model in (Event, Opening, Uptime, Visit):
+            expected = self.in_order(model)
+            self.assertTrue(len(expected) > 2 * self.size, model.__name__)
+
+            # Forward from the first page
+            pages = [keyset.KeysetPage(model.objects.all(), size=self.size)]
+            self.assertIsNone(pages[0].prior)
+            while pages[-1].next:
+                pages.append(keyset.KeysetPage(model.objects.all(), after=pages[-1].next, size=self.size))
+            self.assertEqual(sum((self.pks(page) for page in pages), []), expected, model.__name__)
+
+            # And back from the last
+            back = [pages[-1]]
+            while back[0].prior:
+                back.insert(0, keyset.KeysetPage(model.objects.all(), before=back[0].prior, size=self.size))
+            self.assertEqual(sum((self.pks(page) for page in back), []), expected, model.__name__)
+            self.assertEqual([len(self.pks(page)) for page in back[:-1]], [self.size] * (len(back) - 1))
+
+    def test_fixed_queries_however_deep(self):
+        def queries(cursor):
+            with CaptureQueriesContext(connection) as captured:
+                self.pks(keyset.KeysetPage(Event.objects.all(), after=cursor, size=self.size))
+            return len(captured.captured_queries)
+
+        timestamps = list(Event.objects.order_by("timestamp").values_list("timestamp", flat=True))
+        shallow, deep = (keyset.encode((timestamp,)) for timestamp in (timestamps[0], timestamps[-3 * self.size]))
+        self.assertEqual(queries(shallow), queries(deep))
+
+    def test_invalid_cursor(self):
+        for cursor in ("not a cursor", keyset.encode([1]), keyset.encode(["yesterday", 1])):
+            with self.assertRaises(ValueError):
+                keyset.KeysetPage(Opening.objects.all(), after=cursor)
+
+    def test_page_links_keep_parameters(self):
+        params = QueryDict("door=1&elements=brief&after=abc")
+        self.assertEqual(QueryDict(keyset.page_query(params, before="xyz")), QueryDict("door=1&elements=brief&before=xyz"))
+        self.assertEqual(QueryDict(keyset.page_query(params, after="xyz")), QueryDict("door=1&elements=brief&after=xyz"))
+
+    def test_neighbours(self):
+        for model in (Event, Opening, Visit):
+            pks = self.in_order(model)
+            objects = model.objects.in_bulk(pks)
+            self.assertEqual(keyset.neighbours(objects[pks[0]]), (None, pks[1]))
+            self.assertEqual(keyset.neighbours(objects[pks[5]]), (pks[4], pks[6]))
+            self.assertEqual(keyset.neighbours(objects[pks[-1]]), (pks[-2], None))
+
+    def test_previous_opening_of_the_door(self):
+        for door in self.doors:
+            openings = list(Opening.objects.filter(door=door).order_by("date_time", "id"))
+            self.assertIsNone(openings[0].previous)
+            self.assertEqual([opening.previous for opening in openings[1:]], openings[:-1])
+
+
+class DerivationStateTests(TestCase):
+
+    chunks = 6
+
+    def setUp(self):
+        Door.objects.all().delete()
+        self.doors = [Door.objects.create(tuya_device_id=f"door{i}") for i in range(2)]
+
+        # Events on both doors (which interleave, so visits span them) that arrive in chunks, which end
+        # mid visit and with Opens or onlines pending
+        for i, door in enumerate(self.doors):
+            synthetic_events(door, 360, start=1670000000000 + 2 * i, seed=i)
+            synthetic_uptimes(door, 360, start=1670000000001 + 2 * i, seed=i)
+        self.events = list(Event.objects.order_by("timestamp"))
+        Event.objects.all().delete()
+
+    def add_events(self, chunk):
+        size = math.ceil(len(self.events) / self.chunks)
+        Event.objects.bulk_create(self.events[chunk * size:(chunk + 1) * size])
+
+    def derived(self):
+        return [list(Opening.objects.order_by("date_time").values_list("open_event_id", "close_event_id", "visit__date_time")),
+                list(Uptime.objects.order_by("date_time").values_list("online_event_id", "offline_event_id")),
+                list(Visit.objects.order_by("date_time").values_list("date_time", "duration", "prior_quiet", "doors", "overlaps", "doors_open")),
+                list(Event.objects.order_by("timestamp").values_list("timestamp", "pairing"))]
+
+    def test_incremental_matches_rebuild(self):
+        pending = set()
+        for chunk in range(self.chunks):
+            self.add_events(chunk)
+            for door in self.doors:
+                Pipeline(door).run()
+            Visit.update_from_openings()
+            pending |= set(DerivationState.objects.exclude(pending=None).values_list("stage", flat=True))
+
+        # Some chunks ended with an Open and an online pending
+        self.assertEqual(pending, {"openings", "uptimes"})
+        incremental = self.derived()
+
+        for door in self.doors:
+            Pipeline(door, rebuild=True).run()
+        Visit.update_from_openings(Rebuild=True)
+
+        for incremental, rebuilt in zip(incremental, self.derived()):
+            self.assertEqual(incremental, rebuilt)
+
+    def test_lagging_door_matches_rebuild(self):
+        # One door's events all arrive, the other's only in part (its fetch ran out of budget), and the rest
+        # of them later, among openings already in visits
+        steady, lagging = self.doors
+        events = [e for e in self.events if e.door_id == steady.id]
+        lagging_events = [e for e in self.events if e.door_id == lagging.id]
+        Event.objects.bulk_create(events + lagging_events[:len(lagging_events) // 3])
+        for door in self.doors:
+            Pipeline(door).run()
+        Visit.update_from_openings()
+
+        Event.objects.bulk_create(lagging_events[len(lagging_events) // 3:])
+        Pipeline(lagging).run()
+        Visit.update_from_openings()
+
+        self.assertFalse(Opening.objects.filter(visit=None).exists())
+        incremental = self.derived()
+
+        Visit.update_from_openings(Rebuild=True)
+        for incremental, rebuilt in zip(incremental, self.derived()):
+            self.assertEqual(incremental, rebuilt)
+
+    def test_no_lookback_queries(self):
+        self.add_events(0)
+        for door in self.doors:
+            Pipeline(door).run()
+        Visit.update_from_openings()
+
+        self.add_events(1)
+        with CaptureQueriesContext(connection) as queries:
+            for door in self.doors:
+                Pipeline(door).run()
+            Visit.update_from_openings()
+
+        # Openings, Uptimes and Visits are never read in reverse time order to find the last of them
+        lookbacks = [q["sql"] for q in queries.captured_queries if '"date_time" DESC' in q["sql"]]
+        self.assertEqual(lookbacks, [])
+
+
+class SegmentationTests(TestCase):
+
+    def setUp(self):
+        Door.objects.all().delete()
+        for i in range(2):
+            door = Door.objects.create(tuya_device_id=f"door{i}")
+            synthetic_events(door, 200, start=1670000000000 + 2 * i, seed=i)
+            Opening.update_from_events(door)
+        Visit.update_from_openings()
+
+    def test_matches_visits(self):
+        thresholds = [timedelta(minutes=m) for m in (1, 3, VISIT_SEPARATION)]
+        with CaptureQueriesContext(connection) as queries:
+            segmentation = Visit.segmentation(thresholds)
+        self.assertEqual(len(queries.captured_queries), 1)
+
+        # At the visit separation, what Visits are
+        visits = segmentation[timedelta(minutes=VISIT_SEPARATION)]
+        self.assertEqual(visits["visits"], Visit.objects.count())
+        self.assertEqual(visits["durations"], Visit.histogram("durations", timedelta(seconds=30)))
+        self.assertEqual(visits["doors_per_visit_total"], Visit.histogram("doors_per_visit_total"))
+        self.assertEqual(visits["doors_per_visit_unique"], Visit.histogram("doors_per_visit_unique"))
+
+        # And at any threshold what Visit.segment makes of the openings
+        openings = list(Opening.objects.order_by("date_time"))
+        for threshold in thresholds:
+            segments = Visit.segment(openings, separation=threshold)
+            self.assertEqual(segmentation[threshold]["visits"], len(segments))
+            self.assertEqual(segmentation[threshold]["doors_per_visit_total"], dict(sorted(Counter(len(o) for o, q in segments).items())))
+            self.assertEqual(segmentation[threshold]["doors_per_visit_unique"], dict(sorted(Counter(len(set(x.door_id for x in o)) for o, q in segments).items())))
+
+        self.assertTrue(segmentation[thresholds[0]]["visits"] > segmentation[thresholds[1]]["visits"] > segmentation[thresholds[2]]["visits"])
+
+
+@skipUnless(connection.vendor == "postgresql", "Shadow rebuilds are PostgreSQL only")
+class ShadowRebuildTests(TestCase):
+
+    def setUp(self):
+        Door.objects.all().delete()
+        self.doors = [Door.objects.create(tuya_device_id=f"door{i}") for i in range(2)]
+        for i, door in enumerate(self.doors):
+            synthetic_events(door, 200, start=1670000000000 + 2 * i, seed=i)
+            synthetic_uptimes(door, 200, start=1670000000001 + 2 * i, seed=i)
+            Pipeline(door).run()
+        Visit.update_from_openings()
+
+    def derived(self):
+        return [list(Opening.objects.order_by("date_time").values_list("door_id", "open_event_id", "close_event_id", "duration", "visit__date_time")),
+                list(Uptime.objects.order_by("date_time").values_list("door_id", "online_event_id", "offline_event_id", "duration")),
+                list(Visit.objects.order_by("date_time").values_list("date_time", "duration", "prior_quiet", "doors", "overlaps", "doors_open"))]
+
+    def structure(self):
+        with connection.cursor() as cursor:
+            return ({model: shadow.indexes(cursor, model._meta.db_table) for model in shadow.MODELS},
+                    {model: shadow.foreign_keys(cursor, referenced=model._meta.db_table) for model in shadow.MODELS})
+
+    def shadows(self):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT tablename FROM pg_tables WHERE tablename LIKE %s", ["%_shadow"])
+            return cursor.fetchall()
+
+    def test_swap_preserves_data(self):
+        before = self.derived()
+        structure = self.structure()
+        self.assertTrue(len(before[0]) > 100 and len(before[1]) > 100 and len(before[2]) > 1)
+
+        # Readers see the live data until the swap
+        shadow.build()
+        self.assertEqual(self.derived(), before)
+        with connection.cursor() as cursor:
+            self.assertEqual(shadow.checksums(cursor, shadow=True), shadow.checksums(cursor))
+
+        validation, swapped = shadow.rebuild()
+        self.assertTrue(swapped)
+        self.assertEqual(self.derived(), before)
+
+        # The swapped in tables have the indexes and foreign keys of the tables they replaced (by name)
+        self.assertEqual(self.structure(), structure)
+        self.assertEqual(self.shadows(), [])
+
+        # And are updated incrementally from there
+        last = Event.objects.order_by("-timestamp").first()
+        synthetic_events(self.doors[0], 50, start=last.timestamp + 1, seed=3)
+        Pipeline(self.doors[0]).run()
+        Visit.update_from_openings()
+        self.assertTrue(Opening.objects.count() > len(before[0]))
+        self.assertEqual(Event.pairing_drift(), {})
+
+        validation, swapped = shadow.rebuild()
+        self.assertTrue(swapped)
+        for model, (live, rebuilt) in validation.items():
+            self.assertEqual(live, rebuilt)
+
+    def test_changes_need_accepting(self):
+        before = self.derived()
+        Opening.objects.filter(open_event_id=before[0][10][1]).delete()
+
+        validation, swapped = shadow.rebuild()
+        self.assertFalse(swapped)
+        self.assertEqual(validation[Opening][0][0] + 1, validation[Opening][1][0])
+        self.assertEqual(Opening.objects.count(), len(before[0]) - 1)
+        self.assertEqual(self.shadows(), [])
+
+        validation, swapped = shadow.rebuild(accept_changes=True)
+        self.assertTrue(swapped)
+        self.assertEqual(self.derived(), before)
+        self.assertEqual(Event.pairing_drift(), {})
@@ -23,6 +23,12 @@ def ajax_List(request, model):
 
     response = {'view_URL':view_url, 'json_URL':json_url, 'HTML':html}
 
+    # Add the cursors of the pages either side (see Doors.views.keyset), None at the ends
+    response['cursor_prior'] = view.page.prior
+    response['cursor_next'] = view.page.next
+    response['json_URL_prior'] = f"{json_url}?{view.prior_query}" if view.prior_query else None
+    response['json_URL_next'] = f"{json_url}?{view.next_query}" if view.next_query else None
+
     return HttpResponse(json.dumps(response))
 
 
@@ -0,0 +1,77 @@
+'''
+A page cache for the views whose content only changes when logs are fetched.
+
+Cached pages are keyed on the version of the data (see DataFetch.version), which goes up every time
+a fetch finishes (resumed or not) and whenever the data is changed other than by a fetch, and so
+invalidates them all. Superseded versions are never read again and age out of the cache.
+
+The cache used is the one named by settings.PAGE_CACHE (in settings.CACHES) so that the backend
+is pluggable: local memory in development and testing, and shared by the uWSGI workers (and the
+fetch_logs command that warms it) on the live site.
+'''
+from django.conf import settings
+from django.core.cache import caches
+from django.http.response import HttpResponse
+from django.test.client import RequestFactory
+from django.urls import reverse, resolve
+
+from Doors.models import DataFetch
+
+from Site.logutils import log
+
+# The URL names of the pages cached, and warmed after each fetch
+CACHED_PAGES = ['home', 'trends', 'technical']
+
+
+def page_cache():
+    return caches[getattr(settings, "PAGE_CACHE", "default")]
+
+
+def page_key(request, version):
+    return f"page:{version}:{request.get_full_path()}"
+
+
+class CachedPage:
+    '''
+    A mixin for views, that caches the rendered page until the data changes. Must precede
+    the view class in the bases (so that its get() runs first).
+    '''
+
+    def get(self, request, *args, **kwargs):
+        key = page_key(request, DataFetch.version())
+        cached = page_cache().get(key)
+
+        if cached is None:
+            response = super().get(request, *args, **kwargs)
+            if hasattr(response, "render"):
+                response.render()
+            if response.status_code == 200:
+                page_cache().set(key, (response.content, response["Content-Type"]))
+            return response
+        else:
+            content, content_type = cached
+            return HttpResponse(content, content_type=content_type)
+
+
+def warm_pages(pages=CACHED_PAGES, verbosity=1):
+    '''
+    Renders the cached pages so that they are in the cache for the first visitor after a fetch.
+
+    :param pages: a list of URL names of the pages to render
+    :param verbosity: Django manage.py argument for Verbosity level; 0=minimal output, 1=normal output, 2=verbose output, 3=very verbose output
+    '''
+    factory = RequestFactory(SERVER_NAME=settings.ALLOWED_HOSTS[0] if settings.ALLOWED_HOSTS else "localhost")
+
+    for name in pages:
+        path = reverse(name)
+        request = factory.get(path)
+        request.resolver_match = resolve(path)
+
+        try:
+            response = request.resolver_match.func(request, *request.resolver_match.args, **request.resolver_match.kwargs)
+            if verbosity >= 1:
+                print(f"Warmed {path} ({response.status_code}).")
+        except Exception as E:
+            log.warning(f"Failed to warm {path}: {E}")
+            if verbosity >= 1:
+                print(f"Failed to warm {path}: {E}")
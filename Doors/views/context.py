@@ -1,4 +1,4 @@
-from Doors.models import Event, Opening, Visit, DataFetch
+from Doors.models import DataFetch
 from Doors.models.conf import VISIT_SEPARATION
 
 
@@ -11,23 +11,8 @@ def general_context(self, context={}):
     context['view_name'] = self.request.resolver_match.view_name
     context['menu_items'] = ['home', 'recent', 'trends', 'technical', 'nearby', 'build']
 
-    first_event = Event.first().date_time
-    last_event = Event.last().date_time
-    last_fetch = DataFetch.objects.last()
-    if last_fetch:
-        last_fetch = last_fetch.date_time
-    else:
-        last_fetch = "unknown"
-
-    context["data_stats"] = {
-        'first_event': first_event,
-        'last_event': last_event,
-        'last_fetch': last_fetch,
-        'time_span': last_event - first_event,
-        'event_count': Event.histogram['doorcontact_state'],
-        'open_count': Opening.objects.all().count(),
-        'visit_count': Visit.objects.all().count(),
-        'visit_separation': VISIT_SEPARATION
-        }
+    # In one query, from the snapshot taken at the last fetch (see DataFetch.data_stats)
+    context["data_stats"] = DataFetch.data_stats()
+    context["data_stats"]['visit_separation'] = VISIT_SEPARATION
 
     return context
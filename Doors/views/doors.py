@@ -1,21 +1,23 @@
 # from django.views.generic import TemplateView
-import math, re, numpy as np
+import math, re
 
-from datetime import timedelta
+from datetime import date, timedelta
 
 from bokeh.plotting import figure
 from bokeh.embed import components
 from bokeh.models import FixedTicker, BasicTicker, SingleIntervalTicker, CategoricalTicker, Range1d, CategoricalTickFormatter, CustomJS
 from bokeh.resources import Resources
 
-from django.db.models import Count, Min, Max, Avg
+from django.core.exceptions import BadRequest
 
 from django_rich_views.views import RichTemplateView
 from django_rich_views.css import get_css_custom_properties, parse_color
 
-from Doors.models import Door, Visit, Event, Opening, Uptime
+from Doors.models import Door, Visit, Event, Opening, Uptime, Histogram, DailyRollup
+from Doors.models.histogram import DURATION_CATEGORIES, QUIET_CATEGORIES
 
 from .context import general_context
+from .cache import CachedPage
 
 from Site.logutils import log
 
@@ -89,19 +91,18 @@ def histogram(data, category_label, value_label="Number of Visits", bar_color="g
     return {"JSfiles": resources.js_files, "script": graph_script, "div": graph_div}
 
 
-def graph(data, xlabel, ylabel, line_color='green'):
+def graph(series, xlabel, ylabel, line_color='green'):
     '''
-    Produced a line graph.
+    Produced a line graph, of a series as steps (dots at each step) and its smoothed fit (a line).
 
-    :param data: a dict, with x as key and y as value
+    :param series: a dict with the points in x and y and the smoothed fit in smooth_x and smooth_y (see Event.battery_series)
     :param xlabel: an x-axis label
     :param ylabel: a y-axis label
     '''
-    JS = JSResources(minified=False, mode='cdn')
+    resources = Resources(minified=False, mode='cdn')
 
-    x = list(data.keys())
-    y = list(data.values())
-    y_smooth = np.poly1d(np.polyfit(x, y, 5))(x)
+    x = series["x"]
+    y = series["y"]
 
     plot = figure(sizing_mode='stretch_both',  # Fill the container (use CSS of container to size)
                   x_axis_label=xlabel,
@@ -120,15 +121,16 @@ def graph(data, xlabel, ylabel, line_color='green'):
 
     plot.yaxis.ticker = list(range(0, max(y)))
 
-    line = plot.line(x, y_smooth, color=line_color, line_width=5)
+    line = plot.line(series["smooth_x"], series["smooth_y"], color=line_color, line_width=5)
+    steps = plot.step(x, y, color='red', mode="after")
     points = plot.dot(x, y, color='red', size=10)
 
     graph_script, graph_div = components(plot)
 
-    return {"JSfiles": JS.js_files, "script": graph_script, "div": graph_div}
+    return {"JSfiles": resources.js_files, "script": graph_script, "div": graph_div}
 
 
-class HomePage(RichTemplateView):
+class HomePage(CachedPage, RichTemplateView):
     template_name = "homepage.html"
 
     def extra_context_provider(self, context={}):
@@ -144,7 +146,29 @@ class Recent(RichTemplateView):
         return general_context(self, context)
 
 
-class Trends(RichTemplateView):
+def trends_range(params):
+    '''
+    Returns the first and last days (dates, None for no bound) of the range of days requested in params (a
+    QueryDict) with days=N (the last N days), year=YYYY, or start=YYYY-MM-DD and/or end=YYYY-MM-DD. Both
+    None if no range is requested. Raises BadRequest if the range is malformed.
+    '''
+    try:
+        if params.get("days"):
+            days = int(params["days"])
+            if days < 1:
+                raise ValueError(f"days must be positive, not {days}")
+            today = date.today()
+            return today - timedelta(days=days - 1), today
+        elif params.get("year"):
+            year = int(params["year"])
+            return date(year, 1, 1), date(year, 12, 31)
+        else:
+            return tuple(date.fromisoformat(params[bound]) if params.get(bound) else None for bound in ("start", "end"))
+    except ValueError as E:
+        raise BadRequest(f"Invalid range of days: {E}") from E
+
+
+class Trends(CachedPage, RichTemplateView):
     template_name = "trends.html"
 
     def extra_context_provider(self, context={}):
@@ -166,54 +190,64 @@ class Trends(RichTemplateView):
         #     rgb_value = (int(r * 255), int(g * 255), int(b * 255))
         #     self.bar_color = rgb_value
 
-        event_histogram = Event.histogram
-
         # A little asertion here on data integrity. Not literallya serted (with an asert) because while
         # teething in it has actually failed a fair bit. Just dumps enough diagnostics identify where
-        # the assertion fails.
-        orphans = len(Event.orphans)
-        io = Event.invalid_orphans()
+        # the assertion fails. In a constant number of queries, however many orphans there are.
+        orphans = Event.orphan_analysis()
+        io = [o for o in orphans if not o.valid]
 
+        # The first event on a door (if Closed) and the last (if Open) are orphans that lack a neighbour
         allowance = 0
-        for door in Door.objects.all():
-            first = Event.first('doorcontact_state', door)
-            last = Event.last('doorcontact_state', door)
-            if first.value == 'Closed': allowance += 1
-            if last.value == 'Open': allowance += 1
+        for o in orphans:
+            if o.before[1] is None and o.value == 'Closed': allowance += 1
+            if o.after[0] is None and o.value == 'Open': allowance += 1
+
+        events = Event.objects.filter(code='doorcontact_state').count()
+        openings = Opening.objects.all().count()
 
-        if Opening.objects.all().count() * 2 + len(io) + allowance != event_histogram['doorcontact_state']:
+        if openings * 2 + len(io) + allowance != events:
             log.debug("Databases inconsistency")
-            log.debug(f"\tEvents with code 'Door Contact State' : {event_histogram['doorcontact_state']}")
-            log.debug(f"\tEvents with code 'Door Contact State' that are orphans (have no associate Opening): {event_histogram['doorcontact_state_orphans']}")
-            log.debug(f"\tEvent.orphans: {orphans}")
+            log.debug(f"\tEvents with code 'Door Contact State' : {events}")
+            log.debug(f"\tEvents with code 'Door Contact State' that are orphans (have no associate Opening): {len(orphans)}")
             log.debug(f"\tEvent.invalid_orphans: {len(io)}    An valid orphan is one in which the door contact states either side (before and after) are NOT identical.")
-            log.debug(f"\tA count of Openings: {Opening.objects.all().count()}")
-            log.debug(f"\tExpected events for {Opening.objects.all().count()} Openings: {Opening.objects.all().count()*2}")
-            log.debug(f"\tFirst events (Closed would be an orphan): {[Event.first('doorcontact_state', door).value for door in Door.objects.all()]}")
-            log.debug(f"\tLast events (Open would be an orphan): {[Event.last('doorcontact_state', door).value for door in Door.objects.all()]}")
+            log.debug(f"\tA count of Openings: {openings}")
+            log.debug(f"\tExpected events for {openings} Openings: {openings*2}")
+            log.debug(f"\tFirst events (Closed would be an orphan): {[o.value for o in orphans if o.before[1] is None]}")
+            log.debug(f"\tLast events (Open would be an orphan): {[o.value for o in orphans if o.after[0] is None]}")
             log.debug(f"\tAllowance (being valid orphans, from First or Last): {allowance}")
-            log.debug(f"\tCheck sum: {Opening.objects.all().count()*2}+{len(io)}+{allowance}={Opening.objects.all().count()*2+len(io)+allowance} and should = {event_histogram['doorcontact_state']}")
+            log.debug(f"\tCheck sum: {openings*2}+{len(io)}+{allowance}={openings*2+len(io)+allowance} and should = {events}")
+
+        # The histograms of all days are precomputed (refreshed with every fetch of the logs) and those of
+        # a range of days are drawn from the daily rollups of those days
+        start, end = trends_range(self.request.GET)
+        if start is None and end is None:
+            histograms = Histogram.all()
+        else:
+            histograms = DailyRollup.histograms(start, end)
+            context["range_stats"] = DailyRollup.summary(start, end)
+        context["range_start"] = start
+        context["range_end"] = end
 
         # Visit histograms
-        context["histogram_by_per_day"] = histogram(Visit.histogram("per_days"), "Visits per Day", bar_color=self.bar_color)
-        context["histogram_by_hour_of_day"] = histogram(Visit.histogram("day"), "Hour of the Day", bar_color=self.bar_color)
-        context["histogram_by_day_of_week"] = histogram(Visit.histogram("week"), "Day of the Week", bar_color=self.bar_color)
-        context["histogram_by_day_of_month"] = histogram(Visit.histogram("month"), "Day of the Month", bar_color=self.bar_color)
-        context["histogram_by_month_of_year"] = histogram(Visit.histogram("year", "months"), "Month", bar_color=self.bar_color)
-        context["histogram_by_week_of_year"] = histogram(Visit.histogram("year", "weeks"), "Month", bar_color=self.bar_color)
-        context["histogram_by_durations"] = histogram(Visit.histogram("durations", timedelta(seconds=30)), "Visit Duration (min:sec)", bar_color=self.bar_color, tick_every=3)
-        context["histogram_by_quiet_times"] = histogram(Visit.histogram("quiet_times", timedelta(minutes=30)), "Quiet Time (min:sec)", bar_color=self.bar_color, tick_every=2)
-        context["histogram_total_doors_per_visit"] = histogram(Visit.histogram("doors_per_visit_total"), "Total Doors Opened", bar_color=self.bar_color)
-        context["histogram_unique_doors_per_visit"] = histogram(Visit.histogram("doors_per_visit_unique"), "Unique Doors Opened", bar_color=self.bar_color)
+        context["histogram_by_per_day"] = histogram(histograms[(Visit, "per_days", None)], "Visits per Day", bar_color=self.bar_color)
+        context["histogram_by_hour_of_day"] = histogram(histograms[(Visit, "day", None)], "Hour of the Day", bar_color=self.bar_color)
+        context["histogram_by_day_of_week"] = histogram(histograms[(Visit, "week", None)], "Day of the Week", bar_color=self.bar_color)
+        context["histogram_by_day_of_month"] = histogram(histograms[(Visit, "month", None)], "Day of the Month", bar_color=self.bar_color)
+        context["histogram_by_month_of_year"] = histogram(histograms[(Visit, "year", "months")], "Month", bar_color=self.bar_color)
+        context["histogram_by_week_of_year"] = histogram(histograms[(Visit, "year", "weeks")], "Month", bar_color=self.bar_color)
+        context["histogram_by_durations"] = histogram(histograms[(Visit, "durations", DURATION_CATEGORIES)], "Visit Duration (min:sec)", bar_color=self.bar_color, tick_every=3)
+        context["histogram_by_quiet_times"] = histogram(histograms[(Visit, "quiet_times", QUIET_CATEGORIES)], "Quiet Time (min:sec)", bar_color=self.bar_color, tick_every=2)
+        context["histogram_total_doors_per_visit"] = histogram(histograms[(Visit, "doors_per_visit_total", None)], "Total Doors Opened", bar_color=self.bar_color)
+        context["histogram_unique_doors_per_visit"] = histogram(histograms[(Visit, "doors_per_visit_unique", None)], "Unique Doors Opened", bar_color=self.bar_color)
 
         # Opening histograms
-        context["histogram_by_doors"] = histogram(Visit.histogram("opens_per_door"), "Door", value_label="Number of Openings", bar_color=self.bar_color)
-        context["histogram_by_opening_durations"] = histogram(Opening.histogram("durations", timedelta(seconds=30)), "Opening Duration (min:sec)", value_label="Number of Openings", bar_color=self.bar_color, tick_every=2)
+        context["histogram_by_doors"] = histogram(histograms[(Visit, "opens_per_door", None)], "Door", value_label="Number of Openings", bar_color=self.bar_color)
+        context["histogram_by_opening_durations"] = histogram(histograms[(Opening, "durations", DURATION_CATEGORIES)], "Opening Duration (min:sec)", value_label="Number of Openings", bar_color=self.bar_color, tick_every=2)
 
         return general_context(self, context)
 
 
-class Technical(RichTemplateView):
+class Technical(CachedPage, RichTemplateView):
     template_name = "technical.html"
 
     def extra_context_provider(self, context={}):
@@ -228,20 +262,29 @@ class Technical(RichTemplateView):
         else:
             self.bar_color = "red"
 
-        # Calculate the uptime statistcs
-        uptimes = Uptime.objects.all().aggregate(count=Count('duration'), min=Min('duration'), max=Max('duration'), avg=Avg('duration'))
+        # The uptime statistcs, from the uptime sketches (without reading the uptimes)
+        uptimes = Uptime.statistics()
 
         context["count_uptimes"] = uptimes["count"]
         context["min_uptime"] = uptimes["min"]
         context["max_uptime"] = uptimes["max"]
         context["avg_uptime"] = uptimes["avg"]
+        context["median_uptime"] = uptimes["quantiles"][0.5]
+        context["p90_uptime"] = uptimes["quantiles"][0.9]
+        context["p99_uptime"] = uptimes["quantiles"][0.99]
         context["uptime_histogram"] = histogram(Uptime.histogram(), "Uptime duration (seconds)", "Frequency", bar_color=self.bar_color)
 
+        # Keyed on door, with the event at which its battery charge last changed, and the series of all doors
+        # in one query (downsampled, so bounded in size however long the history)
         context[f"battery_graphs"] = {}
-        for door in Door.objects.all():
-            context[f"battery_graphs"][door.id] = graph(Event.battery_graph(door), "Time (days)", "Battery Charge", line_color=self.bar_color)
-
-        context["orphans"] = Event.orphans
+        battery_series = Event.battery_series()
+        for door in Door.objects.select_related("battery_event"):
+            if door.id in battery_series:
+                series = battery_series[door.id]
+                context[f"battery_graphs"][door] = dict(graph(series, "Time (days)", "Battery Charge", line_color=self.bar_color), replace=series["replace"])
+
+        # Orphans with their neighbours, in one query (see Event.orphan_analysis)
+        context["orphans"] = Event.orphan_analysis()
 
         return general_context(self, context)
 
@@ -1,7 +1,27 @@
 from django_rich_views.views import RichListView, RichDetailView
 from django_rich_views.options import list_display_format, object_display_format
 
+from django.core.exceptions import BadRequest
+
 from .context import general_context
+from .keyset import KeysetPage, neighbours, page_query
+
+
+def with_related(queryset):
+    '''
+    Returns queryset fetching the related objects that its objects render when listed, as declared by
+    the model in list_select_related (joined) and list_prefetch_related (fetched in one query each), so
+    that a page of objects takes a fixed number of queries whatever its size.
+    '''
+    select = getattr(queryset.model, "list_select_related", ())
+    prefetch = getattr(queryset.model, "list_prefetch_related", ())
+
+    if select:
+        queryset = queryset.select_related(*select)
+    if prefetch:
+        queryset = queryset.prefetch_related(*prefetch)
+
+    return queryset
 
 
 class view_List(RichListView):
@@ -9,8 +29,35 @@ class view_List(RichListView):
     format = list_display_format()
     extra_context_provider = general_context
 
+    def get_queryset(self, *args, **kwargs):
+        # Used for /list and /json (see ajax_List) pages alike. The page cursors are taken from the
+        # request so they aren't read as filters, and the list is a page of objects in key order.
+        params = self.request.GET.copy()
+        after = params.pop("after", [None])[-1]
+        before = params.pop("before", [None])[-1]
+        self.request.GET = params
+
+        try:
+            self.page = KeysetPage(with_related(super().get_queryset(*args, **kwargs)), after, before)
+        except ValueError as E:
+            raise BadRequest(str(E)) from E
+
+        # The query strings of the pages either side (None at the ends), which keep the other parameters
+        self.prior_query = page_query(params, before=self.page.prior) if self.page.prior else None
+        self.next_query = page_query(params, after=self.page.next) if self.page.next else None
+
+        self.queryset = self.page.object_list
+        return self.queryset
+
 
 class view_Detail(RichDetailView):
     template_name = 'detail.html'
     format = object_display_format()
     extra_context_provider = general_context
+
+    def get_object(self, *args, **kwargs):
+        # The prior and next objects browsed to are found by keyset lookups (see Doors.views.keyset)
+        obj = super().get_object(*args, **kwargs)
+        if getattr(self, "object_browser", None):
+            self.object_browser = (*neighbours(obj), *self.object_browser[2:])
+        return obj
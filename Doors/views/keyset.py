@@ -0,0 +1,155 @@
+'''
+Keyset (cursor) pagination, for paging through lists of objects in the order of their natural keys.
+
+A model declares the fields it is ordered on in ordering_keys (unique together, ending in a tiebreak
+like the id if need be, and indexed) else it is ordered on its primary key. A page is found by seeking in
+the index to the keys of the row before it (the cursor), so a page deep into a large table (Events) costs
+no more than the first, where an offset has the database count through every row before it.
+
+Cursors are the keys of a row, JSON encoded and URL safe base64 encoded.
+'''
+import json
+
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+
+from django.db.models import Q
+
+# The number of objects on a page of the list views
+PAGE_SIZE = 100
+
+
+def ordering_keys(model):
+    return getattr(model, "ordering_keys", ("pk",))
+
+
+def key_field(model, key):
+    return model._meta.pk if key == "pk" else model._meta.get_field(key)
+
+
+def encode(values):
+    '''
+    Returns a cursor for a row with key values (a list or tuple of them). Times are encoded to the
+    microsecond (as the database holds them) so that a cursor matches its row exactly.
+    '''
+    values = [value.isoformat() if hasattr(value, "isoformat") else value for value in values]
+    return urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip("=")
+
+
+def decode(model, cursor):
+    '''
+    Returns the key values a cursor holds for a row of model. Raises ValueError if the cursor is invalid.
+    '''
+    keys = ordering_keys(model)
+    try:
+        values = json.loads(urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except Exception as E:
+        raise ValueError(f"Invalid cursor: {cursor}") from E
+
+    if not isinstance(values, list) or len(values) != len(keys):
+        raise ValueError(f"Invalid cursor: {cursor}")
+
+    try:
+        return [key_field(model, key).to_python(value) for key, value in zip(keys, values)]
+    except Exception as E:
+        raise ValueError(f"Invalid cursor: {cursor}") from E
+
+
+def beyond(keys, values, reverse=False):
+    '''
+    Returns a Q object selecting rows with keys after values in key order (or before them if reverse). It
+    bounds the leading key as well, so that an index on it can seek to the cursor.
+    '''
+    op = "lt" if reverse else "gt"
+    q = Q()
+    equal = {}
+    for key, value in zip(keys, values):
+        q |= Q(**equal, **{f"{key}__{op}": value})
+        equal[key] = value
+    if len(keys) > 1:
+        q &= Q(**{f"{keys[0]}__{op}e": values[0]})
+    return q
+
+
+def ordered(queryset, keys, reverse=False):
+    return queryset.order_by(*(f"-{key}" if reverse else key for key in keys))
+
+
+def neighbours(obj, queryset=None):
+    '''
+    Returns the primary keys of the objects before and after obj in key order (None at the ends) in one
+    indexed query each.
+
+    :param obj: a model instance
+    :param queryset: the objects to look among (default all objects of its model)
+    '''
+    model = type(obj)
+    keys = ordering_keys(model)
+    values = [getattr(obj, key) for key in keys]
+    if queryset is None:
+        queryset = model.objects.all()
+
+    prior = ordered(queryset.filter(beyond(keys, values, reverse=True)), keys, reverse=True).values_list("pk", flat=True).first()
+    next = ordered(queryset.filter(beyond(keys, values)), keys).values_list("pk", flat=True).first()
+    return prior, next
+
+
+def page_query(params, after=None, before=None):
+    '''
+    Returns the query string of the page after or before a cursor: the parameters of the request (filters,
+    formats and such) with the cursor given in place of any the request had.
+
+    :param params: a QueryDict, the GET parameters of a request
+    :param after: a cursor, for the page after it
+    :param before: a cursor, for the page before it
+    '''
+    params = params.copy()
+    params.pop("after", None)
+    params.pop("before", None)
+    params["after" if after is not None else "before"] = after if after is not None else before
+    return params.urlencode()
+
+
+class KeysetPage:
+    '''
+    A page of a queryset in key order, of the rows after a cursor, or before one (or the first page). In
+    a fixed number of queries however deep the page:
+
+        1 for the objects (when object_list is evaluated)
+        1 for the next cursor (the keys of the last object, if there are more after it)
+        1 for the prior cursor and 1 to check there are objects before it (only if paging from a cursor)
+        1 to find the start of the page (only if paging back)
+    '''
+
+    def __init__(self, queryset, after=None, before=None, size=PAGE_SIZE):
+        '''
+        :param queryset: a QuerySet of the objects to page through
+        :param after: a cursor, for the page after it
+        :param before: a cursor, for the page before it
+        :param size: the most objects on a page
+        '''
+        model = queryset.model
+        keys = ordering_keys(model)
+
+        if before is not None:
+            # The page starts size objects before the cursor (or at the first)
+            rows = queryset.filter(beyond(keys, decode(model, before), reverse=True))
+            start = ordered(rows, keys, reverse=True).values_list(*keys)[size - 1:size].first()
+            if start is not None:
+                rows = rows.filter(~beyond(keys, start, reverse=True))
+        elif after is not None:
+            rows = queryset.filter(beyond(keys, decode(model, after)))
+        else:
+            rows = queryset
+
+        rows = ordered(rows, keys)
+        self.object_list = rows[:size]
+
+        # The keys of the last object on the page and the first on the next, if there is one
+        edge = list(rows.values_list(*keys)[size - 1:size + 1])
+        self.next = encode(edge[0]) if len(edge) == 2 else None
+
+        self.prior = None
+        if after is not None or before is not None:
+            first = rows.values_list(*keys).first()
+            if first is not None and queryset.filter(beyond(keys, first, reverse=True)).exists():
+                self.prior = encode(first)
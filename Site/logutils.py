@@ -6,9 +6,10 @@ To use, just import "log" from here and call log.debug(msg).
 import re, logging
 
 from re import RegexFlag as ref  # Specifically to avoid a PyDev Error in the IDE.
-from time import time
+from time import time, perf_counter
 
 from django.conf import settings
+from django.db import connection
 
 log = logging.getLogger("MSL")
 
@@ -75,6 +76,60 @@ class LoggingMiddleware(object):
         return self.get_response(request)
 
 
+class QueryCounter(object):
+    '''
+    A database execute wrapper that counts the queries executed and the time they take.
+
+    See: https://docs.djangoproject.com/en/4.1/topics/db/instrumentation/
+    '''
+
+    def __init__(self):
+        self.count = 0
+        self.time = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.time += perf_counter() - start
+
+
+class QueryCountMiddleware(object):
+    '''
+    A simple middleware to instrument every request with the number of database queries it executed,
+    their time and the total time taken. Reported to the log when debugging, and in response headers
+    (X-Query-Count, X-Query-Time and a Server-Timing header that browser developer tools present) if
+    settings.QUERY_COUNT_HEADERS is True (as it is in development but not on the live site).
+    '''
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        counter = QueryCounter()
+        start = perf_counter()
+
+        with connection.execute_wrapper(counter):
+            response = self.get_response(request)
+
+        total = perf_counter() - start
+
+        request.query_count = counter.count
+        request.query_time = counter.time
+
+        if getattr(settings, "QUERY_COUNT_HEADERS", False):
+            response["X-Query-Count"] = counter.count
+            response["X-Query-Time"] = f"{counter.time * 1000:.1f}"
+            response["Server-Timing"] = f'db;desc="{counter.count} queries";dur={counter.time * 1000:.1f}, total;dur={total * 1000:.1f}'
+
+        if settings.DEBUG:
+            log.debug(f"{request.path}: {counter.count} queries in {counter.time * 1000:.1f} ms, {total * 1000:.1f} ms in all.")
+
+        return response
+
+
 relative_filter = RelativeFilter()
 
 log.addFilter(relative_filter)
@@ -10,7 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.1/ref/settings/
 """
 
-import platform, sys, os
+import platform, sys, os, tempfile
 
 from pathlib import Path
 from tzlocal import get_localzone
@@ -95,6 +95,7 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     # "debug_toolbar.middleware.DebugToolbarMiddleware",
+    'Site.logutils.QueryCountMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -104,6 +105,10 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
+# Report the queries each request made in its response headers (see Site.logutils.QueryCountMiddleware),
+# not on the live site where anyone could read them
+QUERY_COUNT_HEADERS = not SITE_IS_LIVE
+
 # Add the lighttpd middleware if live
 if SITE_IS_LIVE:
     WSGI_APPLICATION = 'Site.wsgi.application'
@@ -182,6 +187,35 @@ USE_L10N = True
 # https://docs.djangoproject.com/en/3.1/howto/static-files/
 STATIC_URL = '/static/'
 
+# Caches
+# https://docs.djangoproject.com/en/4.1/topics/cache/
+#
+# Pages that only change when logs are fetched are cached in PAGE_CACHE (see Doors.views.cache).
+# On the live site uWSGI runs several worker processes, and the fetch_logs command warms the cache
+# from another process still, so they share a file based cache (a memcached or redis backend can
+# be configured here just as well). In development a local memory cache suffices.
+PAGE_CACHE = 'pages'
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    PAGE_CACHE: {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': '/data/cache/MontaguStreetLibrary',
+        'TIMEOUT': 2 * 24 * 60 * 60,  # Two days, pages are invalidated by every (daily) fetch anyhow
+    } if SITE_IS_LIVE else {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'pages',
+        'TIMEOUT': None,
+    }
+}
+
+# A columnar cache of Events, Openings and Visits (see Doors.models.columns), written after every fetch of the
+# logs and memory mapped read only by the uWSGI workers, which share its pages in the OS page cache. None to
+# disable it (and read all data through the ORM).
+COLUMN_CACHE = '/data/cache/MontaguStreetLibrary/columns' if SITE_IS_LIVE else os.path.join(tempfile.gettempdir(), 'MontaguStreetLibrary', 'columns')
+
 # TUYA Settings
 
 TUYA_KEY = "nsk4pxgkmmggs5ffqxkd"